@@ -0,0 +1,304 @@
+"""
+Builds a synthetic fleet of Cisco-like devices, with its devices inventory and its cfg_cmd_check.xlsx templates,
+and times the three phases of template_create_check.py on it: gen_template, gen_excel and fix_cfg. No real
+configuration is needed, and the size of everything can be chosen:
+
+    python bench_fleet.py --devices 500 --lines 5000 --depth 3 --commands 800 --regex 0.2
+
+Every phase runs in its own process, so that the peak memory reported is the one of that phase only (with
+--workers the memory of the worker processes is not included). Use --workdir to keep the generated fleet and the
+output files, and --json to save the results.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import openpyxl
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+line_break = '@@@'
+
+words = ['core', 'edge', 'access', 'backup', 'primary', 'mgmt', 'voice', 'video', 'data', 'guest', 'transit',
+         'customer', 'uplink', 'downlink', 'peer', 'lab', 'dmz', 'wan', 'lan', 'ring']
+
+
+def section (rnd, name, depth, width):
+    """ Returns the (indent, text) lines of a section with children nested down to 'depth' levels """
+    lines = [(0, name)]
+    if depth <= 0:
+        return lines
+    for i in range(width):
+        child = rnd.choice(['set', 'match', 'police rate', 'priority level', 'bandwidth', 'queue-limit']) + ' ' + str(i)
+        for indent, text in section(rnd, child, depth - 1, max(1, width // 2)):
+            lines.append((indent + 1, text))
+    return lines
+
+
+def golden_config (rnd, lines, depth):
+    """ The reference config of a profile, every device is a variation of it. Returns (indent, text) lines. """
+    config = []
+    counter = 0
+    while len(config) < lines:
+        counter += 1
+        kind = counter % 6
+        if kind == 0:
+            config.append((0, 'service ' + rnd.choice(words) + '-' + str(counter)))
+        elif kind == 1:
+            config.append((0, 'logging host 10.%d.%d.%d' % (counter // 65536 % 256, counter // 256 % 256, counter % 256)))
+        elif kind == 2:
+            config.append((0, 'interface GigabitEthernet0/%d/%d' % (counter // 48, counter % 48)))
+            config.append((1, 'description ' + rnd.choice(words) + ' link ' + str(counter)))
+            config.append((1, 'ip address 10.%d.%d.1 255.255.255.252' % (counter // 256 % 256, counter % 256)))
+            config.append((1, 'service-policy output PM-' + rnd.choice(words)))
+            config.append((1, 'no shutdown'))
+        elif kind == 3:
+            config += [(indent, text) for indent, text in section(rnd, 'policy-map PM-' + str(counter), depth, 4)]
+        elif kind == 4:
+            config.append((0, 'vrf definition VRF-' + str(counter)))
+            config.append((1, 'rd 65000:' + str(counter)))
+            if depth > 1:
+                config.append((1, 'address-family ipv4'))
+                config.append((2, 'route-target export 65000:' + str(counter)))
+                config.append((2, 'route-target import 65000:' + str(counter)))
+                config.append((1, 'exit-address-family'))
+        else:
+            config.append((0, 'snmp-server community ' + rnd.choice(words) + str(counter) + ' RO'))
+        if kind in (2, 3, 4):
+            config.append((0, '!'))
+    return config
+
+
+def device_config (rnd, golden, dev, missing):
+    """ The config of a device: the golden one with some lines missing and some device specific values """
+    lines = ['Building configuration...', '', 'Current configuration : 123456 bytes', '!', 'version 15.2',
+             'hostname ' + dev, '!']
+    skip_below = None
+    for indent, text in golden:
+        # a missing line takes all its children with it
+        if skip_below != None and indent > skip_below:
+            continue
+        skip_below = None
+        if text != '!' and rnd.random() < missing:
+            skip_below = indent
+            continue
+        if text.startswith('description '):
+            text += ' ' + dev
+        lines.append(' ' * indent + text)
+    lines.append('end')
+    return lines
+
+
+def search_lines (golden):
+    # every line of the golden config with its parents, as the template commands are written
+    parents = []
+    found = []
+    for indent, text in golden:
+        parents = parents[:indent]
+        found.append(line_break.join(parents + [text]))
+        parents.append(text)
+    return found
+
+
+def to_regex (rnd, cmd):
+    """ Turns a literal command into a regexp matching the same line """
+    choice = rnd.randint(0, 2)
+    if choice == 0 and any(c.isdigit() for c in cmd):
+        out = ''
+        digits = False
+        for c in cmd:
+            if c.isdigit():
+                if not digits:
+                    out += '\\d+'
+                digits = True
+            else:
+                out += c
+                digits = False
+        return out
+    segments = cmd[:-1].split(line_break)
+    last = segments[-1].split(' ')
+    if choice == 1 and len(last) > 1:
+        segments[-1] = last[0] + ' .*' + last[-1]
+        return line_break.join(segments) + '$'
+    if len(segments) > 1:
+        segments[0] = segments[0].split(' ')[0] + '.*'
+        return line_break.join(segments) + '$'
+    return '^' + cmd
+
+
+def generate_fleet (workdir, devices, lines, depth, commands, regex, profiles, missing, seed):
+    """ Writes configs, inventory and templates in workdir. Returns the fleet description used by the benchmark. """
+    rnd = random.Random(seed)
+    cfg_root_dir = os.path.join(workdir, 'configs') + os.sep
+    dev_wb = openpyxl.Workbook(write_only=True)
+    dev_sheet = dev_wb.create_sheet('Devices')
+    dev_sheet.append(['Directory', 'proxy\nprot', 'conn\nprofile', 'host\ntransport', 'System Name', 'mgmt ip', 'release',
+                      'Config Check Profile'] + [None] * 7 + ['Profile'])
+    cmd_wb = openpyxl.Workbook(write_only=True)
+    vars_rows = []
+    cfg_template = {}
+    total_lines = 0
+    for p in range(profiles):
+        profile = 'PROFILE_' + str(p + 1)
+        golden = golden_config(rnd, lines, depth)
+        os.makedirs(cfg_root_dir + profile, exist_ok=True)
+        for d in range(p, devices, profiles):
+            dev = 'dev%05d' % d
+            config = device_config(rnd, golden, dev, missing)
+            total_lines += len(config)
+            filename = cfg_root_dir + profile + '/' + dev + '.txt'
+            with open(filename, 'w') as file:
+                file.write('\n'.join(config) + '\n')
+            if not profile in cfg_template:
+                # the template names are taken in cfg_root_dir
+                cfg_template[profile] = profile + '/' + dev + '.txt'
+            dev_sheet.append([profile, 'ssh', 'profile_1', 'ssh', dev, '10.20.%d.%d' % (d // 256, d % 256), 'IOS XE 17.3',
+                              profile] + [None] * 7 + [profile])
+            vars_rows.append([dev, 'Loop_0_ip', '10.10.%d.%d' % (d // 256, d % 256)])
+
+        cmd_sheet = cmd_wb.create_sheet(profile)
+        cmd_sheet.append(['Command', 'Add Command', 'Remove/Change command', 'Cmd Counter'])
+        candidates = [cmd for cmd in search_lines(golden) if not cmd.endswith('!')]
+        rnd.shuffle(candidates)
+        for cmd in candidates[:commands]:
+            cmd = cmd + '$'
+            add_cmd = None
+            if rnd.random() < regex:
+                cmd = to_regex(rnd, cmd)
+            elif rnd.random() < 0.2:
+                add_cmd = cmd[:-1] + ' ! $(Loop_0_ip) + 1'
+            cmd_sheet.append([cmd, add_cmd, None, None])
+    vars_sheet = cmd_wb.create_sheet('VARS')
+    vars_sheet.append(['Device', 'Var Name', 'Var Value'])
+    for row in vars_rows:
+        vars_sheet.append(row)
+    dev_wb.save(os.path.join(workdir, 'IpDevices_list.xlsx'))
+    cmd_wb.save(os.path.join(workdir, 'cfg_cmd_check.xlsx'))
+    return {'cfg_root_dir': cfg_root_dir, 'cfg_template': cfg_template, 'devices': devices, 'lines': total_lines,
+            'commands': commands * profiles}
+
+
+def run_phase (settings, phase, verbose, queue):
+    """ Runs one phase of template_create_check with the given settings, in a process of its own """
+    import template_create_check as tcc
+    for name in settings:
+        setattr(tcc, name, settings[name])
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.perf_counter()
+    getattr(tcc, 'run_' + phase)()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        peak = peak / 1024 if sys.platform != 'darwin' else peak / 1024 / 1024
+    queue.put((elapsed, peak))
+
+
+def benchmark (workdir, fleet, phases, workers, verbose):
+    base = {
+        'cfg_root_dir': fleet['cfg_root_dir'],
+        'xls_ip_devices': os.path.join(workdir, 'IpDevices_list.xlsx'),
+        'inventory_cache': '',
+        'xls_cfg_miss': os.path.join(workdir, 'Cfg_Check.xlsx'),
+        'cfg_check_cmd': os.path.join(workdir, 'cfg_cmd_check.xlsx'),
+        'cfg_check_cache': '',
+        'check_snapshot': os.path.join(workdir, 'Cfg_Check.snapshot'),
+        'csv_cfg_miss_dir': '',
+        'fix_plan_file': os.path.join(workdir, 'Cfg_Fix.jsonl'),
+        'cfg_template': fleet['cfg_template'],
+        'check_workers': workers,
+        'template_workers': workers,
+        'profiles_filter': '.*',
+        'dev_filter': '.*',
+        'gen_template': False,
+        'gen_excel': False,
+        'fix_cfg': False,
+    }
+    results = {}
+    for phase in phases:
+        settings = dict(base)
+        settings[phase] = True
+        if phase == 'gen_template':
+            # the proposed templates go to another file, the benchmark templates are needed by gen_excel
+            settings['cfg_check_cmd'] = os.path.join(workdir, 'cfg_cmd_template.xlsx')
+            if os.path.exists(settings['cfg_check_cmd']):
+                os.remove(settings['cfg_check_cmd'])
+        if phase == 'gen_excel' and os.path.exists(settings['xls_cfg_miss']):
+            os.remove(settings['xls_cfg_miss'])
+        if phase == 'fix_cfg' and not os.path.exists(settings['xls_cfg_miss']):
+            print('Skipping fix_cfg, it needs the output of gen_excel')
+            continue
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_phase, args=(settings, phase, verbose, queue))
+        process.start()
+        elapsed, peak = queue.get()
+        process.join()
+        lines = fleet['lines']
+        if phase == 'gen_template':
+            # the template file of every profile is read once more
+            lines += len(fleet['cfg_template']) * fleet['lines'] // max(1, fleet['devices'])
+        results[phase] = {
+            'seconds': round(elapsed, 3),
+            'devices_per_s': round(fleet['devices'] / elapsed, 1),
+            'lines_per_s': round(lines / elapsed) if phase != 'fix_cfg' else None,
+            'cells_per_s': round(fleet['devices'] * fleet['commands'] / len(fleet['cfg_template']) / elapsed)
+                           if phase == 'fix_cfg' else None,
+            'peak_mb': round(peak, 1) if peak != None else None,
+        }
+    return results
+
+
+def main ():
+    parser = argparse.ArgumentParser(description='Synthetic fleet benchmark of template_create_check.py')
+    parser.add_argument('--devices', type=int, default=100, help='number of devices (default 100)')
+    parser.add_argument('--lines', type=int, default=2000, help='lines of every config (default 2000)')
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of the sections (default 3)')
+    parser.add_argument('--commands', type=int, default=300, help='template commands per profile (default 300)')
+    parser.add_argument('--regex', type=float, default=0.2, help='fraction of commands written as regexp (default 0.2)')
+    parser.add_argument('--profiles', type=int, default=2, help='number of profiles (default 2)')
+    parser.add_argument('--missing', type=float, default=0.02, help='probability of a line missing on a device')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help='check_workers and template_workers (default 1)')
+    parser.add_argument('--phases', default='gen_template,gen_excel,fix_cfg', help='comma separated phases to time')
+    parser.add_argument('--workdir', help='where the fleet is generated and kept, a temporary directory if not given')
+    parser.add_argument('--json', help='file where the results are written')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the phases')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_fleet_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        fleet = generate_fleet(workdir, args.devices, args.lines, args.depth, args.commands, args.regex, args.profiles,
+                               args.missing, args.seed)
+        print('Generated '+str(args.devices)+' devices, '+str(fleet['lines'])+' config lines, '+str(fleet['commands'])+
+              ' template commands in '+str(round(time.perf_counter() - start, 1))+'s ('+workdir+')')
+        results = benchmark(workdir, fleet, args.phases.split(','), args.workers, args.verbose)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print('%-14s %10s %12s %12s %12s %10s' % ('phase', 'seconds', 'devices/s', 'lines/s', 'cells/s', 'peak MB'))
+    for phase in results:
+        r = results[phase]
+        print('%-14s %10s %12s %12s %12s %10s' % (phase, r['seconds'], r['devices_per_s'], r['lines_per_s'] or '-',
+                                                r['cells_per_s'] or '-', r['peak_mb'] if r['peak_mb'] != None else 'n/a'))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'parameters': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
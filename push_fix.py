@@ -0,0 +1,460 @@
+"""
+Pushes the commands found by fix_cfg to the devices, many devices at a time. The commands are taken from the fix
+plan written by template_create_check.py (fix_plan_file or fix_plan_dir), or from running fix_cfg when no plan is
+given, and the result of every device is written as json lines:
+
+    python push_fix.py --plan Cfg_Fix.jsonl --transport my_transport:SshTransport --concurrency 100
+    python push_fix.py --plan Cfg_Fix.jsonl --simulate --concurrency 500 --sim-latency 0.05
+
+How to reach the devices is up to a Transport class (see below), to be written for the proxies, jump hosts and
+libraries of every network: this script only takes care of doing it concurrently, with a timeout on every attempt,
+retries and a pool of open connections. With --simulate the devices are emulated by a local server, so the
+concurrency and the throughput can be tried without any real device.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import importlib
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class CommandError(Exception):
+    """ A command refused by the device. The device is not tried again, its configuration would be the same """
+    pass
+
+
+class Transport:
+    """
+    How the commands reach a device. endpoint() tells where the connection of a device goes (the device itself, or a
+    proxy where the device is then chosen), connect() opens a connection to an endpoint, send() configures a device
+    through an open connection and returns its output, raising CommandError when a command is refused, and close()
+    closes a connection. The connections of an endpoint are reused for the next devices of the same endpoint.
+    The methods are coroutines: a blocking library can be used through asyncio.to_thread.
+    """
+    def endpoint (self, device):
+        return device
+
+    async def connect (self, endpoint):
+        raise NotImplementedError
+
+    async def send (self, connection, device, commands):
+        raise NotImplementedError
+
+    async def close (self, connection):
+        pass
+
+
+class ConnectionPool:
+    """
+    Open connections of the transport, by endpoint. At most 'size' connections of an endpoint are used at the same
+    time (None for no limit), and at most 'max_idle' unused connections are kept open, the ones unused for the
+    longest time being closed first.
+    """
+    def __init__ (self, transport, size=None, max_idle=100):
+        self.transport = transport
+        self.size = size
+        self.max_idle = max_idle
+        # endpoint -> unused connections, the endpoint used the longest time ago first
+        self.idle = collections.OrderedDict()
+        self.idle_count = 0
+        self.slots = {}
+        self.closing = set()
+        self.opened = 0
+        self.reused = 0
+
+    async def acquire (self, endpoint):
+        slot = None
+        if self.size != None:
+            if not endpoint in self.slots:
+                self.slots[endpoint] = asyncio.Semaphore(self.size)
+            slot = self.slots[endpoint]
+            await slot.acquire()
+        try:
+            connections = self.idle.get(endpoint)
+            if connections:
+                connection = connections.pop()
+                if not connections:
+                    del self.idle[endpoint]
+                self.idle_count -= 1
+                self.reused += 1
+                return connection
+            connection = await self.transport.connect(endpoint)
+            self.opened += 1
+            return connection
+        except BaseException:
+            if slot != None:
+                slot.release()
+            raise
+
+    def release (self, endpoint, connection, broken=False):
+        """ Gives the connection back, a broken one (error, timeout ...) is closed instead of being reused """
+        if self.size != None:
+            self.slots[endpoint].release()
+        if broken:
+            self.close_later(connection)
+            return
+        if not endpoint in self.idle:
+            self.idle[endpoint] = []
+        self.idle[endpoint].append(connection)
+        self.idle.move_to_end(endpoint)
+        self.idle_count += 1
+        while self.idle_count > self.max_idle:
+            old_endpoint, connections = next(iter(self.idle.items()))
+            self.close_later(connections.pop(0))
+            if not connections:
+                del self.idle[old_endpoint]
+            self.idle_count -= 1
+
+    def close_later (self, connection):
+        task = asyncio.ensure_future(self.close_quietly(connection))
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def close_quietly (self, connection):
+        try:
+            await self.transport.close(connection)
+        except Exception:
+            pass
+
+    async def close (self):
+        for connections in self.idle.values():
+            for connection in connections:
+                self.close_later(connection)
+        self.idle.clear()
+        self.idle_count = 0
+        if self.closing:
+            await asyncio.wait(list(self.closing))
+
+
+async def push_once (device, commands, transport, pool):
+    endpoint = transport.endpoint(device)
+    connection = await pool.acquire(endpoint)
+    try:
+        output = await transport.send(connection, device, commands)
+    except CommandError:
+        # the device refused a command but the connection is still good
+        pool.release(endpoint, connection)
+        raise
+    except BaseException:
+        # an error or the timeout in the middle of the commands, nobody knows what is left on the connection
+        pool.release(endpoint, connection, broken=True)
+        raise
+    pool.release(endpoint, connection)
+    return output
+
+
+async def push_device (device, commands, transport, pool, timeout=60, retries=2, retry_delay=1):
+    """
+    Sends the commands to the device, with 'timeout' seconds for every attempt (waiting for a connection, connecting
+    and sending), and up to 'retries' more attempts after an error or a timeout, waiting retry_delay, then twice as
+    much and so on. A refused command is not tried again. Returns the result of the device as a dictionary.
+    """
+    result = {'device': device, 'commands': len(commands), 'status': None, 'attempts': 0, 'seconds': 0,
+              'error': None, 'output': None}
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        result['attempts'] += 1
+        try:
+            result['output'] = await asyncio.wait_for(push_once(device, commands, transport, pool), timeout)
+            result['status'] = 'ok'
+            result['error'] = None
+            break
+        except CommandError as err:
+            result['status'] = 'rejected'
+            result['error'] = str(err)
+            break
+        except asyncio.TimeoutError:
+            result['status'] = 'timeout'
+            result['error'] = 'no answer in '+str(timeout)+'s'
+        except Exception as err:
+            result['status'] = 'failed'
+            result['error'] = type(err).__name__+': '+str(err)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+async def push_commands (devices_commands, transport, concurrency=50, pool_size=None, timeout=60, retries=2,
+                         retry_delay=1, on_result=None):
+    """
+    Pushes the commands of every device, 'concurrency' devices at a time. devices_commands is the dictionary
+    returned by run_fix_cfg, or any iterable of (device, commands), read only as the devices are started. on_result
+    is called with the result of every device as soon as it's done. Returns the results, in the order they ended.
+    """
+    pool = ConnectionPool(transport, pool_size, max_idle=concurrency)
+    if isinstance(devices_commands, dict):
+        devices_commands = devices_commands.items()
+    devices = iter(devices_commands)
+    results = []
+
+    async def worker ():
+        for device, commands in devices:
+            if not len(commands):
+                continue
+            result = await push_device(device, commands, transport, pool, timeout, retries, retry_delay)
+            results.append(result)
+            if on_result != None:
+                on_result(result)
+
+    try:
+        await asyncio.gather(*[worker() for k in range(max(1, concurrency))])
+    finally:
+        await pool.close()
+    print('Connections opened: '+str(pool.opened)+', reused: '+str(pool.reused))
+    return results
+
+
+def read_plan (plan):
+    """
+    Reads the fix plan written by template_create_check.py: the json lines of fix_plan_file, or the device.txt files
+    of fix_plan_dir. Returns the commands of every device, in the order of the plan.
+    """
+    devices_commands = {}
+    if os.path.isdir(plan):
+        for name in sorted(os.listdir(plan)):
+            if name.endswith('.txt'):
+                with open(os.path.join(plan, name)) as file:
+                    devices_commands[name[:-4]] = file.read().splitlines()
+        return devices_commands
+    with open(plan) as file:
+        for line in file:
+            if line.strip():
+                row = json.loads(line)
+                if not row['device'] in devices_commands:
+                    devices_commands[row['device']] = []
+                devices_commands[row['device']] += row['commands']
+    return devices_commands
+
+
+class SimulatedDevices:
+    """
+    A local server answering like many devices behind a proxy. A session starts with 'READY' after connect_latency
+    seconds; the client names a device with 'device NAME' and gets 'OK NAME', then sends the commands one per line,
+    each answered with 'OK' after 'latency' seconds, or refused with '% Invalid input' with probability 'reject',
+    and ends the device with 'end', answered with 'DONE'. Then another device can be configured on the same session.
+    With probability 'hang' a device never answers, and with probability 'drop' the session is closed in the middle
+    of its commands. The commands configured on every device are kept in 'configured'.
+    """
+    def __init__ (self, latency=0.01, connect_latency=0.05, reject=0.0, hang=0.0, drop=0.0, seed=1):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.reject = reject
+        self.hang = hang
+        self.drop = drop
+        self.random = random.Random(seed)
+        self.configured = {}
+        self.sessions = 0
+        self.max_sessions = 0
+        self.connections = 0
+        self.server = None
+
+    async def start (self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.session, host, port, backlog=4096)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop (self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def session (self, reader, writer):
+        self.connections += 1
+        self.sessions += 1
+        self.max_sessions = max(self.max_sessions, self.sessions)
+        try:
+            await asyncio.sleep(self.connect_latency)
+            writer.write(b'READY\n')
+            await writer.drain()
+            device = None
+            fault = None
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip('\n')
+                if device == None:
+                    if not line.startswith('device '):
+                        writer.write(b'% No device selected\n')
+                        await writer.drain()
+                        continue
+                    device = line[7:]
+                    draw = self.random.random()
+                    fault = 'hang' if draw < self.hang else 'drop' if draw < self.hang + self.drop else None
+                    writer.write(('OK '+device+'\n').encode())
+                elif line == 'end':
+                    writer.write(b'DONE\n')
+                    device = None
+                else:
+                    if fault == 'hang':
+                        # nothing is answered anymore, until the client gives up
+                        while await reader.readline():
+                            pass
+                        break
+                    if fault == 'drop':
+                        break
+                    await asyncio.sleep(self.latency)
+                    if self.random.random() < self.reject:
+                        writer.write(('% Invalid input: '+line+'\n').encode())
+                    else:
+                        if not device in self.configured:
+                            self.configured[device] = []
+                        self.configured[device].append(line)
+                        writer.write(b'OK\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+
+class SimulatedTransport(Transport):
+    """ Transport of SimulatedDevices: every device is reached through the same server, as through a proxy """
+    def __init__ (self, host, port):
+        self.host = host
+        self.port = port
+
+    def endpoint (self, device):
+        return (self.host, self.port)
+
+    async def connect (self, endpoint):
+        reader, writer = await asyncio.open_connection(*endpoint)
+        answer = await reader.readline()
+        if answer != b'READY\n':
+            writer.close()
+            raise ConnectionError('unexpected greeting '+repr(answer))
+        return reader, writer
+
+    async def command (self, connection, line):
+        reader, writer = connection
+        writer.write((line+'\n').encode())
+        await writer.drain()
+        answer = await reader.readline()
+        if not answer:
+            raise ConnectionError('connection closed')
+        return answer.decode().rstrip('\n')
+
+    async def send (self, connection, device, commands):
+        await self.command(connection, 'device '+device)
+        for cmd in commands:
+            answer = await self.command(connection, cmd)
+            if answer.startswith('%'):
+                # the device is left out of configuration mode before giving the error
+                await self.command(connection, 'end')
+                raise CommandError(device+': '+answer)
+        return await self.command(connection, 'end')
+
+    async def close (self, connection):
+        connection[1].close()
+        await connection[1].wait_closed()
+
+
+def simulator_process (settings, queue, stop):
+    """ Runs SimulatedDevices in a process of its own, so that it doesn't take the cpu of the push """
+    async def serve ():
+        simulator = SimulatedDevices(**settings)
+        queue.put(await simulator.start())
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        await simulator.stop()
+        queue.put({'connections': simulator.connections, 'max_sessions': simulator.max_sessions,
+                   'configured': sum(len(cmds) for cmds in simulator.configured.values())})
+    asyncio.run(serve())
+
+
+def load_transport (spec, options):
+    """ The transport 'module:Class', built with the 'name=value' options as keyword arguments """
+    module_name, class_name = spec.split(':')
+    transport_class = getattr(importlib.import_module(module_name), class_name)
+    return transport_class(**dict(option.split('=', 1) for option in options))
+
+
+async def run (args, devices_commands):
+    if args.simulate:
+        settings = {'latency': args.sim_latency, 'connect_latency': args.sim_connect_latency, 'reject': args.sim_reject,
+                    'hang': args.sim_hang, 'drop': args.sim_drop, 'seed': args.seed}
+        queue = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        simulator = multiprocessing.Process(target=simulator_process, args=(settings, queue, stop))
+        simulator.start()
+        host, port = queue.get()
+        transport = SimulatedTransport(host, port)
+    else:
+        simulator = None
+        transport = load_transport(args.transport, args.option)
+
+    results_file = open(args.results, 'w') if args.results else None
+    counts = collections.Counter()
+
+    def on_result (result):
+        counts[result['status']] += 1
+        if results_file != None:
+            results_file.write(json.dumps(result) + '\n')
+
+    start = time.perf_counter()
+    try:
+        results = await push_commands(devices_commands, transport, args.concurrency, args.per_endpoint, args.timeout,
+                                      args.retries, args.retry_delay, on_result)
+    finally:
+        if results_file != None:
+            results_file.close()
+        if simulator != None:
+            stop.set()
+            sim_stats = queue.get()
+            simulator.join()
+    elapsed = time.perf_counter() - start
+
+    commands = sum(result['commands'] for result in results if result['status'] == 'ok')
+    print('Pushed '+str(len(results))+' devices in '+str(round(elapsed, 2))+'s: '+
+          ', '.join(status+' '+str(counts[status]) for status in ('ok', 'rejected', 'timeout', 'failed')))
+    print(str(round(len(results) / elapsed, 1))+' devices/s, '+str(round(commands / elapsed))+' commands/s')
+    if simulator != None:
+        print('Simulated devices: '+str(sim_stats['connections'])+' sessions, at most '+str(sim_stats['max_sessions'])+
+              ' at the same time, '+str(sim_stats['configured'])+' commands configured')
+    for result in results:
+        if result['status'] != 'ok':
+            print(result['device']+' '+result['status']+' after '+str(result['attempts'])+' attempts: '+
+                  str(result['error']))
+    return results
+
+
+def main ():
+    parser = argparse.ArgumentParser(description='Concurrent push of the fix_cfg commands to the devices')
+    parser.add_argument('--plan', help='fix_plan_file or fix_plan_dir of template_create_check.py, '
+                                       'fix_cfg is run when not given')
+    parser.add_argument('--transport', help="transport class, as 'module:Class'")
+    parser.add_argument('--option', action='append', default=[], help="'name=value' argument of the transport class")
+    parser.add_argument('--concurrency', type=int, default=50, help='devices configured at the same time (default 50)')
+    parser.add_argument('--per-endpoint', type=int, help='connections used at the same time on an endpoint '
+                                                         '(e.g. a proxy), no limit by default')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds of every attempt on a device (default 60)')
+    parser.add_argument('--retries', type=int, default=2, help='attempts after a failure or a timeout (default 2)')
+    parser.add_argument('--retry-delay', type=float, default=1, help='seconds before the first retry (default 1)')
+    parser.add_argument('--results', default='./Cfg_Push.jsonl', help='json lines with the result of every device')
+    parser.add_argument('--simulate', action='store_true', help='push to local simulated devices')
+    parser.add_argument('--sim-latency', type=float, default=0.01, help='seconds of every simulated command')
+    parser.add_argument('--sim-connect-latency', type=float, default=0.05, help='seconds of a simulated login')
+    parser.add_argument('--sim-reject', type=float, default=0.0, help='probability of a refused command')
+    parser.add_argument('--sim-hang', type=float, default=0.0, help='probability of a device never answering')
+    parser.add_argument('--sim-drop', type=float, default=0.0, help='probability of a dropped session')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if not args.simulate and not args.transport:
+        parser.error('a --transport is needed, or --simulate')
+
+    if args.plan:
+        devices_commands = read_plan(args.plan)
+    else:
+        import template_create_check
+        devices_commands = template_create_check.run_fix_cfg()
+    asyncio.run(run(args, devices_commands))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,71 @@
+import io
 import re
+import csv
+import json
+import base64
+import sys
+import gzip
+import mmap
+import zlib
+import pickle
+import tarfile
+import zipfile
+import tempfile
+import hashlib
+import functools
+import heapq
 import time
 import datetime
+import math
+import threading
+import urllib.parse
 import os.path
+import multiprocessing
 from ipaddress import IPv4Address
-import openpyxl
-from openpyxl.utils.cell import get_column_letter
-from openpyxl.styles import PatternFill
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 # Where the output of the configurations check is written, here for every profile
 # you can find the list of devices, for each of them you can find which config commands
 # are present or not
 xls_cfg_miss = './Cfg_Check.xlsx'
+# Optional directory where the same check results are also written as one CSV file per profile, for tools that
+# don't need to go through excel, created if needed. Leave it empty to write only the excel file.
+csv_cfg_miss_dir = ''
 xls_ip_devices = './IpDevices_list.xlsx'
+# The 'Devices' sheet of xls_ip_devices, as read by the last run. It's read again only when the excel file changes,
+# set it to '' to always read the excel file.
+inventory_cache = './IpDevices_list.cache'
 cfg_root_dir = 'root_path_to_config_files'
+# Archive (.zip, .tar, .tar.gz, .tgz ...) with the configuration files. The files are looked for in the archive as
+# cfg_root_dir + directory + '/' + device + '.txt', so here cfg_root_dir is the folder of the configs inside the
+# archive ('' when they are at its top). Leave it empty to read the files from disk, where a 'device.txt.gz' file is
+# read as well when there is no 'device.txt'. A zip or an uncompressed tar is read in place, without extracting
+# anything. A compressed tar (.tar.gz, .tgz ...) can't be read in any order: every time it changes (so every run, with
+# nightly archives) it's decompressed in full in the temporary directory, and it saves no disk space or disk I/O
+# compared to extracting it. Prefer zip or uncompressed tar archives.
+cfg_archive = ''
+# read the configuration files on disk through mmap, so that unchanged files are hashed without being copied
+cfg_mmap = False
 # File that contains the configurations to be checked for every profile, and what to do in case
 # of mismatches (add a command in case something is missing, or remove/change a command)
 cfg_check_cmd = './cfg_cmd_check.xlsx'
+# Results of the last check of every device, reused when neither the config file nor the profile commands
+# have changed. Set it to '' to check everything again on every run.
+cfg_check_cache = './Cfg_Check.cache'
+# Compact copy of the check results, one bit for every device and command, written together with xls_cfg_miss.
+# fix_cfg reads it instead of the excel file, as long as the excel file is the one written with it.
+# Set it to '' to only write the excel file.
+check_snapshot = './Cfg_Check.snapshot'
 
-# list of the files to be taken as 'template' examples
+# list of the files to be taken as 'template' examples. The names that are not absolute and don't start with '.' are
+# in cfg_root_dir, as the devices' configs: they follow cfg_root_dir when it's changed (e.g. from the command line).
 cfg_template = {    
-    "PROFILE_1": cfg_root_dir + "Backbone/pe_1.txt",
-    "PROFILE_2": cfg_root_dir + "Backbone/rr_1.txt",
-    "PROFILE_3": cfg_root_dir + "Backbone/p.txt"
+    "PROFILE_1": "Backbone/pe_1.txt",
+    "PROFILE_2": "Backbone/rr_1.txt",
+    "PROFILE_3": "Backbone/p.txt"
 }
 
 # generate the proposed config template by reading the configs, should be manually revised
@@ -30,137 +74,1782 @@ gen_template = False
 gen_excel = True
 # check what needs to be fixed, using columns 'B' and 'C' in cfg_check_cmd excel file
 fix_cfg = False
+# compare the check_snapshot of this run with an older copy of it (e.g. the one of the previous night), and write
+# in drift_file which device lost or gained which command, one line per change. When it's set, gen_excel (and
+# merge_shards) move the previous check_snapshot to drift_old_snapshot before writing the new one, so that every run
+# is compared with the one before it.
+drift_diff = False
+drift_old_snapshot = './Cfg_Check.snapshot.old'
+drift_file = './Cfg_Drift.csv'
+# keep running after the other phases: the devices whose config file changes are checked again as soon as it's seen
+# (the files are looked at every watch_interval seconds), and everything is loaded again when xls_ip_devices,
+# cfg_check_cmd or cfg_archive change. The check cache is saved after every change, so the next runs don't check
+# again what watch has checked, and so is watch_snapshot: the results of watch are not in xls_cfg_miss, so they are
+# not written in check_snapshot, that is the one of xls_cfg_miss (drift_diff can compare them, e.g. with
+# drift_old_snapshot = check_snapshot and check_snapshot = watch_snapshot). The profiles not watched are taken from
+# check_snapshot. The results can be asked on http://127.0.0.1:watch_port (0 not to answer):
+#   /profiles                          every profile with its devices, commands and average compliance
+#   /device?name=D                     the compliance of device D and the commands it misses
+#   /missing?command=C&profile=P       the devices missing the command C, as written in cfg_check_cmd (profile optional)
+watch = False
+watch_interval = 10
+watch_port = 8765
+watch_snapshot = './Cfg_Watch.snapshot'
+# Split gen_excel over several runs, on several machines or as separate batch jobs: with shard_count > 1, gen_excel
+# checks only the devices of shard shard_index (0 ... shard_count-1), chosen by a hash of the device name, and writes
+# their results in shard_dir instead of xls_cfg_miss. Once the results of all the shards are in the same shard_dir,
+# merge_shards writes xls_cfg_miss (and its csv files and snapshot) as a single run would have done, and removes
+# the shards results. Every shard writes the id of its run, from shard_run_id (e.g. the date of the nightly run) and
+# from the devices and commands of every profile: the shards of different runs are not merged.
+shard_count = 1
+shard_index = 0
+shard_dir = './Cfg_Check.shards'
+shard_run_id = ''
+merge_shards = False
+# Optional directory where fix_cfg writes the commands to be executed on every device, one 'device.txt' file each,
+# and optional file where it writes them as json lines, {"device": ..., "profile": ..., "commands": [...]}. They are
+# written while the devices are read; when one of them is set the commands are not printed. fix_plan_dir is created
+# when missing, and the '.txt' files of the previous run are deleted first: only the devices of this run are there.
+fix_plan_dir = ''
+fix_plan_file = ''
 
 
 profiles_filter = '.*'
 dev_filter = '.*'
+# number of processes checking the devices' configs in gen_excel, 1 to do everything in this process, 0 to use
+# one process per cpu. The output is the same in any case.
+check_workers = 1
+# the same for the processes reading the devices' configs in gen_template
+template_workers = 1
+# Minimum support of the commands written by gen_template, as the fraction of the profile's devices where they must be
+# found (0.05 for 5%). The commands found on less devices are not written, except the ones of the cfg_template file,
+# and the memory used doesn't grow with the lines found on a few devices only (descriptions, addresses ...), at the
+# cost of reading the configs twice. 0 writes every command found.
+template_min_support = 0
+# Measure where the time goes: every phase and its steps (excel loading and saving ...), every profile, every device
+# (file reading, parsing, get_line, matching) and the template commands with the highest cumulative match time. The
+# result is written as json next to xls_cfg_miss (e.g. ./Cfg_Check.report.json). It slows the run down a bit.
+run_report = False
+# how many of the slowest template commands are listed in the report for every profile
+run_report_top = 20
+# validate_templates (the 'validate' subcommand) times the template commands on a sample config of their profile,
+# the cfg_template file or else the first config of the profile: the ones that the checker runs as regexp, taking
+# more than this many microseconds per line of the sample, are reported as slow
+slow_command_us = 20
+# tab separated file where validate_templates writes, for every command, how the checker finds it, its timing on the
+# sample config and its problems. Leave it empty to only print the problems.
+validate_report = ''
 # command lines that are 'sons' of other lines, are separated in this way
 line_break = '@@@'
 
-commands = {}
+# Rules used by get_line on every config line during the template generation, in this order: the first rule whose
+# regexp is found in the line decides. 'skip' drops the line, 'change' replaces it with the output, a group of the
+# match like '\1' or '\g<0>' or a fixed string.
+line_rules = [
+    ('skip', '^\s+!', ''),
+    ('skip', '^(vrf definition|mpls ldp neighbor.*password|hostname)', ''),
+    ('skip', '^!', ''),
+    ('skip', '^(show run|Building config|Current config|version|boot)', ''),
+    ('skip', 'set uuid', ''),
+    ('change', 'enable secret \d+', '\\g<0>'),
+    ('change', '^(?=.*server-private.*key 7 )(.*key 7)', '\\1'),
+    ('change', '^(.*password 7)', '\\1'),
+    ('change', '^(.*key-string \d+)', '\\1'),
+    ('change', 'license udi pid.*sn', 'license udi pid.*sn'),
+    ('change', '^(username.*secret \d+)', '\\1'),
+    ('change', '^ntp authentication-key 10 md5', 'ntp authentication-key 10 md5'),
+    ('change', 'crypto pki trustpoint TP-self-signed-', 'crypto pki trustpoint TP-self-signed-'),
+    ('change', '^(.*Self-Signed-Certificate-)', '\\1'),
+    ('change', '^(.*TP-self-signed-)', '\\1'),
+]
+# File with the rules to be used instead of the ones above: a text file with action, regexp and output separated by
+# tabs, or an excel file with the same columns in a 'LINE_RULES' sheet. Leave it empty to use the rules above.
+line_rules_file = ''
+# Corpus of config lines with their expected get_line result (json lines, see get_line_corpus.jsonl): when set, the
+# rules are checked against it before generating the templates, and nothing is done in case of errors.
+line_rules_corpus = ''
+
+class LineRules:
+    """
+    The get_line rules compiled once. Every rule is a regexp with an action: 'skip' drops the line, 'change' replaces
+    it with the output, that can be a group of the match (like '\\1' or '\\g<0>', expanded as re.sub does) or a fixed
+    string. The first rule whose regexp is found in the line decides, lines with no matching rule are kept as they are.
+    To avoid running all the regexps on every line:
+    - rules anchored with '^' are only tried on lines starting with one of the characters they can start with, the
+      rules to be tried are remembered for every first character
+    - before running a regexp, we check that the line contains the longest string the regexp needs to find
+    """
+    def __init__ (self, rules):
+        self.rules = []
+        for action, pattern, output in rules:
+            try:
+                regex = re.compile(pattern)
+            except re.error as err:
+                print('ERROR in line rule "'+pattern+'": '+str(err)+', rule skipped')
+                continue
+            if not action in ('skip', 'change'):
+                print('ERROR in line rule "'+pattern+'": unknown action '+str(action)+', rule skipped')
+                continue
+            output = '' if output == None else output
+            group = None
+            if re.search(r'^\\(\d+)$', output):
+                group = int(output[1:])
+            elif re.search(r'^\\g<(\d+)>$', output):
+                group = int(output[3:-1])
+            first_chars = None
+            literal = None
+            if not regex.flags & re.IGNORECASE:
+                parsed = list(sre_parse.parse(pattern))
+                if len(parsed) and parsed[0] == (sre_parse.AT, sre_parse.AT_BEGINNING):
+                    first_chars = self.first_chars(parsed[1:])
+                literal = self.required_literal(parsed)
+            self.rules.append((regex, action, group, '\\' in output, output, first_chars, literal))
+        self.dispatch = {}
+
+    def first_chars (self, items):
+        # the characters a match can start with: a set of characters, plus 'SPACE' for \s. None when it can be anything.
+        if not len(items):
+            return None
+        op, av = items[0]
+        if op is sre_parse.LITERAL:
+            return frozenset([chr(av)])
+        if op is sre_parse.SUBPATTERN:
+            # a group like (?i:...) has its own flags, its characters can be in any case
+            if av[1] & re.IGNORECASE:
+                return None
+            return self.first_chars(list(av[-1]))
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            return self.first_chars(list(av[2]))
+        if op is sre_parse.BRANCH:
+            chars = set()
+            for branch in av[1]:
+                branch_chars = self.first_chars(list(branch))
+                if branch_chars == None:
+                    return None
+                chars.update(branch_chars)
+            return frozenset(chars)
+        if op is sre_parse.IN:
+            chars = set()
+            for in_op, in_av in av:
+                if in_op is sre_parse.LITERAL:
+                    chars.add(chr(in_av))
+                elif in_op is sre_parse.CATEGORY and in_av is sre_parse.CATEGORY_SPACE:
+                    chars.add('SPACE')
+                else:
+                    return None
+            return frozenset(chars)
+        return None
+
+    def required_literal (self, items):
+        # the longest string that must be in any line matching the items: runs of literals found in the sequence,
+        # in groups, in lookaheads and in what is repeated at least once
+        best = ''
+        run = ''
+        for op, av in list(items) + [(None, None)]:
+            if op is sre_parse.LITERAL:
+                run += chr(av)
+                continue
+            if len(run) > len(best):
+                best = run
+            run = ''
+            inner = None
+            if op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                inner = av[-1]
+            elif op is sre_parse.ASSERT and av[0] == 1:
+                inner = av[1]
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                inner = av[2]
+            if inner != None:
+                inner_best = self.required_literal(inner)
+                if inner_best != None and len(inner_best) > len(best):
+                    best = inner_best
+        return best if len(best) else None
+
+    def rules_for (self, first):
+        # the rules that can match a line starting with 'first', computed once for every character
+        if not first in self.dispatch:
+            self.dispatch[first] = [rule for rule in self.rules if rule[5] == None or first in rule[5] or
+                                    (first.isspace() and 'SPACE' in rule[5])]
+        return self.dispatch[first]
+
+    def apply (self, line):
+        for regex, action, group, template, output, first_chars, literal in self.rules_for(line[:1]):
+            if literal != None and not literal in line:
+                continue
+            match = regex.search(line)
+            if match == None:
+                continue
+            if action == 'skip':
+                return None
+            if group != None:
+                return match.group(group)
+            if template:
+                return match.expand(output)
+            return output
+        return line
+
+def load_line_rules (filename):
+    """
+    Reads the get_line rules from a file: an excel file with action, regexp and output in the columns A, B and C of
+    the 'LINE_RULES' sheet (the first row is the header), or a text file with the same three fields separated by tabs
+    (lines starting with '#' are comments).
+    """
+    rules = []
+    if filename.endswith('.xlsx'):
+        rules_targ = load_openpyxl().load_workbook(filename, read_only=True)
+        for row in rules_targ['LINE_RULES'].iter_rows(min_row=2, values_only=True):
+            if row_value(row, 'A') == None or row_value(row, 'B') == None:
+                continue
+            rules.append((str(row_value(row, 'A')).strip(), str(row_value(row, 'B')), row_value(row, 'C')))
+        rules_targ.close()
+    else:
+        with open(filename, 'r') as file:
+            for line in file:
+                line = line.rstrip('\r\n')
+                if not len(line.strip()) or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                rules.append((fields[0].strip(), fields[1], fields[2] if len(fields) > 2 else ''))
+    return rules
+
+# the rules in use, compiled the first time get_line is called
+compiled_line_rules = None
 
 def get_line (line):
     # This function returns the config line, changing it if necessary to reflect the specific requirements.
-    # In case the line needs to be skipped, 'None' is returned.
-    if re.search("^\s+!", line):
-        return None
-    elif re.search("^(vrf definition|mpls ldp neighbor.*password|hostname)", line):
-        return None
-    elif re.search("^!", line):
-        return None
-    elif re.search("^(show run|Building config|Current config|version|boot)", line):
-        return None
-    elif re.search("set uuid", line):
-        return None
+    # In case the line needs to be skipped, 'None' is returned. The rules are in 'line_rules' or 'line_rules_file'.
+    global compiled_line_rules
+    if compiled_line_rules == None:
+        compiled_line_rules = LineRules(load_line_rules(line_rules_file) if line_rules_file else line_rules)
+    return compiled_line_rules.apply(line)
 
-    # Lines that need to be changed to be properly matched ...
-    if re.search("enable secret \d+", line):
-        line = re.search("(enable secret \d+)", line).group(1)
-    elif re.search("server-private.*key 7 ", line):
-        line = re.search('(.*key 7)', line).group(1)
-    elif re.search("password 7", line):
-        line = re.search('(.*password 7)', line).group(1)
-    elif re.search("key-string \d+", line):
-        line = re.search('(.*key-string \d+)', line).group(1)
-    elif re.search("license udi pid.*sn", line):
-        line = "license udi pid.*sn"
-    elif re.search("^username.*secret \d+", line):
-        line = re.search("(username.*secret \d+)", line).group(1)
-    elif re.search("^ntp authentication-key 10 md5", line):
-        line = "ntp authentication-key 10 md5"
-    elif re.search("crypto pki trustpoint TP-self-signed-", line):
-        line = "crypto pki trustpoint TP-self-signed-"
-    elif re.search("Self-Signed-Certificate-", line):
-        line = re.search("(.*Self-Signed-Certificate-)", line).group(1)
-    elif re.search("TP-self-signed-", line):
-        line = re.search("(.*TP-self-signed-)", line).group(1)
-    return line
-
-def update_template_cmd (filename, target = False):
+def check_line_rules (corpus_file):
     """
-    We now need to parse all the files belonging to the profile to insert all the commands to be checked. In this phase,
-    we filter global commands and other commands that we know are mandatory. We also have other filters to skip lines or 
-    whole SECTIONS (everything indented below something). This should provide a good list with no missing commands, we
-    should also update the counters matching each command as we proceed parsing all the files. This should provide a
-    confidence level of how much a certain command should be present or not. We store everything in an excel file for
-    further manuale processing. As a last step, we parse the 'target' example file for the given profile, and print all
-    the missing commands (for example, interfaces configurations, router bgp configurations and so on). These commands
-    could be manually changed to be checked on ALL node's configuration (for example 'router bgp\|timers 10 30'), or they
-    could be simply removed (like for example all interface specific configs, unless they are used for the same purpose so 
-    that the same interfaces is configured in the same way on every node ... ip address config could be removed).
+    Checks get_line against a corpus of config lines with their expected result, one json object per line with the
+    'line' and 'expected' keys (null when the line must be skipped). Returns the number of mismatches.
+    """
+    errors = 0
+    with open(corpus_file, 'r') as file:
+        for corpus_line in file:
+            if not len(corpus_line.strip()):
+                continue
+            entry = json.loads(corpus_line)
+            result = get_line(entry['line'])
+            if result != entry['expected']:
+                print('ERROR in line rules, '+repr(entry['line'])+' gives '+repr(result)+' instead of '+repr(entry['expected']))
+                errors += 1
+    print('Line rules checked on '+corpus_file+', '+str(errors)+' errors')
+    return errors
+
+class RunReport:
+    """
+    The timings collected when run_report is set. For every phase we keep its total time, the time of its steps (like
+    loading or saving an excel file) and, for every profile, its time and the times of every device:
+    - 'read': reading the config file
+    - 'parse': building its CfgTree
+    - 'lines': get_line and the commands counting (gen_template)
+    - 'match': matching the template commands (gen_excel)
+    plus the cumulative time and number of tests of every template command, of which only the run_report_top slowest
+    are written in the report.
     """
-    global commands
+    def __init__ (self):
+        self.start = datetime.datetime.now()
+        self.phases = {}
+
+    def phase (self, phase):
+        if not phase in self.phases:
+            self.phases[phase] = {'seconds': 0.0, 'steps': {}, 'profiles': {}}
+        return self.phases[phase]
+
+    def profile (self, phase, profile):
+        profiles = self.phase(phase)['profiles']
+        if not profile in profiles:
+            profiles[profile] = {'seconds': 0.0, 'devices': {}, 'commands': {}}
+        return profiles[profile]
+
+    def add_step (self, phase, step, seconds):
+        steps = self.phase(phase)['steps']
+        steps[step] = steps.get(step, 0.0) + seconds
+
+    def add_device (self, phase, profile, filename, timings):
+        """ 'timings' is the dictionary filled while reading and checking the device, with 'commands' as returned by
+        CmdMatcher.take_costs() when the commands have been matched """
+        entry = self.profile(phase, profile)
+        device = entry['devices'].setdefault(filename, {})
+        for step in timings:
+            if step != 'commands':
+                device[step] = device.get(step, 0.0) + timings[step]
+        for cmd_index, seconds, tests in timings.get('commands', ()):
+            cost = entry['commands'].get(cmd_index, (0.0, 0))
+            entry['commands'][cmd_index] = (cost[0] + seconds, cost[1] + tests)
+
+    def as_dict (self, commands = {}):
+        """ The report as written in the json file, 'commands' gives the commands of every profile by index """
+        phases = {}
+        for phase in self.phases:
+            profiles = {}
+            for profile, entry in self.phase(phase)['profiles'].items():
+                totals = {}
+                devices = {}
+                for filename, device in entry['devices'].items():
+                    devices[filename] = dict((step, round(seconds, 6)) for step, seconds in device.items())
+                    for step in device:
+                        totals[step] = totals.get(step, 0.0) + device[step]
+                slowest = heapq.nlargest(run_report_top, entry['commands'].items(), key=lambda item: item[1][0])
+                profile_commands = commands.get(profile, [])
+                profiles[profile] = {
+                    'seconds': round(entry['seconds'], 6),
+                    'devices_count': len(devices),
+                    'totals': dict((step, round(seconds, 6)) for step, seconds in totals.items()),
+                    'slowest_commands': [{'command': profile_commands[i] if i < len(profile_commands) else i,
+                                          'seconds': round(seconds, 6), 'tests': tests}
+                                         for i, (seconds, tests) in slowest],
+                    'devices': devices,
+                }
+            phases[phase] = {
+                'seconds': round(self.phases[phase]['seconds'], 6),
+                'steps': dict((step, round(seconds, 6)) for step, seconds in self.phases[phase]['steps'].items()),
+                'profiles': profiles,
+            }
+        return {'start': self.start.isoformat(), 'phases': phases}
+
+# the report of this run, when run_report is set
+report = None
+# the commands of every profile, to give a name to the slowest commands in the report
+report_commands = {}
+
+def report_file ():
+    return os.path.splitext(xls_cfg_miss)[0] + '.report.json'
+
+def start_phase ():
+    """
+    Returns the start time of a phase, the run report is created by the first phase when run_report is set. Every
+    phase lists the configuration files again, some may have been added since the previous one.
+    """
+    global report, config_source
+    if run_report and report == None:
+        report = RunReport()
+    config_source = None
+    return time.perf_counter()
+
+def end_phase (phase, started):
+    # the report is written again at the end of every phase, with all the phases run so far
+    if report == None:
+        return
+    report.phase(phase)['seconds'] += time.perf_counter() - started
+    with open(report_file(), 'w') as file:
+        json.dump(report.as_dict(report_commands), file, indent=1)
+    print('Run report written in '+report_file())
 
-    with open(filename, 'r') as file:
-        print('Reading file ' + filename + ' ... ')
+def timed_step (phase, step, started):
+    """ Adds to the report the time passed since 'started' for a step of the phase, returns the current time """
+    now = time.perf_counter()
+    if report != None:
+        report.add_step(phase, step, now - started)
+    return now
+
+def phase_settings (phase):
+    """
+    Lets a phase take settings as keyword arguments, for that call only: run_gen_excel(profiles_filter = '^PE') runs
+    the check with that profiles_filter, and the settings are back as they were afterwards. The other keyword
+    arguments are the ones of the phase.
+    """
+    @functools.wraps(phase)
+    def run (*args, **kwargs):
+        settings = dict((name, kwargs.pop(name)) for name in list(kwargs) if name in setting_names)
+        if not len(settings):
+            return phase(*args, **kwargs)
+        old = dict((name, globals()[name]) for name in settings)
+        configure(**settings)
+        try:
+            return phase(*args, **kwargs)
+        finally:
+            configure(**old)
+    return run
+
+class CfgNode:
+    """
+    One line of a configuration file. 'line' is the line as read from the file, 'text' the stripped one, 'parent'
+    the node it is indented below (None for global lines) and 'path' the line_break separated list of all the parents.
+    """
+    __slots__ = ('line', 'text', 'path', 'parent')
+
+    def __init__ (self, line, path, parent):
+        self.line = line
+        self.text = line.strip()
+        self.path = path
+        self.parent = parent
+
+    def search_line (self):
+        # the line with all its parents, this is what the template commands are checked against
+        if self.parent == None:
+            return self.text
+        return self.path + line_break + self.text
+
+class CfgTree:
+    """
+    A configuration file parsed once in a tree, following the indentation of the lines. The 'nodes' list keeps all
+    the lines in the file order, every one with its parent path ('' for global lines), for example
+    'router bgp 65000@@@address-family vpnv4'. The parent path strings are interned, so lines below the same parents
+    (on this device and on all the others) share the same string, and CmdMatcher selects the commands of a path once.
+    """
+    __slots__ = ('filename', 'nodes')
+
+    def __init__ (self, filename, lines):
+        self.filename = filename
+        self.nodes = []
         last_spaces = 0
-        last_line = ""
+        # this is what is found above an indented line at the very beginning of the file
+        last_node = CfgNode('', '', None)
         parents = []
         num_spaces = []
-        spaces = 0
-        # reading file line by line
-        for line in file:
-            if re.search('^\s', line):
-                spaces = len(re.search("^(\s+)", line).group(1))
-                #print('\n\nEntering line with trailing spaces '+str(spaces)+' last spaces '+str(last_spaces))
+        paths = []
+        path = ''
+        for line in lines:
+            stripped = line.lstrip()
+            if len(stripped) != len(line):
+                spaces = len(line) - len(stripped)
                 if (spaces > last_spaces):
-                    parents.append(last_line.strip())
+                    parents.append(last_node)
                     num_spaces.append(spaces)
+                    paths.append(sys.intern(last_node.search_line()))
                     last_spaces = spaces
-                    #print('Inside indentation '+last_line+' spaces '+str(spaces)+' last spaces '+str(last_spaces))
                 elif (spaces < last_spaces):
-                    #print('Exiting indentation with line '+line+' spaces '+str(spaces)+' last spaces '+str(last_spaces)+' num_spaces[-1] '+str(num_spaces[-1]))
-                    #print(parents)
-                    #print(num_spaces)
                     while (len(num_spaces)>0) and num_spaces[-1]>spaces:
-                        #print('Removing from parent stack '+parents[-1])
                         num_spaces.pop()
                         parents.pop()
-                        #print(parents)
+                        paths.pop()
                     if not len(num_spaces):
                         print('WARNING: indentation error at line '+line+' spaces '+str(spaces)+' last spaces '+str(last_spaces))
                     last_spaces = spaces
+                path = paths[-1] if len(paths) else ''
             # in this case there are 0 spaces, this is a global config command. Often on Cisco configuration,
             # this line can be a "!" line. This works anyway.
+            elif len(parents):
+                parents = []
+                num_spaces = []
+                paths = []
+                path = ''
+                last_spaces = 0
+            last_node = CfgNode(line, path, parents[-1] if len(parents) else None)
+            self.nodes.append(last_node)
+
+class DirSource:
+    """
+    The configuration files on disk. The files of a directory are listed only once, to know which devices have a
+    config. A file missing but compressed as file + '.gz' is read as well, under the same name.
+    """
+    def __init__ (self):
+        self.dir_files = {}
+
+    def exists (self, filename):
+        dir, name = os.path.split(filename)
+        if not dir in self.dir_files:
+            try:
+                self.dir_files[dir] = set(os.listdir(dir or '.'))
+            except OSError:
+                self.dir_files[dir] = set()
+        if name in self.dir_files[dir] or name + '.gz' in self.dir_files[dir]:
+            return True
+        # not in the listing, but it could still be found (case insensitive file systems, '..' in the name ...)
+        return os.path.exists(filename) or os.path.exists(filename + '.gz')
+
+    def read (self, filename):
+        """ Returns the content of a file, as bytes or as a read-only mmap with cfg_mmap """
+        if not os.path.exists(filename) and os.path.exists(filename + '.gz'):
+            with gzip.open(filename + '.gz', 'rb') as file:
+                return file.read()
+        with open(filename, 'rb') as file:
+            if cfg_mmap:
+                try:
+                    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty files can't be mapped
+                    pass
+            return file.read()
+
+class ArchiveSource:
+    """
+    The configuration files inside cfg_archive. Zip and uncompressed tar files are read in place, in any order. A
+    compressed tar can only be read from its beginning, so it's decompressed in an uncompressed copy, in the temporary
+    directory, that is read in the same way: it costs as much disk as extracting the files. Every process opens the
+    archive for itself.
+    The files not in the archive (like the cfg_template examples kept aside) are read from disk.
+    """
+    def __init__ (self, archive):
+        self.archive = archive
+        self.disk = DirSource()
+        self.pid = None
+        self.handle = None
+        self.members = {}
+        if zipfile.is_zipfile(archive):
+            self.kind = 'zip'
+            with zipfile.ZipFile(archive) as handle:
+                for name in handle.namelist():
+                    self.members[self.member_name(name)] = name
+            return
+        self.kind = 'tar'
+        try:
+            tarfile.open(archive, 'r:').close()
+        except tarfile.ReadError:
+            self.archive = self.uncompressed_copy(archive)
+        with tarfile.open(self.archive, 'r:') as handle:
+            for member in handle.getmembers():
+                if member.isfile():
+                    self.members[self.member_name(member.name)] = member
+
+    def uncompressed_copy (self, archive):
+        """
+        Returns the uncompressed copy of a compressed tar, made file by file without keeping them in memory. It's
+        named after the archive, its size and its date, so that the other processes and the next runs use the same
+        copy as long as the archive doesn't change; the copies of its older versions are deleted.
+        """
+        stat = os.stat(archive)
+        prefix = 'cfg_archive_' + hashlib.sha1(os.path.abspath(archive).encode()).hexdigest()[:16] + '_'
+        copy = os.path.join(tempfile.gettempdir(), prefix + str(stat.st_mtime_ns) + '_' + str(stat.st_size) + '.tar')
+        if os.path.exists(copy):
+            return copy
+        for name in os.listdir(tempfile.gettempdir()):
+            if name.startswith(prefix) and name.endswith('.tar'):
+                os.remove(os.path.join(tempfile.gettempdir(), name))
+        print('Decompressing the archive '+archive+' in '+copy+' (a zip or an uncompressed tar is read in place) ... ')
+        temp = copy + '.' + str(os.getpid()) + '.tmp'
+        with tarfile.open(archive, 'r|*') as source, tarfile.open(temp, 'w:') as target:
+            for member in source:
+                target.addfile(member, source.extractfile(member) if member.isfile() else None)
+        os.replace(temp, copy)
+        return copy
+
+    def member_name (self, name):
+        # the names are compared as written in the inventory, without a leading './'
+        while name.startswith('./'):
+            name = name[2:]
+        return name
+
+    def exists (self, filename):
+        return self.member_name(filename) in self.members or self.disk.exists(filename)
+
+    def read (self, filename):
+        member = self.members.get(self.member_name(filename))
+        if member == None:
+            return self.disk.read(filename)
+        if self.pid != os.getpid():
+            # a handle opened by the parent process can't be shared, its file position would be
+            self.pid = os.getpid()
+            self.handle = zipfile.ZipFile(self.archive) if self.kind == 'zip' else tarfile.open(self.archive, 'r:')
+        if self.kind == 'zip':
+            return self.handle.read(member)
+        return self.handle.extractfile(member).read()
+
+# where the configuration files are read from, opened at the first reading
+config_source = None
+
+def get_config_source ():
+    global config_source
+    if config_source == None:
+        config_source = ArchiveSource(cfg_archive) if cfg_archive else DirSource()
+    return config_source
+
+def get_cfg_tree (filename, data = None, timings = None):
+    """
+    Returns the CfgTree of the given configuration file. 'data' is the content of the file, when it has already been
+    read. The reading and parsing times are added to 'timings', if given. The trees are not kept from one phase to the
+    next one: the check phase reads every file again anyway to know if it has changed, and keeping the trees of a whole
+    fleet would take much more memory than parsing them again takes time.
+    """
+    started = time.perf_counter()
+    if data == None:
+        data = get_config_source().read(filename)
+        if timings != None:
+            timings['read'] = timings.get('read', 0.0) + time.perf_counter() - started
+            started = time.perf_counter()
+    print('Reading file ' + filename + ' ... ')
+    # decoded as open(filename, 'r') would do
+    tree = CfgTree(filename, io.TextIOWrapper(io.BytesIO(data)))
+    if timings != None:
+        timings['parse'] = timings.get('parse', 0.0) + time.perf_counter() - started
+    return tree
+
+def update_template_cmd (filename, commands, target = False, timings = None, allowed = None, found = None):
+    """
+    We now need to parse all the files belonging to the profile to insert all the commands to be checked. In this phase,
+    we filter global commands and other commands that we know are mandatory. We also have other filters to skip lines or 
+    whole SECTIONS (everything indented below something). This should provide a good list with no missing commands, we
+    should also update the counters matching each command as we proceed parsing all the files. This should provide a
+    confidence level of how much a certain command should be present or not. We store everything in an excel file for
+    further manuale processing. As a last step, we parse the 'target' example file for the given profile, and print all
+    the missing commands (for example, interfaces configurations, router bgp configurations and so on). These commands
+    could be manually changed to be checked on ALL node's configuration (for example 'router bgp\|timers 10 30'), or they
+    could be simply removed (like for example all interface specific configs, unless they are used for the same purpose so 
+    that the same interfaces is configured in the same way on every node ... ip address config could be removed).
+    The commands are counted in 'commands', a dictionary command -> counter where the commands keep the order in
+    which they are found (None to not count them). With 'allowed' only the commands in it are taken, and the
+    commands of the file are also added to the 'found' set, if given. The times spent are added to 'timings'.
+    """
+    tree = get_cfg_tree(filename, timings = timings)
+    started = time.perf_counter()
+    # the parents are written as changed by get_line, so here we keep every line (with its parents) as it is
+    # used in the commands, its children will be found below this path
+    tmpl_lines = {}
+    for node in tree.nodes:
+        line = get_line(node.line)
+        if line == None:
+            text = node.text
+        else:
+            text = line.strip()
+        if node.parent == None:
+            tmpl_lines[node] = text
+        else:
+            tmpl_lines[node] = tmpl_lines.get(node.parent, node.parent.text) + line_break + text
+        if line == None:
+            continue
+
+        if node.parent != None:
+            parents = tmpl_lines.get(node.parent, node.parent.text)
+            if re.search('( key \d+|enable secret|password)', line):
+                cmd = parents + line_break + line.strip()
             else:
-                while (len(parents)):
-                    parents.pop()
-                    num_spaces.pop()
-                    last_spaces = 0
-                    spaces = 0
-                    last_line = ''
-            last_line = line
-            line = get_line(line)
-            if line == None:
+                cmd = parents + line_break + line.strip() + '$'
+        else:
+            if re.search('( key \d+|enable secret \d+|password)', line):
+                cmd = line.strip()
+            else:
+                cmd = line.strip() + '$'
+        if not target and re.search('^(router|interface|crypto pki certificate chain|vrf definition)', cmd):
+            continue
+        if allowed != None and not cmd in allowed:
+            continue
+        if found != None:
+            found.add(cmd)
+        if commands != None:
+            if not cmd in commands:
+                commands[cmd] = 0
+            if not target:
+                commands[cmd] += 1
+    if timings != None:
+        timings['lines'] = timings.get('lines', 0.0) + time.perf_counter() - started
+
+def worker_settings ():
+    # the settings of this run for the worker processes: started with 'spawn' (the default on Windows and macOS)
+    # they import this file again and would otherwise get the values written at its beginning
+    return dict((name, globals()[name]) for name in setting_names)
+
+def init_worker (settings):
+    # with 'fork' the worker already has the same settings, and keeps what has been read with them
+    changed = dict((name, value) for name, value in settings.items() if globals()[name] != value)
+    if len(changed):
+        configure(**changed)
+
+def template_worker (job):
+    # the devices of a chunk read here or in a worker process. With 'timed' the timings of every device are sent back
+    # too. With 'allowed' only those commands are counted, together with the number of devices where each of them is
+    # found.
+    filenames, timed, allowed = job
+    commands = {}
+    support = {}
+    device_timings = []
+    for filename in filenames:
+        timings = {} if timed else None
+        found = set() if allowed != None else None
+        update_template_cmd(filename, commands, timings = timings, allowed = allowed, found = found)
+        if found != None:
+            for cmd in found:
+                support[cmd] = support.get(cmd, 0) + 1
+        if timed:
+            device_timings.append((filename, timings))
+    return commands, support, device_timings
+
+def support_worker (job):
+    # the devices of a chunk counted in a LossyCounter, for the first reading of template_min_support
+    filenames, timed, error = job
+    counter = LossyCounter(error)
+    device_timings = []
+    for filename in filenames:
+        timings = {} if timed else None
+        found = set()
+        update_template_cmd(filename, None, timings = timings, found = found)
+        counter.add_device(found)
+        if timed:
+            device_timings.append((filename, timings))
+    return counter, device_timings
+
+def merge_template_cmd (commands, other):
+    """ Adds the counters of 'other' to 'commands', the commands found only in 'other' go at the end in its order """
+    for cmd in other:
+        if cmd in commands:
+            commands[cmd] += other[cmd]
+        else:
+            commands[cmd] = other[cmd]
+
+class LossyCounter:
+    """
+    Counts on how many devices every command is found, in bounded memory (the 'lossy counting' of Manku and Motwani).
+    The devices are taken in buckets of 1/error devices, and at the end of every bucket the commands that can't have
+    been found on more than error * devices are forgotten: a command found again later starts with a 'missed' count
+    as high as what could have been forgotten. So count + missed is never below the real number of devices, and
+    only the commands found on many devices, or on the last buckets, are kept.
+    Two counters of the same error are merged the same way, the devices of each of them can be any.
+    """
+    def __init__ (self, error):
+        self.width = max(1, int(math.ceil(1 / error)))
+        self.devices = 0
+        # command -> [count, missed]
+        self.counts = {}
+
+    def add_device (self, cmds):
+        missed = self.devices // self.width
+        for cmd in cmds:
+            entry = self.counts.get(cmd)
+            if entry == None:
+                self.counts[cmd] = [1, missed]
+            else:
+                entry[0] += 1
+        self.devices += 1
+        if self.devices % self.width == 0:
+            self.prune()
+
+    def prune (self):
+        bucket = self.devices // self.width
+        for cmd in [cmd for cmd, (count, missed) in self.counts.items() if count + missed <= bucket]:
+            del self.counts[cmd]
+
+    def merge (self, other):
+        for cmd in self.counts:
+            if not cmd in other.counts:
+                self.counts[cmd][1] += other.devices // other.width
+        for cmd, (count, missed) in other.counts.items():
+            entry = self.counts.get(cmd)
+            if entry == None:
+                self.counts[cmd] = [count, missed + self.devices // self.width]
+            else:
+                entry[0] += count
+                entry[1] += missed
+        self.devices += other.devices
+        self.prune()
+
+    def candidates (self, threshold):
+        """ The commands that may be found on at least 'threshold' devices, all the ones that are found are there """
+        return set(cmd for cmd, (count, missed) in self.counts.items() if count + missed >= threshold)
+
+def template_chunks (filenames, *args):
+    """ The jobs of the template workers: chunks of the devices with the other arguments, one chunk without workers """
+    if template_workers == 1 or len(filenames) < 2:
+        return [(filenames,) + args]
+    size = -(-len(filenames) // ((template_workers or multiprocessing.cpu_count()) * 4))
+    return [(filenames[i:i+size],) + args for i in range(0, len(filenames), size)]
+
+def map_template_chunks (worker, jobs):
+    # the chunks are read here or in the worker processes, the results come back one by one in the chunks order
+    if len(jobs) < 2:
+        for job in jobs:
+            yield worker(job)
+        return
+    with multiprocessing.Pool(template_workers or None, init_worker, (worker_settings(),)) as pool:
+        for result in pool.imap(worker, jobs):
+            yield result
+
+def template_file (profile):
+    # the cfg_template file of a profile, None when it has none
+    filename = cfg_template.get(profile)
+    if filename == None or os.path.isabs(filename) or filename.startswith('.'):
+        return filename
+    return cfg_root_dir + filename
+
+def count_supported_cmd (profile, filenames):
+    """
+    The counting of run_gen_template with template_min_support, in bounded memory. The devices are read twice:
+    - first the number of devices having every command is estimated with a LossyCounter, with an error of half the
+      minimum support, to find the commands that may reach it
+    - then only those commands, and the ones of the cfg_template file, are counted exactly
+    The result is the same as counting everything and then dropping the commands found on less than
+    template_min_support of the devices, except the ones of the cfg_template file that are always kept.
+    """
+    threshold = template_min_support * len(filenames)
+    timed = report != None
+    target_cmds = set()
+    update_template_cmd(template_file(profile), None, target = True, found = target_cmds)
+
+    counter = LossyCounter(template_min_support / 2)
+    for chunk_counter, device_timings in map_template_chunks(support_worker,
+                                                             template_chunks(filenames, timed, template_min_support / 2)):
+        counter.merge(chunk_counter)
+        for filename, timings in device_timings:
+            report.add_device('gen_template', profile, filename, timings)
+    allowed = counter.candidates(threshold) | target_cmds
+
+    commands = {}
+    support = {}
+    for chunk_commands, chunk_support, device_timings in map_template_chunks(template_worker,
+                                                                             template_chunks(filenames, timed, allowed)):
+        merge_template_cmd(commands, chunk_commands)
+        for cmd in chunk_support:
+            support[cmd] = support.get(cmd, 0) + chunk_support[cmd]
+        for filename, timings in device_timings:
+            report.add_device('gen_template', profile, filename, timings)
+    for cmd in list(commands):
+        if support.get(cmd, 0) < threshold and not cmd in target_cmds:
+            del commands[cmd]
+    print('Profile '+profile+': '+str(len(commands))+' commands found on at least '+str(100 * template_min_support)+
+          '% of the devices or in the template, out of '+str(len(allowed))+' counted')
+    return commands
+
+class CmdMatcher:
+    """
+    Matching engine for the template commands of one profile, built once and then used on every line of every
+    device. For a given line it returns the same command that the old loop did: the first command, in the excel
+    order, that re.search() finds in the line and that has the same number of line_break (same indentation depth).
+    To get there without trying every command on every line:
+    - patterns are compiled once, with '***' already replaced by a space
+    - commands are split in buckets by their line_break depth, a line only looks at its own bucket
+    - commands without regex metacharacters are not run as regexp: '^...$' ones are found with a dictionary
+      lookup on the whole line, the others with startswith/endswith/in
+    - all the other commands are indexed by one 'whole word' that any matching line must contain (a word with a
+      space, a line_break, '^' or '$' on both sides). For each line we only try the commands indexed by the words
+      of the line, plus the few ones where such a word could not be found.
+    - 'kinds' tells how every command is found: 'exact' (dictionary lookup), 'prefix', 'suffix', 'substring'
+      (startswith, endswith, in) or 'regex'
+    - when a whole CfgTree is checked, the words found before a line_break in the command must be in the parent
+      path: the commands that can match below each parent path are selected once and remembered for all devices.
+    - a whole CfgTree is checked one section at a time (a global line with all the lines below it), and the commands
+      found in a section are remembered by a hash of its lines: the same section on another device (line vty, aaa,
+      policy-map ...) costs one dictionary lookup.
+    """
+    # markers for the '^' and '$' anchors when a pattern is analyzed
+    AT_BEGIN = 1
+    AT_END = 2
+    # parent paths remembered with their own candidate commands, the memory is cleared past this size
+    max_paths = 100000
+    # the same for the sections remembered with the commands found in them
+    max_sections = 100000
+
+    def __init__ (self, commands):
+        self.commands = commands
+        # words are split on spaces and on the characters used by line_break, so a word in the command is always
+        # a whole word in the matching line too, whatever the surrounding characters are
+        separators = '\s' + re.escape(''.join(sorted(set(line_break))))
+        self.word_split = re.compile('[' + separators + ']+')
+        self.word_find = re.compile('[^' + separators + ']+')
+        self.buckets = {}
+        self.kinds = []
+        self.cmd_words = []
+        self.cmd_parent_words = []
+        self.paths = {}
+        self.sections = {}
+        self.section_hits = 0
+        self.section_misses = 0
+        for i in range(len(commands)):
+            pattern = commands[i].replace('***', ' ')
+            regex = re.compile(pattern)
+            depth = pattern.count(line_break)
+            if not depth in self.buckets:
+                # exact literals, word -> commands, commands to be always tried, command -> test function,
+                # parent word -> commands, commands with no word in the parents
+                self.buckets[depth] = ({}, {}, [], {}, {}, [])
+            exact, words, always, tests, parent_words, no_parent = self.buckets[depth]
+            literal, anchor_start, anchor_end, cmd_words, cmd_parent_words = self.analyze(regex)
+            self.cmd_words.append(cmd_words)
+            self.cmd_parent_words.append(cmd_parent_words)
+            if literal != None and anchor_start and anchor_end:
+                self.kinds.append('exact')
+                if not literal in exact:
+                    exact[literal] = i
                 continue
+            if literal == None:
+                self.kinds.append('regex')
+                tests[i] = regex.search
+            elif anchor_start:
+                self.kinds.append('prefix')
+                tests[i] = lambda line, literal=literal: line.startswith(literal)
+            elif anchor_end:
+                self.kinds.append('suffix')
+                tests[i] = lambda line, literal=literal: line.endswith(literal)
+            else:
+                self.kinds.append('substring')
+                tests[i] = lambda line, literal=literal: literal in line
 
-            last_line = line
-            if len(parents):
-                if re.search('( key \d+|enable secret|password)', line):
-                    cmd = line_break.join(parents) + line_break + line.strip()
+        # every command is indexed by its less common word, so that the lists to be checked are as short as possible
+        self.word_counter = {}
+        for cmd_words in self.cmd_words:
+            for word in cmd_words:
+                self.word_counter[word] = self.word_counter.get(word, 0) + 1
+        for depth in self.buckets:
+            exact, words, always, tests, parent_words, no_parent = self.buckets[depth]
+            for i in sorted(tests):
+                if len(self.cmd_words[i]):
+                    self.add_word(words, self.cmd_words[i], i)
                 else:
-                    cmd = line_break.join(parents) + line_break + line.strip() + '$'
-                if not target and re.search('^(router|interface|crypto pki certificate chain|vrf definition)', cmd):
-                    continue
-                if not cmd in commands:
-                    commands[cmd] = 0
-                    #print('"' + '\|'.join(parents) + '\|' + line.strip() + '$",')
-                if not target:
-                    commands[cmd] += 1
-            else:
-                if re.search('( key \d+|enable secret \d+|password)', line):
-                    cmd = line.strip()
+                    always.append(i)
+                if len(self.cmd_parent_words[i]):
+                    self.add_word(parent_words, self.cmd_parent_words[i], i)
                 else:
-                    cmd = line.strip() + '$'
-                if not target and re.search('^(router|interface|crypto pki certificate chain|vrf definition)', cmd):
-                    continue
-                if not cmd in commands:
-                    commands[cmd] = 0
-                    #print('"' + line.strip() + '$",')
-                if not target:
-                    commands[cmd] += 1
+                    no_parent.append(i)
+
+    def instrument (self):
+        """
+        Wraps every test of a command in a timer, for the run report: the time and the number of tests of every
+        command are accumulated until take_costs() is called. The commands found with a dictionary lookup are not
+        timed, the lookup costs the same whatever the command.
+        """
+        seconds = self.seconds = [0.0] * len(self.commands)
+        tests_count = self.tests_count = [0] * len(self.commands)
+        clock = time.perf_counter
+        def timed (i, test):
+            def timed_test (line):
+                started = clock()
+                result = test(line)
+                seconds[i] += clock() - started
+                tests_count[i] += 1
+                return result
+            return timed_test
+        for depth in self.buckets:
+            tests = self.buckets[depth][3]
+            for i in tests:
+                tests[i] = timed(i, tests[i])
+
+    def take_costs (self):
+        """ Returns (command index, seconds, tests) for the commands tested since the last call, and resets them """
+        costs = [(i, self.seconds[i], self.tests_count[i]) for i in range(len(self.commands)) if self.tests_count[i]]
+        for i, seconds, tests in costs:
+            self.seconds[i] = 0.0
+            self.tests_count[i] = 0
+        return costs
+
+    def add_word (self, index, cmd_words, i):
+        word = min(cmd_words, key=lambda w: (self.word_counter[w], -len(w)))
+        if not word in index:
+            index[word] = []
+        index[word].append(i)
+
+    def analyze (self, regex):
+        """
+        Returns (literal, anchor_start, anchor_end, words, parent_words). 'literal' is None unless the pattern is a
+        plain string, optionally anchored with '^' and/or '$'. 'words' is the set of whole words that every matching line
+        contains, 'parent_words' the ones among them coming before a line_break, that must be found in the parents.
+        """
+        if regex.flags & re.IGNORECASE:
+            return None, False, False, frozenset(), frozenset()
+        # the pattern as a list of single characters, AT_BEGIN/AT_END for the anchors and None for anything else
+        items = []
+        for op, av in sre_parse.parse(regex.pattern):
+            if op is sre_parse.LITERAL:
+                items.append(chr(av))
+            elif op is sre_parse.AT and av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+                items.append(self.AT_BEGIN)
+            elif op is sre_parse.AT and av in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+                items.append(self.AT_END)
+            else:
+                items.append(None)
+
+        anchor_start = len(items) > 0 and items[0] is self.AT_BEGIN
+        anchor_end = len(items) > 0 and items[-1] is self.AT_END
+        body = items[int(anchor_start):len(items)-int(anchor_end)]
+        if all(isinstance(item, str) for item in body):
+            literal = ''.join(body)
+        else:
+            literal = None
+
+        # literal characters are grouped in runs, a run is broken by anything else in the pattern. Inside a run, a word
+        # surrounded by separators is mandatory, the first and last one only if the run is anchored on that side
+        found = []
+        last_break = -1
+        run = []
+        bounded = False
+        for pos in range(len(items)+1):
+            item = items[pos] if pos < len(items) else None
+            if isinstance(item, str):
+                run.append(item)
+                continue
+            run_string = ''.join(run)
+            run_start = pos - len(run)
+            for word in self.word_find.finditer(run_string):
+                if (word.start() > 0 or bounded) and (word.end() < len(run) or item is self.AT_END):
+                    found.append((word.group(), run_start + word.end()))
+            if line_break in run_string:
+                last_break = run_start + run_string.rfind(line_break)
+            run = []
+            bounded = item is self.AT_BEGIN
+        words = frozenset(word for word, end in found)
+        parent_words = frozenset(word for word, end in found if end <= last_break)
+        return literal, anchor_start, anchor_end, words, parent_words
+
+    def match (self, search_line):
+        """ Returns the index of the first command matching search_line, None if there is no match """
+        bucket = self.buckets.get(search_line.count(line_break))
+        if bucket == None:
+            return None
+        exact, words, always, tests = bucket[:4]
+        found = exact.get(search_line)
+        candidates = []
+        for word in set(self.word_split.split(search_line)):
+            if word in words:
+                candidates.extend(words[word])
+        candidates.sort()
+        for i in heapq.merge(always, candidates):
+            if found != None and i > found:
+                break
+            if tests[i](search_line):
+                return i
+        return found
+
+    def path_candidates (self, path, depth):
+        """
+        Returns the commands that can match a line below 'path' at the given depth: a word index built with the words
+        not already in the path, and the commands with all their words in the path (to be always tried)
+        """
+        key = (path, depth)
+        if key in self.paths:
+            return self.paths[key]
+        if len(self.paths) >= self.max_paths:
+            self.paths = {}
+        bucket = self.buckets.get(depth)
+        if bucket == None:
+            self.paths[key] = None
+            return None
+        exact, words, always, tests, parent_words, no_parent = bucket
+        path_words = frozenset(self.word_split.split(path))
+        allowed = list(no_parent)
+        for word in path_words:
+            if word in parent_words:
+                allowed.extend(i for i in parent_words[word] if self.cmd_parent_words[i] <= path_words)
+        path_index = {}
+        path_always = []
+        for i in sorted(allowed):
+            line_words = self.cmd_words[i] - path_words
+            if len(line_words):
+                self.add_word(path_index, line_words, i)
+            else:
+                path_always.append(i)
+        self.paths[key] = (path_index, path_always)
+        return self.paths[key]
+
+    def match_tree (self, tree):
+        """ Returns the list of the commands matched by the lines of a CfgTree, one for every line with a match """
+        found = []
+        section = []
+        for node in tree.nodes:
+            if node.parent == None and len(section):
+                found.extend(self.match_section(section))
+                section = []
+            section.append(node)
+        if len(section):
+            found.extend(self.match_section(section))
+        return found
+
+    def match_section (self, nodes):
+        """
+        Returns the commands matched by the lines of a section. The result of a line only depends on its search line
+        and on being a global line or not, and only the first line of a section can be global (or not, for the
+        lines above the first global line of a file), so this is what the section hash is made of.
+        """
+        search_lines = [node.search_line() for node in nodes]
+        key = hashlib.sha1((('G' if nodes[0].parent == None else 'C') + '\n'.join(search_lines)).encode()).digest()
+        found = self.sections.get(key)
+        if found != None:
+            self.section_hits += 1
+            return found
+        self.section_misses += 1
+        found = []
+        for node, search_line in zip(nodes, search_lines):
+            cmd_index = self.match_node(node, search_line)
+            if cmd_index != None:
+                found.append(cmd_index)
+        if len(self.sections) >= self.max_sections:
+            self.sections = {}
+        found = self.sections[key] = tuple(found)
+        return found
+
+    def match_node (self, node, search_line):
+        """ Returns the index of the first command matching a node of a CfgTree, None if there is no match """
+        # the words before a line_break in the command can be looked for in the parents only if the line
+        # itself has no line_break
+        if line_break in node.text:
+            return self.match(search_line)
+        depth = search_line.count(line_break)
+        candidates = self.path_candidates(node.path if node.parent != None else '', depth)
+        if candidates == None:
+            return None
+        path_index, path_always = candidates
+        exact, tests = self.buckets[depth][0], self.buckets[depth][3]
+        cmd_index = exact.get(search_line)
+        line_candidates = []
+        for word in set(self.word_split.split(node.text)):
+            if word in path_index:
+                line_candidates.extend(path_index[word])
+        line_candidates.sort()
+        for i in heapq.merge(path_always, line_candidates):
+            if cmd_index != None and i > cmd_index:
+                break
+            if tests[i](search_line):
+                return i
+        return cmd_index
+
+# the characters config lines are made of, to compare what the parts of a regexp can match
+regex_alphabet = frozenset(' \t' + ''.join(chr(c) for c in range(33, 127)))
+
+def regex_chars (items, from_end = False):
+    """
+    Returns (characters, empty) for a list of sre_parse items: the characters of regex_alphabet a match can start with
+    (or end with, 'from_end'), and whether the match can be empty. Anything not understood can be any character.
+    """
+    chars = set()
+    for op, av in (list(items)[::-1] if from_end else items):
+        if op is sre_parse.LITERAL:
+            item_chars, empty = set([chr(av)]), False
+        elif op is sre_parse.NOT_LITERAL:
+            item_chars, empty = regex_alphabet - set([chr(av)]), False
+        elif op is sre_parse.ANY:
+            item_chars, empty = regex_alphabet, False
+        elif op is sre_parse.IN:
+            item_chars, empty = set(char for char in regex_alphabet if regex_in(av, char)), False
+        elif op is sre_parse.SUBPATTERN:
+            item_chars, empty = regex_chars(av[-1], from_end)
+        elif op is sre_parse.BRANCH:
+            item_chars, empty = set(), False
+            for branch in av[1]:
+                branch_chars, branch_empty = regex_chars(branch, from_end)
+                item_chars |= branch_chars
+                empty = empty or branch_empty
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            item_chars, empty = regex_chars(av[2], from_end)
+            empty = empty or av[0] == 0
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            item_chars, empty = set(), True
+        else:
+            item_chars, empty = regex_alphabet, True
+        chars |= item_chars
+        if not empty:
+            return chars, False
+    return chars, True
+
+def regex_in (items, char):
+    # whether a character is in a sre_parse set like [a-z\d] or [^,]
+    categories = {
+        sre_parse.CATEGORY_DIGIT: char.isdigit(),
+        sre_parse.CATEGORY_NOT_DIGIT: not char.isdigit(),
+        sre_parse.CATEGORY_SPACE: char.isspace(),
+        sre_parse.CATEGORY_NOT_SPACE: not char.isspace(),
+        sre_parse.CATEGORY_WORD: char.isalnum() or char == '_',
+        sre_parse.CATEGORY_NOT_WORD: not (char.isalnum() or char == '_'),
+    }
+    negate = False
+    for op, av in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL and chr(av) == char:
+            return not negate
+        elif op is sre_parse.RANGE and av[0] <= ord(char) <= av[1]:
+            return not negate
+        elif op is sre_parse.CATEGORY and categories.get(av, True):
+            return not negate
+    return negate
+
+def regex_variable (items):
+    # whether the sre_parse items can match strings of different lengths in more than one way: a repeat without a
+    # fixed count, or alternatives
+    for op, av in items:
+        if op is sre_parse.BRANCH or (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] != av[1]):
+            return True
+        if op is sre_parse.SUBPATTERN and regex_variable(av[-1]):
+            return True
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and regex_variable(av[2]):
+            return True
+    return False
+
+def command_risks (pattern):
+    """
+    Returns the risks of a template command that compiles, as (severity, message) warnings:
+    - a repeat with no small limit of something of variable length, where the characters a repetition can end with
+      can also start the next one ('(\S+\s*)+', '(a+)+'): the same text can be split in repetitions in many ways,
+      and the backtracking grows exponentially with the length of the lines that almost match
+    - characters required after '$' or before '^', in the command or in one of its alternatives or groups: that part
+      of the command can never match a line
+    - a '.' between digits, that matches any character where '\.' was probably meant (an ip address)
+    - a '|' outside of parenthesis, that makes the whole command before it one of the alternatives
+    """
+    risks = []
+    def walk (items):
+        for op, av in items:
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                low, high, inner = av
+                if high > 10 and regex_variable(inner):
+                    first, empty = regex_chars(inner)
+                    last, empty = regex_chars(inner, from_end = True)
+                    if empty or len(first & last):
+                        risks.append(('WARNING', 'a repeat that can split the same text in many ways can backtrack '
+                                                 'exponentially'))
+                        return True
+                if walk(inner):
+                    return True
+            elif op is sre_parse.BRANCH:
+                for branch in av[1]:
+                    if walk(branch):
+                        return True
+            elif op is sre_parse.SUBPATTERN:
+                if walk(av[-1]):
+                    return True
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                if walk(av[1]):
+                    return True
+        return False
+    items = list(sre_parse.parse(pattern))
+    walk(items)
+
+    def required (item):
+        op, av = item
+        return op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN) or \
+               (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1)
+    # the sequences of the pattern: the whole of it, every alternative and the content of every group and repeat
+    sequences = [items]
+    for sequence in sequences:
+        for op, av in sequence:
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                sequences.append(list(av[2]))
+            elif op is sre_parse.BRANCH:
+                sequences.extend(list(branch) for branch in av[1])
+            elif op is sre_parse.SUBPATTERN:
+                sequences.append(list(av[-1]))
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                sequences.append(list(av[1]))
+    anchors = None
+    dots = None
+    for sequence in sequences:
+        for pos in range(len(sequence)):
+            op, av = sequence[pos]
+            if anchors == None and op is sre_parse.AT and av in (sre_parse.AT_END, sre_parse.AT_END_STRING) and \
+               any(required(item) for item in sequence[pos+1:]):
+                anchors = ('WARNING', "'$' followed by more characters, it can never match")
+            if anchors == None and op is sre_parse.AT and \
+               av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING) and \
+               any(required(item) for item in sequence[:pos]):
+                anchors = ('WARNING', "'^' after some characters, it can never match")
+            if dots == None and 0 < pos < len(sequence) - 1 and op is sre_parse.ANY and \
+               sequence[pos-1][0] is sre_parse.LITERAL and sequence[pos+1][0] is sre_parse.LITERAL and \
+               chr(sequence[pos-1][1]).isdigit() and chr(sequence[pos+1][1]).isdigit():
+                dots = ('WARNING', "'.' between digits matches any character, '\\.' may be meant")
+    risks += [risk for risk in (anchors, dots) if risk != None]
+
+    # the '|' are looked for in the text, sre_parse moves what the alternatives start with out of them
+    depth = 0
+    escaped = False
+    in_class = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            risks.append(('WARNING', "'|' outside of parenthesis, the alternatives are the whole command"))
+            break
+    return risks
+
+def command_problems (commands):
+    """ Returns the problems of the commands of a profile as (command index, 'ERROR' or 'WARNING', message) """
+    problems = []
+    for i in range(len(commands)):
+        pattern = commands[i].replace('***', ' ')
+        try:
+            re.compile(pattern)
+        except re.error as err:
+            problems.append((i, 'ERROR', 'not a valid regexp, '+str(err)))
+            continue
+        for severity, message in command_risks(pattern):
+            problems.append((i, severity, message))
+    return problems
+
+def preflight_commands (profile, commands):
+    """
+    Prints the problems of the commands of a profile before checking its devices: the errors and the commands that
+    may backtrack exponentially, only the number of the other warnings (validate_templates lists them). Returns False
+    when some commands are not valid regexp: the profile can't be checked.
+    """
+    valid = True
+    others = 0
+    for i, severity, message in command_problems(commands):
+        if severity == 'ERROR' or 'backtrack' in message:
+            print(severity+' in command "'+commands[i]+'" of profile '+profile+': '+message)
+        else:
+            others += 1
+        valid = valid and severity != 'ERROR'
+    if others:
+        print('Profile '+profile+': '+str(others)+' warnings about its commands, see the validate subcommand')
+    if not valid:
+        print('ERROR, the devices of profile '+profile+' are not checked, the previous results are kept')
+    return valid
+
+def time_commands (commands, filename, skip = ()):
+    """
+    Times every command as a plain regexp search on the lines of a sample config with the same line_break depth, that
+    is on every line the checker could try it on. Returns (microseconds per line, lines matched) for every command,
+    None for the commands in 'skip' and the ones with no line of their depth. At most 2000 lines of every depth are
+    taken, spread over the file.
+    """
+    max_lines = 2000
+    lines = {}
+    for node in get_cfg_tree(filename).nodes:
+        search_line = node.search_line()
+        depth = search_line.count(line_break)
+        if not depth in lines:
+            lines[depth] = []
+        lines[depth].append(search_line)
+    for depth in lines:
+        if len(lines[depth]) > max_lines:
+            lines[depth] = [lines[depth][len(lines[depth]) * i // max_lines] for i in range(max_lines)]
+
+    timings = []
+    clock = time.perf_counter
+    for i in range(len(commands)):
+        pattern = commands[i].replace('***', ' ')
+        depth_lines = lines.get(pattern.count(line_break))
+        if i in skip or depth_lines == None:
+            timings.append(None)
+            continue
+        search = re.compile(pattern).search
+        matched = 0
+        started = clock()
+        for line in depth_lines:
+            if search(line):
+                matched += 1
+        timings.append(((clock() - started) * 1000000 / len(depth_lines), matched))
+    return timings
+
+def check_cfg_file (matcher, filename, known_hash = None, timed = False):
+    """
+    Returns (content_hash, presence, timings, sections) for a device. The presence vector tells, for every command, how
+    many lines of its config match it. When the content of the file has 'known_hash', it has already been checked with
+    the same commands and it's not parsed again: presence is None, the cached result must be used. With 'timed' the
+    matcher must be instrumented, and timings has the times spent on the device for the run report, otherwise None.
+    sections is (found in the matcher cache, matched) for the sections of the config.
+    """
+    started = time.perf_counter()
+    timings = {} if timed else None
+    data = get_config_source().read(filename)
+    content_hash = hashlib.sha1(data).hexdigest()
+    if timed:
+        timings['read'] = time.perf_counter() - started
+    if content_hash == known_hash:
+        return content_hash, None, timings, (0, 0)
+    presence = [0] * len(matcher.commands)
+    tree = get_cfg_tree(filename, data = data, timings = timings)
+    started = time.perf_counter()
+    hits, misses = matcher.section_hits, matcher.section_misses
+    for cmd_index in matcher.match_tree(tree):
+        presence[cmd_index] += 1
+    if timed:
+        timings['match'] = time.perf_counter() - started
+        timings['commands'] = matcher.take_costs()
+    return content_hash, presence, timings, (matcher.section_hits - hits, matcher.section_misses - misses)
+
+# matcher of the profile being checked in the worker processes, and whether the devices are timed
+check_worker_matcher = None
+check_worker_timed = False
+
+def init_check_worker (settings, commands, timed = False):
+    # the settings and the command list are sent once to every worker process, which compiles it for all its devices
+    global check_worker_matcher, check_worker_timed
+    init_worker(settings)
+    check_worker_matcher = CmdMatcher(commands)
+    check_worker_timed = timed
+    if timed:
+        check_worker_matcher.instrument()
+
+def check_worker (job):
+    filename, known_hash = job
+    return check_cfg_file(check_worker_matcher, filename, known_hash, check_worker_timed)
+
+def check_cache_file ():
+    # every shard keeps the results of its own devices
+    if shard_count > 1 and cfg_check_cache:
+        return cfg_check_cache + '.' + str(shard_index) + 'of' + str(shard_count)
+    return cfg_check_cache
+
+def load_check_cache ():
+    """
+    Returns the results of the previous checks, stored in cfg_check_cache as:
+    profile -> {'commands': hash of the profile command list, 'devices': {filename: (content_hash, presence)}}
+    where presence only keeps the (command index, matching lines) pairs of the commands found.
+    """
+    filename = check_cache_file()
+    if not filename or not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, 'rb') as file:
+            cache = pickle.load(file)
+        if cache.get('version') == 1:
+            return cache['profiles']
+        print('WARNING: ignoring the check cache '+filename+', unknown format')
+    except Exception as err:
+        print('WARNING: ignoring the check cache '+filename+', '+str(err))
+    return {}
+
+def save_check_cache (profiles):
+    filename = check_cache_file()
+    if not filename:
+        return
+    # written aside and then renamed, an interrupted run can't leave a broken cache
+    with open(filename + '.tmp', 'wb') as file:
+        pickle.dump({'version': 1, 'profiles': profiles}, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount (bits):
+        return bin(bits).count('1')
+
+class CheckMatrix:
+    """
+    The check result of a profile: which command is present on which device. Every device is a row, an integer
+    used as a bitset where bit i is set when the command i is present, so that the whole matrix takes one bit per
+    device and command. The columns (one bitset per command, bit d set for the device d) are built when needed, and
+    give the totals of every command and the devices missing it without looking at every cell.
+    """
+    def __init__ (self, commands, devices = None, rows = None):
+        self.commands = commands
+        self.devices = devices if devices != None else []
+        self.rows = rows if rows != None else []
+        self.cols = None
+
+    def add_device (self, dev, cmd_indexes):
+        bits = 0
+        for cmd_index in cmd_indexes:
+            bits |= 1 << cmd_index
+        self.devices.append(dev)
+        self.rows.append(bits)
+        self.cols = None
+
+    def present (self, dev_index, cmd_index):
+        return (self.rows[dev_index] >> cmd_index) & 1 == 1
+
+    def columns (self):
+        # the matrix transposed, every set bit of every row is visited once
+        if self.cols == None:
+            cols = [bytearray((len(self.rows) + 7) // 8) for cmd in self.commands]
+            for dev_index in range(len(self.rows)):
+                bits = self.rows[dev_index]
+                byte, bit = dev_index >> 3, 1 << (dev_index & 7)
+                while bits:
+                    low = bits & -bits
+                    cols[low.bit_length() - 1][byte] |= bit
+                    bits ^= low
+            self.cols = [int.from_bytes(col, 'little') for col in cols]
+        return self.cols
+
+    def totals (self):
+        """
+        The number of devices with every command. The rows are summed as bit-sliced counters: planes[k] holds bit k of
+        the counter of every command, so adding a row is a binary addition done on all the commands at once.
+        """
+        planes = []
+        for bits in self.rows:
+            k = 0
+            while bits:
+                if k == len(planes):
+                    planes.append(0)
+                planes[k], bits = planes[k] ^ bits, planes[k] & bits
+                k += 1
+        totals = [0] * len(self.commands)
+        for k in range(len(planes)):
+            for cmd_index in set_bits(planes[k]):
+                totals[cmd_index] += 1 << k
+        return totals
+
+    def compliance (self):
+        """ The fraction of the commands present on every device """
+        if not len(self.commands):
+            return [1.0] * len(self.rows)
+        return [popcount(bits) / len(self.commands) for bits in self.rows]
+
+    def missing (self, cmd_index):
+        """ The devices without the given command, from the columns when they are already built """
+        if self.cols == None:
+            return [self.devices[dev_index] for dev_index in range(len(self.rows))
+                    if not (self.rows[dev_index] >> cmd_index) & 1]
+        col = self.cols[cmd_index]
+        return [self.devices[dev_index] for dev_index in range(len(self.devices)) if not (col >> dev_index) & 1]
+
+    def pack (self):
+        # every row as the same number of bytes, all the rows compressed together and written as base64 text, so
+        # that the packed matrix can be saved as json
+        size = (len(self.commands) + 7) // 8
+        bits = b''.join(row.to_bytes(size, 'little') for row in self.rows)
+        return {'commands': self.commands, 'devices': self.devices,
+                'bits': base64.b64encode(zlib.compress(bits)).decode('ascii')}
+
+    @staticmethod
+    def unpack (packed):
+        size = (len(packed['commands']) + 7) // 8
+        bits = zlib.decompress(base64.b64decode(packed['bits']))
+        if size:
+            rows = [int.from_bytes(bits[i:i+size], 'little') for i in range(0, size * len(packed['devices']), size)]
+        else:
+            rows = [0] * len(packed['devices'])
+        return CheckMatrix(list(packed['commands']), list(packed['devices']), rows)
+
+def excel_signature (filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def save_json (filename, data):
+    """
+    Writes the snapshots and the shards, that can be shared between machines, as json: unlike pickle, reading them
+    can't run any code. The file is written aside and renamed, so that it's never found half written.
+    """
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+    os.replace(filename + '.tmp', filename)
 
-if gen_template:
+def load_snapshot (filename, excel_file = None):
+    """
+    Returns (sheets, profile -> CheckMatrix) as saved in the snapshot file, None if it can't be read. With
+    'excel_file', None is also returned when the snapshot was not written together with that excel file (missing,
+    saved again, or changed by hand since then).
+    """
+    if not filename or not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as file:
+            snapshot = json.load(file)
+        if snapshot.get('version') != 2:
+            print('WARNING: ignoring the check snapshot '+filename+', unknown format')
+            return None
+        if excel_file != None and (not os.path.exists(excel_file) or list(excel_signature(excel_file)) != snapshot['excel']):
+            print('WARNING: the check snapshot '+filename+' is not the one of '+excel_file+', it is not used')
+            return None
+        matrices = {}
+        for profile in snapshot['profiles']:
+            matrices[profile] = CheckMatrix.unpack(snapshot['profiles'][profile])
+        return snapshot['sheets'], matrices
+    except Exception as err:
+        print('WARNING: ignoring the check snapshot '+filename+', '+str(err))
+    return None
+
+def save_snapshot (filename, sheets, matrices, excel_file = None):
+    # without 'excel_file' the snapshot doesn't go with an excel file, and load_snapshot never takes it as its one
+    profiles = {}
+    for profile in matrices:
+        profiles[profile] = matrices[profile].pack()
+    snapshot = {'version': 2, 'created': datetime.datetime.now().isoformat(),
+                'excel': list(excel_signature(excel_file)) if excel_file else None, 'sheets': sheets, 'profiles': profiles}
+    save_json(filename, snapshot)
+
+def set_bits (bits):
+    """ Yields the index of every bit set in an integer, from the lowest """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def matrix_drift (old, new):
+    """
+    Yields (device, command, change) for everything that changed between two CheckMatrix of the same profile. The
+    change is 'lost' or 'gained' for a command present before and not now or the other way round, 'removed device'
+    and 'added device' (with no command) for devices found in only one of them. Commands are compared by their text:
+    the ones added or removed from the template are not reported device by device.
+    The old rows are moved to the columns of the new matrix, then only the bits set in old & ~new and new & ~old are
+    visited, so unchanged devices cost one integer comparison.
+    """
+    if old.commands == new.commands:
+        remap = None
+    else:
+        new_index = {}
+        for cmd_index in range(len(new.commands)):
+            new_index.setdefault(new.commands[cmd_index], cmd_index)
+        remap = [new_index.get(cmd) for cmd in old.commands]
+        # bits of the new matrix for the commands also in the old one
+        common = 0
+        for cmd_index in remap:
+            if cmd_index != None:
+                common |= 1 << cmd_index
+
+    # devices are paired by name, a name repeated in a profile is paired in the order of the rows
+    old_rows = {}
+    for dev_index in range(len(old.devices)):
+        old_rows.setdefault(old.devices[dev_index], []).append(old.rows[dev_index])
+    seen = {}
+    for dev_index in range(len(new.devices)):
+        dev = new.devices[dev_index]
+        occurrence = seen.get(dev, 0)
+        seen[dev] = occurrence + 1
+        if occurrence >= len(old_rows.get(dev, [])):
+            yield dev, None, 'added device'
+            continue
+        old_bits = old_rows[dev][occurrence]
+        new_bits = new.rows[dev_index]
+        if remap != None:
+            bits = 0
+            for cmd_index in set_bits(old_bits):
+                if remap[cmd_index] != None:
+                    bits |= 1 << remap[cmd_index]
+            old_bits = bits
+            new_bits &= common
+        if old_bits == new_bits:
+            continue
+        for cmd_index in set_bits(old_bits & ~new_bits):
+            yield dev, new.commands[cmd_index], 'lost'
+        for cmd_index in set_bits(new_bits & ~old_bits):
+            yield dev, new.commands[cmd_index], 'gained'
+    for dev in old_rows:
+        for occurrence in range(seen.get(dev, 0), len(old_rows[dev])):
+            yield dev, None, 'removed device'
+
+class Inventory:
+    """
+    The devices listed in the 'Devices' sheet of xls_ip_devices: 'rows' keeps (excel row, directory, device, profile)
+    for every line, with the values already stripped, 'by_name' the first line of every device name and 'by_profile'
+    the lines of every profile.
+    """
+    def __init__ (self, rows):
+        self.rows = rows
+        self.by_name = {}
+        self.by_profile = {}
+        for row in rows:
+            if not row[2] in self.by_name:
+                self.by_name[row[2]] = row
+            if not row[3] in self.by_profile:
+                self.by_profile[row[3]] = []
+            self.by_profile[row[3]].append(row)
+
+    def config_file (self, row):
+        """ Returns the config file of a device, None if it doesn't exist """
+        filename = cfg_root_dir + row[1] + '/' + row[2] + '.txt'
+        if get_config_source().exists(filename):
+            return filename
+        return None
+
+    def profile_files (self, profile):
+        """ Returns the set of the config files of all the devices of the profile, whether they exist or not """
+        return set(cfg_root_dir + row[1] + '/' + row[2] + '.txt' for row in self.by_profile.get(profile, []))
+
+    def profile_configs (self, dev_filter = '.*', existing = True):
+        """
+        Returns profile -> config files of its devices, for the profiles and devices matching the filters. With
+        existing=False the files are listed even when they are not there (yet).
+        """
+        profiles_list = {}
+        selected = {}
+        for row in self.rows:
+            profile = row[3]
+            if not profile in selected:
+                selected[profile] = profile != 'None' and len(profile) > 0 and re.search(profiles_filter, profile)
+            if not selected[profile] or not re.search(dev_filter, row[2]):
+                continue
+            filename = self.config_file(row) if existing else cfg_root_dir + row[1] + '/' + row[2] + '.txt'
+            if filename == None:
+                # print('Config not found: "'+cfg_root_dir + row[1] + '/' + row[2]+'.txt"')
+                continue
+            if not profile in profiles_list:
+                profiles_list[profile] = []
+            profiles_list[profile].append(filename)
+        return profiles_list
+
+# the devices inventory, read again only when xls_ip_devices changes, and the (file, mtime, size) it was read from
+inventory = None
+inventory_source = None
+
+def get_inventory ():
+    """
+    Returns the Inventory of xls_ip_devices, the one already read as long as the excel file has not changed, or the one
+    of inventory_cache
+    """
+    global inventory, inventory_source
+    stat = os.stat(xls_ip_devices)
+    source = (os.path.abspath(xls_ip_devices), stat.st_mtime_ns, stat.st_size)
+    if inventory != None and inventory_source == source:
+        return inventory
+    inventory_source = source
+    if inventory_cache and os.path.exists(inventory_cache):
+        try:
+            with open(inventory_cache, 'rb') as file:
+                cache = pickle.load(file)
+            if cache.get('version') == 1 and cache['source'] == source:
+                inventory = Inventory(cache['rows'])
+                return inventory
+        except Exception as err:
+            print('WARNING: ignoring the inventory cache '+inventory_cache+', '+str(err))
+
+    print('Loading devices from '+xls_ip_devices+' ... ')
+    rows = []
+    dev_targ = load_openpyxl().load_workbook(xls_ip_devices, read_only=True)
+    xls_row = 1
+    for row in dev_targ['Devices'].iter_rows(min_row=2, values_only=True):
+        xls_row += 1
+        rows.append((xls_row, str(row_value(row, 'A')).strip(), str(row_value(row, 'E')).strip(),
+                     str(row_value(row, 'P')).strip()))
+    dev_targ.close()
+    inventory = Inventory(rows)
+    if inventory_cache:
+        with open(inventory_cache + '.tmp', 'wb') as file:
+            pickle.dump({'version': 1, 'source': source, 'rows': rows}, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(inventory_cache + '.tmp', inventory_cache)
+    return inventory
+
+# openpyxl takes longer to import than everything else: it's imported by the first function reading or writing an
+# excel file, so that what doesn't need excel (checking a device against the snapshot, the watch queries ...) starts
+# without it
+openpyxl = None
+PatternFill = None
+WriteOnlyCell = None
+
+def load_openpyxl ():
+    global openpyxl, PatternFill, WriteOnlyCell
+    if openpyxl == None:
+        import openpyxl as module
+        from openpyxl.styles import PatternFill as fill
+        from openpyxl.cell import WriteOnlyCell as cell
+        openpyxl, PatternFill, WriteOnlyCell = module, fill, cell
+    return openpyxl
+
+def column_index (column):
+    """ The index of an excel column, 1 for 'A', 2 for 'B' ... 27 for 'AA' """
+    index = 0
+    for char in column.upper():
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index
+
+def row_value (row, column):
+    """ Returns the value in the given column ('A', 'B' ...) of a row read with iter_rows(values_only=True) """
+    index = column_index(column) - 1
+    if index < len(row):
+        return row[index]
+    return None
+
+def copy_sheet (source, sheet):
+    """ Copies the values of a read-only sheet into a write-only one, together with the green fills """
+    for row in source.iter_rows():
+        values = []
+        for cell in row:
+            fill = getattr(cell, 'fill', None)
+            if fill != None and fill.fill_type == 'solid' and fill.fgColor.rgb == '0000FF00':
+                new_cell = WriteOnlyCell(sheet, value = cell.value)
+                new_cell.fill = PatternFill("solid", fgColor="00FF00")
+                values.append(new_cell)
+            else:
+                values.append(cell.value)
+        sheet.append(values)
+
+def read_profile_commands (cmd_targ, profile):
+    """ Returns the commands to be checked for the profile, from its sheet of cfg_check_cmd """
+    commands = []
+    for row in cmd_targ[profile].iter_rows(min_row=2, values_only=True):
+        cmd_temp = str(row_value(row, 'A')).strip()
+        if len(cmd_temp) and cmd_temp!='None':
+            commands.append(cmd_temp)
+    return commands
+
+def commands_hash (commands):
+    # a profile's cached results are valid as long as its command list is the same
+    return hashlib.sha1(repr((line_break, commands)).encode()).hexdigest()
+
+@phase_settings
+def run_gen_template ():
     """ 
     We start reading the excel file with the full list of devices, we store the lines that belong to the same
     profiles in a list. We can then, for every profile:
@@ -168,29 +1857,25 @@ if gen_template:
     - create the profile sheet (if not existent)
     - parse the configuration file for every device in the list
     - write the output, command present or not, and update its counter
+    Returns profile -> {command: number of occurrences} of what has been written.
     """
-    profiles_list = {}
-    dev_targ = openpyxl.load_workbook(xls_ip_devices)
-    dev_sheet = dev_targ['Devices']
-    for xls_row in range(2, dev_sheet.max_row+1):
-        profile = str(dev_sheet['P'+str(xls_row)].value).strip()
-        dir = str(dev_sheet['A'+str(xls_row)].value).strip()+'/'
-        dev = str(dev_sheet['E'+str(xls_row)].value).strip()
-        if not os.path.exists(cfg_root_dir + dir + dev + '.txt'):
-            # print('Config not found: "'+cfg_root_dir + dir + dev+'.txt"')
-            continue
-        if profile == 'None' or len(profile)==0 or not re.search(profiles_filter, profile):
-            continue
-        if not profile in profiles_list:
-            profiles_list[profile] = []
-        profiles_list[profile].append(xls_row)
+    phase_start = step = start_phase()
+    if line_rules_corpus and check_line_rules(line_rules_corpus):
+        print('ERROR, the line rules do not give the expected results, the templates are not generated')
+        end_phase('gen_template', phase_start)
+        return None
+    profiles_list = get_inventory().profile_configs()
+    step = timed_step('gen_template', 'inventory', step)
 
     if os.path.exists(cfg_check_cmd):
-        targ = openpyxl.load_workbook(cfg_check_cmd)
+        targ = load_openpyxl().load_workbook(cfg_check_cmd)
     else:
-        targ = openpyxl.Workbook()
+        targ = load_openpyxl().Workbook()
+    step = timed_step('gen_template', 'excel loading', step)
 
+    templates = {}
     for profile in profiles_list:
+        profile_start = time.perf_counter()
         if profile in targ:
             sheet = targ[profile]
         else:
@@ -199,18 +1884,30 @@ if gen_template:
             print('ERROR for profile '+profile+', could not find a template defined')
             continue
 
+        # the devices are read in chunks, here or in the worker processes. Every chunk is counted apart, and the
+        # counters are merged in the devices order, so the commands keep the same order as reading all the devices
+        # one by one
         commands = {}
-        row_counter = 2
-        for i in range(len(profiles_list[profile])):
-            xls_row = profiles_list[profile][i]
-            dir = str(dev_sheet['A'+str(xls_row)].value).strip() + '/'
-            dev = str(dev_sheet['E'+str(xls_row)].value).strip()
-            update_template_cmd(cfg_root_dir + dir + dev + '.txt')
+        filenames = profiles_list[profile]
+        if template_min_support:
+            commands = count_supported_cmd(profile, filenames)
+        elif template_workers != 1 and len(filenames) > 1:
+            for chunk_commands, support, device_timings in map_template_chunks(template_worker,
+                                                                               template_chunks(filenames, report != None, None)):
+                merge_template_cmd(commands, chunk_commands)
+                for filename, timings in device_timings:
+                    report.add_device('gen_template', profile, filename, timings)
+        else:
+            for filename in filenames:
+                timings = {} if report != None else None
+                update_template_cmd(filename, commands, timings = timings)
+                if report != None:
+                    report.add_device('gen_template', profile, filename, timings)
         
         # Here we have read all the config files, now it's time to write down the commands in the excel file.
         # We parse one configuration file, and write down the lines that we have already found also on the other
         # nodes. The other lines are printed afterwards.
-        update_template_cmd(cfg_template[profile], target = True)
+        update_template_cmd(template_file(profile), commands, target = True)
         
         # finished reading the file, here we should print the remained commands, those that should be present only on
         # a few routers. commands[cmd] contains the number of occurrences of the command, on all config files.
@@ -219,140 +1916,374 @@ if gen_template:
             sheet['A'+str(xls_row)].value = cmd
             sheet['C'+str(xls_row)].value = commands[cmd]
             xls_row += 1
+        step = time.perf_counter()
         targ.save(cfg_check_cmd)
         targ.close()
+        step = timed_step('gen_template', 'excel saving', step)
+        if report != None:
+            report.profile('gen_template', profile)['seconds'] += step - profile_start
+        templates[profile] = commands
+    end_phase('gen_template', phase_start)
+    return templates
 
-if gen_excel:
+def check_profiles (profiles_list, check_cache):
     """
-    - we read all the devices belonging to all profiles from the main device database, filters
-    about profiles and devices are already applied in this phase
-    - we open the 'xls_cfg_miss' file and for every profile, we create a new sheet if
-    necessary, and we start examining all the devices' config, for each line we check
-    if the required command is present or not, with complexity O(Nsquare).
+    Checks the devices of every profile of profiles_list (profile -> config files) with the profile's commands of
+    cfg_check_cmd. Yields (profile, commands, devices) for every profile, where devices yields (device, indexes of the
+    commands found) in the order of the config files, to be read before going on with the next profile; commands is
+    None when they can't be read. The devices whose config has not changed since the last check, with the same
+    commands, are taken from check_cache, that gets the results of this check.
     """
-    # this is a dictionary, the keys being the profiles. The values are
-    # arrays containing the indexes of the excel database file.
-    profiles_list = {}
-    dev_targ = openpyxl.load_workbook(xls_ip_devices)
-    dev_sheet = dev_targ['Devices']
-    for xls_row in range(2, dev_sheet.max_row+1):
-        profile = str(dev_sheet['P'+str(xls_row)].value).strip()
-        dir = str(dev_sheet['A'+str(xls_row)].value).strip()+'/'
-        dev = str(dev_sheet['E'+str(xls_row)].value).strip()
-        if not os.path.exists(cfg_root_dir + dir + dev + '.txt'):
-            # print('Config not found: "'+cfg_root_dir + dir + dev+'.txt"')
-            continue
-        if profile == 'None' or len(profile)==0 or not re.search(profiles_filter, profile):
-            continue
-        if not re.search(dev_filter, dev):
+    cmd_targ = None
+    for profile in profiles_list:
+        started = time.perf_counter()
+        try:
+            if cmd_targ == None:
+                cmd_targ = load_openpyxl().load_workbook(cfg_check_cmd, read_only=True)
+            commands = read_profile_commands(cmd_targ, profile)
+            started = timed_step('gen_excel', 'commands loading', started)
+            if not preflight_commands(profile, commands):
+                yield profile, None, None
+                continue
+            matcher = CmdMatcher(commands)
+            if report != None:
+                matcher.instrument()
+                report_commands[profile] = commands
+            timed_step('gen_excel', 'commands compiling', started)
+        except Exception as err:
+            print('Exception while reading commands file '+str(err)+' for profile '+profile)
+            yield profile, None, None
             continue
-        if not profile in profiles_list:
-            profiles_list[profile] = []
-        profiles_list[profile].append(xls_row)
-    dev_targ.close()
+        yield profile, commands, check_profile_devices(profile, commands, matcher, profiles_list[profile], check_cache)
+    if cmd_targ != None:
+        cmd_targ.close()
 
-    if os.path.exists(xls_cfg_miss):
-        targ = openpyxl.load_workbook(xls_cfg_miss)
+def check_profile_devices (profile, commands, matcher, filenames, check_cache):
+    # devices whose config has not changed since the last check, with the same commands, are not checked again
+    cmd_hash = commands_hash(commands)
+    known = {}
+    if profile in check_cache and check_cache[profile]['commands'] == cmd_hash:
+        known = check_cache[profile]['devices']
+    stale = len(check_cache[profile]['devices']) - len(known) if profile in check_cache else 0
+    jobs = [(filename, known[filename][0] if filename in known else None) for filename in filenames]
+
+    # the devices are checked here or in the worker processes, in both cases the presence vectors come back in the
+    # devices order and only this process writes the results
+    if check_workers != 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(check_workers or None, init_check_worker,
+                                    (worker_settings(), commands, report != None))
+        results = pool.imap(check_worker, jobs, chunksize = 4)
     else:
-        targ = openpyxl.Workbook()
+        pool = None
+        results = (check_cfg_file(matcher, filename, known_hash, report != None) for filename, known_hash in jobs)
 
-    for profile in profiles_list:
-        if profile in targ:
-            sheet = targ[profile]
+    devices = {}
+    cache_hits = 0
+    section_hits = 0
+    section_misses = 0
+    for filename, (content_hash, presence, timings, sections) in zip(filenames, results):
+        if timings != None:
+            report.add_device('gen_excel', profile, filename, timings)
+        section_hits += sections[0]
+        section_misses += sections[1]
+        if presence == None:
+            cache_hits += 1
+            found = known[filename][1]
         else:
-            sheet = targ.create_sheet(profile)
+            found = tuple((cmd_index, presence[cmd_index]) for cmd_index in range(len(presence)) if presence[cmd_index])
+        devices[filename] = (content_hash, found)
+        yield os.path.basename(filename).replace('.txt',''), [cmd_index for cmd_index, lines in found]
+    if pool != None:
+        pool.close()
+        pool.join()
+    # the devices left out by dev_filter keep their results for the next runs, only the ones no longer in the
+    # inventory are dropped
+    inventory_files = get_inventory().profile_files(profile)
+    for filename in known:
+        if not filename in devices:
+            if filename in inventory_files:
+                devices[filename] = known[filename]
+            else:
+                stale += 1
+    check_cache[profile] = {'commands': cmd_hash, 'devices': devices}
+    print('Check cache for profile '+profile+': '+str(cache_hits)+' hits, '+str(len(filenames)-cache_hits)+
+          ' misses, '+str(stale)+' stale entries removed; sections already matched on other devices: '+
+          str(section_hits)+' of '+str(section_hits + section_misses))
 
-        commands = []
-        try:
-            cmd_targ = openpyxl.load_workbook(cfg_check_cmd)
-            cmd_sheet = cmd_targ[profile]
-            for cmd_row in range(2, cmd_sheet.max_row+1):
-                cmd_temp = str(cmd_sheet['A'+str(cmd_row)].value).strip()
-                if len(cmd_temp) and cmd_temp!='None':
-                    commands.append(str(cmd_sheet['A'+str(cmd_row)].value).strip())
-        except Exception as err:
-            print('Exception while reading commands file '+str(err)+' for profile '+profile)
+def write_check_excel (phase, profile_names, results, step):
+    """
+    Streams xls_cfg_miss, with the csv files and the snapshot that go with it. profile_names are the profiles written
+    in this run and results yields (profile, commands, devices) for each of them, as check_profiles does. The sheets
+    of the other profiles, and of the profiles whose commands are None, are copied from the previous file. Returns
+    profile -> CheckMatrix of what has been written.
+    """
+    # a write-only workbook can't be changed once saved, so all the sheets are created here in the final order
+    old_targ = None
+    sheet_names = []
+    if os.path.exists(xls_cfg_miss):
+        old_targ = load_openpyxl().load_workbook(xls_cfg_miss, read_only=True)
+        sheet_names = old_targ.sheetnames
+    targ = load_openpyxl().Workbook(write_only=True)
+    sheets = {}
+    for sheet_name in sheet_names + [profile for profile in profile_names if not profile in sheet_names]:
+        sheets[sheet_name] = targ.create_sheet(sheet_name)
+    for sheet_name in sheet_names:
+        if not sheet_name in profile_names:
+            copy_sheet(old_targ[sheet_name], sheets[sheet_name])
+    # the same for the check results of the profiles not checked now, as long as they are the ones in the old file
+    matrices = {}
+    old_snapshot = load_snapshot(check_snapshot, xls_cfg_miss) if check_snapshot and old_targ != None else None
+    if old_snapshot != None:
+        for profile in old_snapshot[1]:
+            if profile in sheets:
+                matrices[profile] = old_snapshot[1][profile]
+    step = timed_step(phase, 'copy of the old sheets', step)
+    if csv_cfg_miss_dir:
+        os.makedirs(csv_cfg_miss_dir, exist_ok=True)
+
+    for profile, commands, devices in results:
+        profile_start = step
+        sheet = sheets[profile]
+        if commands == None:
+            if profile in sheet_names:
+                copy_sheet(old_targ[profile], sheet)
             continue
-        
-        for i in range(0, len(commands)):
-            cell = commands[i].replace(line_break, '\n')
-            sheet[get_column_letter(i+2)+'1'].value = cell
+        matrices.pop(profile, None)
+
+        sheet.append([None] + [cmd.replace(line_break, '\n') for cmd in commands])
+        if csv_cfg_miss_dir:
+            csv_file = open(os.path.join(csv_cfg_miss_dir, profile + '.csv'), 'w', newline='')
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(['Device'] + commands)
 
-        cmd_counter = [0] * len(commands)
+        matrix = CheckMatrix(commands)
         row_counter = 2
-        for i in range(len(profiles_list[profile])):
-            xls_row = profiles_list[profile][i]
-            dir = str(dev_sheet['A'+str(xls_row)].value).strip() + '/'
-            dev = str(dev_sheet['E'+str(xls_row)].value).strip()
-            filename = cfg_root_dir + dir + dev + '.txt'
-            with open(filename, 'r') as file:
-                print('Reading file ' + filename + ' ... ')
-                sheet['A'+str(row_counter)].value = os.path.basename(filename).replace('.txt','')
-                last_spaces = 0
-                last_line = ""
-                parents = []
-                num_spaces = []
-                spaces = 0
-                search_line = ''
-                # reading file line by line
-                for line in file:
-                    if re.search('^\s', line):
-                        spaces = len(re.search("^(\s+)", line).group(1))
-                        #print('Entering line with trailing spaces '+str(spaces)+' last spaces '+str(last_spaces))
-                        if (spaces > last_spaces):
-                            parents.append(last_line.strip())
-                            num_spaces.append(spaces)
-                            last_spaces = spaces
-                            #print('Inside indentation '+last_line)
-                        elif (spaces < last_spaces):
-                            #print('Exiting indentation with line '+line+' spaces '+str(spaces)+' last spaces '+str(last_spaces)+' num_spaces[-1] '+str(num_spaces[-1]))
-                            #print(parents)
-                            #print(num_spaces)
-                            while (len(num_spaces)>0) and num_spaces[-1]>spaces:
-                                #print('Removing from parent stack '+parents[-1])
-                                parents.pop()
-                                num_spaces.pop()
-                                #print(parents)
-                            if not len(num_spaces):
-                                print('WARNING: indentation error at line '+line+' spaces '+spaces+' last spaces '+last_spaces)
-                            last_spaces = spaces
-                    # in this case there are 0 spaces, this is a global config command. Often on Cisco configuration,
-                    # this line can be a "!" line. This works anyway.
-                    else:
-                        while (len(parents)):
-                            parents.pop()
-                            num_spaces.pop()
-                            last_spaces = 0
-                            spaces = 0
-                            last_line = ''
-                    if len(parents):
-                        search_line = line_break.join(parents) + line_break + line.strip()
-                    else:
-                        search_line = line.strip()
-                    #print(search_line)
-                    #print(parents)
-                    for i in range(0, len(commands)):
-                        col_string = get_column_letter(i+2)
-                        commands[i] = commands[i].replace('***',' ')
-                        if re.search(commands[i], search_line) and (commands[i].count(line_break) == search_line.count(line_break)):
-                            sheet[col_string + str(row_counter)].value = 'X'
-                            cmd_counter[i] += 1
-                            break
-                    last_line = line.strip()
-                # print('Reading '+filename+' ...')
-                row_counter += 1
+        for dev, cmd_indexes in devices:
+            row = [None] * len(commands)
+            for cmd_index in cmd_indexes:
+                row[cmd_index] = 'X'
+            matrix.add_device(dev, cmd_indexes)
+            sheet.append([dev] + row)
+            if csv_cfg_miss_dir:
+                csv_writer.writerow([dev] + [cell or '' for cell in row])
+            row_counter += 1
+        if csv_cfg_miss_dir:
+            csv_file.close()
 
         # print the total number of configs that have that command, it's basicly the number of 'X' in every column
+        row = [None]
+        total = len(matrix.devices)
+        cmd_counter = matrix.totals()
         for i in range(0, len(cmd_counter)):
-            cell = get_column_letter(i+2)+str(row_counter)
-            total = len(profiles_list[profile])
-            sheet[cell].value = str(cmd_counter[i]) + ' / ' + str(total)
+            cell = WriteOnlyCell(sheet, value = str(cmd_counter[i]) + ' / ' + str(total))
             if cmd_counter[i] == total:
-                sheet[cell].fill = PatternFill("solid", fgColor="00FF00")
-        
-        print('Writing '+str(sheet.max_row)+' rows of the excel file for profile '+profile)
-        targ.save(xls_cfg_miss)
-        targ.close()
+                cell.fill = PatternFill("solid", fgColor="00FF00")
+            row.append(cell)
+        sheet.append(row)
+        matrices[profile] = matrix
+        compliance = matrix.compliance()
+        print('Written '+str(row_counter)+' rows of the excel file for profile '+profile+', average compliance '+
+              str(round(100 * sum(compliance) / max(1, len(compliance)), 1))+'%')
+        step = time.perf_counter()
+        if report != None:
+            report.profile(phase, profile)['seconds'] += step - profile_start
+
+    if old_targ != None:
+        old_targ.close()
+    print('Saving '+xls_cfg_miss+' ... ')
+    targ.save(xls_cfg_miss)
+    step = timed_step(phase, 'excel saving', step)
+    if check_snapshot:
+        if drift_diff and drift_old_snapshot and os.path.exists(check_snapshot):
+            # the results of the previous run are the ones the drift compares with
+            os.replace(check_snapshot, drift_old_snapshot)
+        save_snapshot(check_snapshot, list(sheets), matrices, xls_cfg_miss)
+        timed_step(phase, 'snapshot saving', step)
+    return matrices
+
+@phase_settings
+def run_gen_excel ():
+    """
+    - we read all the devices belonging to all profiles from the main device database, filters
+    about profiles and devices are already applied in this phase
+    - we stream a new 'xls_cfg_miss' file: for every profile a sheet is written row by row while
+    examining all the devices' config, for each line we check if the required command is present
+    or not. The sheets of the profiles not checked in this run are copied from the previous file.
+    With shard_count > 1 only the devices of the shard are checked, and written in shard_dir.
+    Returns profile -> CheckMatrix of the profiles checked.
+    """
+    phase_start = step = start_phase()
+    # this is a dictionary, the keys being the profiles. The values are
+    # arrays containing the devices' config files.
+    profiles_list = get_inventory().profile_configs(dev_filter)
+    step = timed_step('gen_excel', 'inventory', step)
+    if shard_count > 1 and not 0 <= shard_index < shard_count:
+        print('ERROR, shard_index must be between 0 and '+str(shard_count - 1))
+        end_phase('gen_excel', phase_start)
+        return None
+    check_cache = load_check_cache()
+    for profile in list(check_cache):
+        if not profile in get_inventory().by_profile:
+            # no device has this profile any more
+            del check_cache[profile]
+    step = timed_step('gen_excel', 'check cache', step)
+    if shard_count > 1:
+        matrices = write_shard(profiles_list, check_cache, step)
+    else:
+        matrices = write_check_excel('gen_excel', list(profiles_list), check_profiles(profiles_list, check_cache), step)
+    step = time.perf_counter()
+    save_check_cache(check_cache)
+    timed_step('gen_excel', 'check cache', step)
+    end_phase('gen_excel', phase_start)
+    return matrices
+
+def shard_of (dev):
+    """ The shard of a device, from a hash of its name that is the same on every machine and in every run """
+    return zlib.crc32(dev.encode()) % shard_count
+
+def shard_file (index):
+    return os.path.join(shard_dir, 'shard_' + str(index) + '_of_' + str(shard_count) + '.part')
+
+def write_shard (profiles_list, check_cache, step):
+    """
+    The gen_excel of a shard: only the devices of the shard are checked, and their results are written in shard_dir
+    together with the position of every device in its profile, so that merge_shards puts them back in order.
+    Returns profile -> CheckMatrix of the devices of the shard.
+    """
+    shard_list = {}
+    positions = {}
+    for profile in profiles_list:
+        filenames = profiles_list[profile]
+        positions[profile] = [k for k in range(len(filenames))
+                              if shard_of(os.path.basename(filenames[k]).replace('.txt','')) == shard_index]
+        shard_list[profile] = [filenames[k] for k in positions[profile]]
+    profiles = {}
+    matrices = {}
+    for profile, commands, devices in check_profiles(shard_list, check_cache):
+        if commands == None:
+            continue
+        matrix = CheckMatrix(commands)
+        for dev, cmd_indexes in devices:
+            matrix.add_device(dev, cmd_indexes)
+        matrices[profile] = matrix
+        profiles[profile] = {'positions': positions[profile], 'total': len(profiles_list[profile]),
+                             'matrix': matrix.pack()}
+        print('Checked '+str(len(matrix.devices))+' of the '+str(len(profiles_list[profile]))+' devices of profile '+
+              profile+' in shard '+str(shard_index)+' of '+str(shard_count))
+    step = timed_step('gen_excel', 'devices check', step)
+    # all the shards of a run check the same devices with the same commands, whatever machine they run on
+    run = [shard_run_id, shard_count]
+    for profile in profiles_list:
+        run.append([profile, [os.path.basename(filename).replace('.txt','') for filename in profiles_list[profile]],
+                    profiles[profile]['matrix']['commands'] if profile in profiles else None])
+    run = hashlib.sha1(json.dumps(run).encode()).hexdigest()
+    part = {'version': 2, 'shard': shard_index, 'shards': shard_count, 'run': run,
+            'created': datetime.datetime.now().isoformat(), 'order': list(profiles_list), 'profiles': profiles}
+    os.makedirs(shard_dir, exist_ok=True)
+    filename = shard_file(shard_index)
+    save_json(filename, part)
+    print('Written the results of shard '+str(shard_index)+' in '+filename)
+    timed_step('gen_excel', 'shard saving', step)
+    return matrices
+
+def load_shards ():
+    """
+    Returns (profiles, profile -> CheckMatrix, shard files) with the results of all the shards found in shard_dir,
+    every device in the position it has in the inventory, or None when some shard is missing or the shards are not
+    all of the same run.
+    """
+    parts = {}
+    files = []
+    count = None
+    names = sorted(os.listdir(shard_dir)) if os.path.isdir(shard_dir) else []
+    for name in names:
+        if not name.endswith('.part'):
+            continue
+        try:
+            with open(os.path.join(shard_dir, name), 'r') as file:
+                part = json.load(file)
+        except Exception as err:
+            print('ERROR, could not read the shard '+name+', '+str(err))
+            return None
+        if part.get('version') != 2:
+            print('ERROR, unknown format of the shard '+name)
+            return None
+        if count == None:
+            count = part['shards']
+        if part['shards'] != count:
+            print('ERROR, '+shard_dir+' has shards of '+str(count)+' and of '+str(part['shards'])+' runs')
+            return None
+        parts[part['shard']] = part
+        files.append(os.path.join(shard_dir, name))
+    if count == None:
+        print('ERROR, no shard found in '+shard_dir)
+        return None
+    missing = [str(index) for index in range(count) if not index in parts]
+    if len(missing):
+        print('ERROR, missing the results of the shards '+', '.join(missing)+' of '+str(count))
+        return None
+    runs = {}
+    for index in range(count):
+        runs.setdefault(parts[index]['run'], []).append(str(index))
+    if len(runs) > 1:
+        print('ERROR, the shards in '+shard_dir+' are not of the same run: '+
+              ' and '.join(', '.join(indexes) for indexes in runs.values())+', they are not merged')
+        return None
+
+    profiles = []
+    for index in range(count):
+        for profile in parts[index]['order']:
+            if not profile in profiles:
+                profiles.append(profile)
+    matrices = {}
+    for profile in profiles:
+        pieces = [parts[index]['profiles'][profile] for index in range(count) if profile in parts[index]['profiles']]
+        if len(pieces) < count:
+            # its commands could not be read by some shard, the old sheet is kept
+            print('WARNING: profile '+profile+' is missing in '+str(count - len(pieces))+' shards, not merged')
+            continue
+        rows = []
+        commands = None
+        for piece in pieces:
+            matrix = CheckMatrix.unpack(piece['matrix'])
+            if commands == None:
+                commands = matrix.commands
+            if matrix.commands != commands:
+                print('ERROR, the shards of profile '+profile+' were checked with different commands')
+                return None
+            rows += zip(piece['positions'], matrix.devices, matrix.rows)
+        rows.sort(key=lambda row: row[0])
+        matrices[profile] = CheckMatrix(commands, [row[1] for row in rows], [row[2] for row in rows])
+    return profiles, matrices, files
+
+@phase_settings
+def run_merge_shards ():
+    """
+    Writes xls_cfg_miss, with its csv files and snapshot, from the results of all the shards in shard_dir. Returns
+    profile -> CheckMatrix of the profiles merged, None when the shards can't be merged.
+    """
+    phase_start = step = start_phase()
+    shards = load_shards()
+    if shards == None:
+        end_phase('merge_shards', phase_start)
+        return None
+    profiles, matrices, files = shards
+    print('Merging '+str(len(matrices))+' profiles from '+shard_dir)
+    step = timed_step('merge_shards', 'shards loading', step)
+    results = ((profile, matrices[profile].commands,
+                zip(matrices[profile].devices, (list(set_bits(bits)) for bits in matrices[profile].rows)))
+               for profile in matrices)
+    write_check_excel('merge_shards', list(matrices), results, step)
+    # the shards are merged only once, the next merge needs the results of a new run
+    for filename in files:
+        os.remove(filename)
+    end_phase('merge_shards', phase_start)
+    return matrices
+
+var_regex = re.compile('\$\((.*?)\)')
+ip_math_regex = re.compile('((\d+\.\d+\.\d+\.\d+)\s*?([+|-])\s*(\d+))')
+# (ip, operator, number) -> resulting ip address, None when it's not an ip address
+ip_math_results = {}
 
 def fill_cmd_with_vars (dev, cmd, vars):
     """
@@ -370,34 +2301,132 @@ def fill_cmd_with_vars (dev, cmd, vars):
     This can be useful for static routes with the next hop being based on the interface's ip, that
     has been defined as a variable in the proper tab.
     """
-    if not re.search('\$\(.*?\)', cmd):
+    if not var_regex.search(cmd):
         return cmd
     if not dev in vars:
         return None
-    all_vars = re.findall('\$\((.*?)\)', cmd)
+    all_vars = var_regex.findall(cmd)
     for var in all_vars:
         if not var in vars[dev]:
             print('ERROR, could not find value for var '+var+' for device '+dev)
             return None
         else:
             cmd = cmd.replace('$('+var+')', vars[dev][var])
-    
-    # Ip addresses retrieval, replacement and math operations
-    if re.search('\d+\.\d+\.\d+\.\d+\s*[+|-]\s*\d+', cmd):
-        all_vars = re.findall('((\d+\.\d+\.\d+\.\d+)\s*?([+|-])\s*(\d+))', cmd)
-        for var in all_vars:
+    return ip_arithmetic(dev, cmd)
+
+def ip_arithmetic (dev, cmd):
+    """ Ip addresses retrieval, replacement and math operations of fill_cmd_with_vars, once the variables are replaced """
+    for var in ip_math_regex.findall(cmd):
+        key = var[1:]
+        if key in ip_math_results:
+            ip = ip_math_results[key]
+        else:
             try:
                 if var[2]=='+':
-                    ip = IPv4Address(var[1]) + (int)(var[3])
+                    ip = str(IPv4Address(var[1]) + (int)(var[3]))
                 else:
-                    ip = IPv4Address(var[1]) - (int)(var[3])
-                cmd = cmd.replace(var[0], str(ip))
+                    ip = str(IPv4Address(var[1]) - (int)(var[3]))
             except ValueError:
-                print("Device "+dev+" detected something that looks like an ip address, but it's not: " + var[1])
+                ip = None
+            ip_math_results[key] = ip
+        if ip == None:
+            print("Device "+dev+" detected something that looks like an ip address, but it's not: " + var[1])
+        else:
+            cmd = cmd.replace(var[0], ip)
     return cmd
 
+def fix_lines (cmd):
+    """ the lines to be sent for a fix command: its lines, followed by an 'exit' for every line after the first one """
+    cmd_list = cmd.split('\n')
+    if len(cmd_list)>1:
+        for k in range(len(cmd_list)-1):
+            cmd_list.append('exit')
+    return cmd_list
 
-if fix_cfg:
+class FixCommand:
+    """
+    An add/change command of cfg_check_cmd, compiled once for all the devices of the profile: the text is split around
+    its $(var_name) variables, so that for every device the pieces are only joined with the device's values, and the
+    places where an ip address addition/subtraction could be found are known in advance, so that the ip addresses are
+    looked for only there. The lines are the same of fill_cmd_with_vars, which is still used when a value could build
+    another variable together with the text around it.
+    """
+    def __init__ (self, cmd):
+        self.cmd = cmd
+        pieces = var_regex.split(cmd)
+        self.texts = pieces[0::2]
+        self.names = pieces[1::2]
+        # a command without variables has the same lines for every device
+        self.lines = None if self.names else fix_lines(cmd)
+        self.simple = not any('$' in name for name in self.names)
+        # '+', '-' or '|' with digits or variables on both sides, the variables standing for anything
+        self.ip_math = re.search('[\d\x00]\s*[+|-]\s*[\d\x00]', '\x00'.join(self.texts)) != None
+
+    def render (self, dev, vars):
+        """ the lines of the command for the device, None when the device misses some of the variables """
+        if self.lines != None:
+            return self.lines
+        if not dev in vars:
+            return None
+        dev_vars = vars[dev]
+        ip_math = self.ip_math
+        pieces = [self.texts[0]]
+        for k in range(len(self.names)):
+            value = dev_vars.get(self.names[k])
+            if value == None:
+                print('ERROR, could not find value for var '+self.names[k]+' for device '+dev)
+                return None
+            if not self.simple or '$' in value or value.startswith('('):
+                cmd = fill_cmd_with_vars(dev, self.cmd, vars)
+                return None if cmd == None else fix_lines(cmd)
+            if not ip_math and ('+' in value or '-' in value or '|' in value):
+                ip_math = True
+            pieces.append(value)
+            pieces.append(self.texts[k+1])
+        cmd = ''.join(pieces)
+        if ip_math:
+            cmd = ip_arithmetic(dev, cmd)
+        return fix_lines(cmd)
+
+
+def sheet_rows (sheet):
+    """
+    Yields the header of a sheet of xls_cfg_miss and then, for every row, (excel row, device, present) where
+    present(column) tells whether the command of that column of the sheet is found on the device
+    """
+    cmd_row = 0
+    for row in sheet.iter_rows(values_only=True):
+        cmd_row += 1
+        if cmd_row == 1:
+            yield [str(cell).strip() for cell in row]
+            continue
+        yield cmd_row, str(row_value(row, 'A')).strip(), lambda cmd_col, row=row: cmd_col < len(row) and row[cmd_col] != None
+
+def matrix_rows (matrix):
+    """ The same as sheet_rows, for the CheckMatrix of the profile taken from the snapshot """
+    yield ['None'] + [cmd.replace(line_break, '\n').strip() for cmd in matrix.commands]
+    for dev_index in range(len(matrix.devices)):
+        yield (dev_index + 2, str(matrix.devices[dev_index]).strip(),
+               lambda cmd_col, bits=matrix.rows[dev_index]: (bits >> (cmd_col - 1)) & 1 == 1)
+
+def clear_fix_plan_dir ():
+    # a device fixed since the previous run must not find its old commands there, they would be pushed again
+    os.makedirs(fix_plan_dir, exist_ok=True)
+    for name in os.listdir(fix_plan_dir):
+        if name.endswith('.txt'):
+            os.remove(os.path.join(fix_plan_dir, name))
+
+def write_fix_plan (dev, profile, cmd_list, plan_file, planned):
+    """ Writes the commands of the device in fix_plan_dir and in the json lines plan_file, planned are the devices already written """
+    if fix_plan_dir:
+        with open(os.path.join(fix_plan_dir, dev + '.txt'), 'a' if dev in planned else 'w') as file:
+            file.write('\n'.join(cmd_list) + '\n')
+    if plan_file != None:
+        plan_file.write(json.dumps({'device': dev, 'profile': profile, 'commands': cmd_list}) + '\n')
+    planned.add(dev)
+
+@phase_settings
+def run_fix_cfg ():
     """ to fix stuff, we read the output excel file and check the columns, and the presence of the config command.
     We read the cfg_check_cmd file and:
     - if there is a 'add command' in column 'B', we simply add this command in case it's missing
@@ -408,77 +2437,110 @@ if fix_cfg:
     The above approach is due to the fact that if a command is not present but we used a regexp to make the check, we can't
     replace it with something known, so it must be specified.
     """
+    phase_start = step = start_phase()
     print('Loading commands to be used for the configuration fixes')
     prof_fix_add_cmd = {}
     prof_fix_rem_cmd = {}
-    targ = openpyxl.load_workbook(cfg_check_cmd)
+    targ = load_openpyxl().load_workbook(cfg_check_cmd, read_only=True)
     sheet_names = targ.sheetnames
     for profile_sheet in sheet_names:
         if not profile_sheet in prof_fix_add_cmd:
             prof_fix_add_cmd[profile_sheet] = {}
             prof_fix_rem_cmd[profile_sheet] = {}
         if re.search(profiles_filter, profile_sheet):
-            sheet = targ[profile_sheet]
-            for xls_row in range(2, sheet.max_row+1):
-                orig_cmd = str(sheet['A'+str(xls_row)].value).strip().replace(line_break,'\n')
-                if sheet['B'+str(xls_row)].value != None and len(str(sheet['B'+str(xls_row)].value).strip()):
-                    if sheet['C'+str(xls_row)].value != None and len(str(sheet['C'+str(xls_row)].value).strip()):
+            xls_row = 1
+            for row in targ[profile_sheet].iter_rows(min_row=2, values_only=True):
+                xls_row += 1
+                add_cmd = row_value(row, 'B')
+                rem_cmd = row_value(row, 'C')
+                orig_cmd = str(row_value(row, 'A')).strip().replace(line_break,'\n')
+                if add_cmd != None and len(str(add_cmd).strip()):
+                    if rem_cmd != None and len(str(rem_cmd).strip()):
                         print('ERROR on line '+str(xls_row)+' profile '+profile_sheet+" columns B and C can't be both full")
                         continue
-                    new_cmd = str(sheet['B'+str(xls_row)].value).strip().replace(line_break,'\n')
+                    new_cmd = str(add_cmd).strip().replace(line_break,'\n')
                     new_cmd = re.sub('\$$', '', new_cmd)
                     prof_fix_add_cmd[profile_sheet][orig_cmd] = new_cmd
-                    #print(sheet['B'+str(xls_row)].value)
-                if sheet['C'+str(xls_row)].value != None and len(str(sheet['C'+str(xls_row)].value).strip()):
-                    new_cmd = str(sheet['C'+str(xls_row)].value).strip().replace(line_break,'\n')
+                if rem_cmd != None and len(str(rem_cmd).strip()):
+                    new_cmd = str(rem_cmd).strip().replace(line_break,'\n')
                     new_cmd = re.sub('\$$', '', new_cmd)
                     prof_fix_rem_cmd[profile_sheet][orig_cmd] = new_cmd
 
     # let's read all the device specific variables and their values
     vars = {}
-    sheet = targ['VARS']
-    for xls_row in range(2, sheet.max_row+1):
-        dev = str(sheet['A'+str(xls_row)].value).strip()
-        var_name = str(sheet['B'+str(xls_row)].value).strip()
-        var_value = str(sheet['C'+str(xls_row)].value)
+    for row in targ['VARS'].iter_rows(min_row=2, values_only=True):
+        dev = str(row_value(row, 'A')).strip()
+        var_name = str(row_value(row, 'B')).strip()
+        var_value = str(row_value(row, 'C'))
         if len(dev):
             if not dev in vars:
                 vars[dev] = {}
             vars[dev][var_name] = var_value
     # print(vars)
     targ.close()
+    step = timed_step('fix_cfg', 'commands loading', step)
     #print(prof_fix_add_cmd)
     #print(prof_fix_rem_cmd)
 
     # now we should store the rows for all the devices' names, and then we can start parsing the output file with the
     # potentially missing configurations
     print('Loading devices connection details ... ')
-    dev_targ = openpyxl.load_workbook(xls_ip_devices)
-    dev_sheet = dev_targ['Devices']
     dev_list = {}
-    for xls_row in range(2, dev_sheet.max_row+1):
-        profile = str(dev_sheet['P'+str(xls_row)].value).strip()
-        dev = str(dev_sheet['E'+str(xls_row)].value).strip()
+    for xls_row, dir, dev, profile in get_inventory().rows:
         if profile == 'None' or len(profile) == 0 or not re.search(profiles_filter, profile):
             continue
         if dev in dev_list:
             print('Duplicated device name for '+dev+', we skip it')
             continue
         dev_list[dev] = xls_row
+    step = timed_step('fix_cfg', 'inventory', step)
 
     print('Reading the fixing config file ... ')
     devices_commands = {}
-    cmd_targ = openpyxl.load_workbook(xls_cfg_miss)
-    sheet_names = cmd_targ.sheetnames
+    # the commands of every device are written in the fix plan as soon as its row is read
+    plan_file = open(fix_plan_file, 'w') if fix_plan_file else None
+    planned = set()
+    if fix_plan_dir:
+        clear_fix_plan_dir()
+    # the check results are taken from the snapshot when it's the one of xls_cfg_miss, the excel file is read only for
+    # the profiles missing in the snapshot
+    snapshot = load_snapshot(check_snapshot, xls_cfg_miss) if check_snapshot else None
+    cmd_targ = None
+    if snapshot != None:
+        print('Using the check results in '+check_snapshot)
+        sheet_names, matrices = snapshot
+    else:
+        matrices = {}
+        cmd_targ = load_openpyxl().load_workbook(xls_cfg_miss, read_only=True)
+        sheet_names = cmd_targ.sheetnames
+    step = timed_step('fix_cfg', 'excel loading', step)
     for profile in sheet_names:
         if not re.search(profiles_filter, profile):
             continue
-        cmd_sheet = cmd_targ[profile]
-        print('Reading the '+profile+' tab, rows '+str(cmd_sheet.max_row)+' columns '+str(cmd_sheet.max_column)+' ... ')
-        for cmd_row in range(2, cmd_sheet.max_row+1):
+        profile_start = time.perf_counter()
+        print('Reading the '+profile+' tab ... ')
+        if profile in matrices:
+            rows = matrix_rows(matrices[profile])
+        else:
+            if cmd_targ == None:
+                cmd_targ = load_openpyxl().load_workbook(xls_cfg_miss, read_only=True)
+            rows = sheet_rows(cmd_targ[profile])
+        header = next(rows, [])
+        # only the columns with a fix command are looked at, with the fix commands compiled once for all the devices
+        add_cmd = prof_fix_add_cmd.get(profile, {})
+        rem_cmd = prof_fix_rem_cmd.get(profile, {})
+        fix_cols = []
+        for cmd_col in range(1, len(header)):
+            cmd_2_check = header[cmd_col]
+            if cmd_2_check in add_cmd or cmd_2_check in rem_cmd:
+                # We avoid using string.replace because it could lead to unexpected results, we use again
+                # a regular expression, and we replace only strings ending with a dollar.
+                fix_cols.append((cmd_col,
+                                 FixCommand(re.sub('\$$', '', add_cmd[cmd_2_check])) if cmd_2_check in add_cmd else None,
+                                 FixCommand(re.sub('\$$', '', rem_cmd[cmd_2_check])) if cmd_2_check in rem_cmd else None))
+        for cmd_row, dev, present in rows:
             if (cmd_row%100 == 0):
                 print(' ... read '+str(cmd_row)+' lines')
-            dev = str(cmd_sheet['A'+str(cmd_row)].value).strip()
             if not re.search(dev_filter, dev) or dev == 'None':
                 continue
             #print('Row '+str(cmd_row)+' for device '+dev)
@@ -487,52 +2549,643 @@ if fix_cfg:
                 continue
             if not dev in devices_commands:
                 devices_commands[dev] = []
+            dev_commands = devices_commands[dev]
+            first = len(dev_commands)
             # Now we cycle on the columns. We have basicly two types of commands:
             # 1 - missing commands that need to be added on devices where they are missing
             # 2 - wrong commands that need to be removed/cleaned/changed when they are present
-            for cmd_col in range(2, cmd_sheet.max_column+1):
-                #print(str(cmd_sheet[get_column_letter(cmd_col)+str(cmd_row)].value))
-                cmd_2_check = str(cmd_sheet[get_column_letter(cmd_col)+'1'].value).strip()
-                if cmd_sheet[get_column_letter(cmd_col)+str(cmd_row)].value == None:
-                    #print('Checking command "'+cmd_2_check+'"')
-                    if not cmd_2_check in prof_fix_add_cmd[profile]:
-                        continue
-                    # We avoid using string.replace because it could lead to unexpected results, we use again
-                    # a regular expression, and we replace only strings ending with a dollar. 
-                    cmd = re.sub('\$$', '', prof_fix_add_cmd[profile][cmd_2_check])
-                    cmd = fill_cmd_with_vars(dev, cmd, vars)
-                    if cmd == None:
+            for cmd_col, add_fix, rem_fix in fix_cols:
+                fix = rem_fix if present(cmd_col) else add_fix
+                if fix == None:
+                    continue
+                cmd_list = fix.render(dev, vars)
+                if cmd_list != None:
+                    dev_commands.extend(cmd_list)
+            if len(dev_commands) > first:
+                write_fix_plan(dev, profile, dev_commands[first:], plan_file, planned)
+        if report != None:
+            report.profile('fix_cfg', profile)['seconds'] += time.perf_counter() - profile_start
+    if cmd_targ != None:
+        cmd_targ.close()
+    if plan_file != None:
+        plan_file.close()
+
+    if fix_plan_dir or fix_plan_file:
+        print('\nCommands to be executed on '+str(len(planned))+' devices written to '+' and '.join([name for name in (fix_plan_dir, fix_plan_file) if name]))
+    else:
+        print('\nList of commands to be executed on '+str(len(devices_commands))+' devices ...\n')
+        for dev in devices_commands:
+            if len(devices_commands[dev]):
+                print('\n\nCommands on '+dev+':')
+                print(devices_commands[dev])
+    end_phase('fix_cfg', phase_start)
+    return devices_commands
+
+@phase_settings
+def run_drift_diff ():
+    """
+    Writes in drift_file the (profile, device, command, change) lines for everything that changed between
+    drift_old_snapshot and check_snapshot, for the profiles matching profiles_filter and the devices matching
+    dev_filter. Returns the number of changes.
+    """
+    phase_start = start_phase()
+    old_snapshot = load_snapshot(drift_old_snapshot)
+    new_snapshot = load_snapshot(check_snapshot)
+    if old_snapshot == None or new_snapshot == None:
+        print('ERROR, the drift needs both '+drift_old_snapshot+' and '+check_snapshot)
+        end_phase('drift_diff', phase_start)
+        return None
+    old_matrices = old_snapshot[1]
+    new_matrices = new_snapshot[1]
+    changes = 0
+    with open(drift_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Profile', 'Device', 'Command', 'Change'])
+        for profile in new_matrices:
+            if not re.search(profiles_filter, profile):
+                continue
+            if not profile in old_matrices:
+                print('Profile '+profile+' is new, not compared')
+                continue
+            old = old_matrices[profile]
+            new = new_matrices[profile]
+            old_commands = set(old.commands)
+            new_commands = set(new.commands)
+            added = [cmd for cmd in new.commands if not cmd in old_commands]
+            removed = [cmd for cmd in old.commands if not cmd in new_commands]
+            if len(added) or len(removed):
+                print('Profile '+profile+': '+str(len(added))+' commands added and '+str(len(removed))+
+                      ' removed from the template, they are not compared')
+            profile_changes = 0
+            for dev, cmd, change in matrix_drift(old, new):
+                if not re.search(dev_filter, dev):
+                    continue
+                writer.writerow([profile, dev, cmd, change])
+                profile_changes += 1
+            print('Profile '+profile+': '+str(profile_changes)+' changes')
+            changes += profile_changes
+        for profile in old_matrices:
+            if not profile in new_matrices and re.search(profiles_filter, profile):
+                print('Profile '+profile+' is not in '+check_snapshot+' anymore, not compared')
+    print('Written '+str(changes)+' changes in '+drift_file)
+    end_phase('drift_diff', phase_start)
+    return changes
+
+def config_signature (filename):
+    """ Returns (file, mtime, size) of a config file on disk, or of its .gz copy, None when there is none """
+    for name in (filename, filename + '.gz'):
+        try:
+            stat = os.stat(name)
+            return (name, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+    return None
+
+class CheckWatcher:
+    """
+    The check results of every profile kept in memory by the watch mode, with the commands compiled once: only the
+    devices whose config file changes are checked again, and their row of the profile's CheckMatrix is replaced.
+    The queries of the http server are answered from here, 'lock' is held while the results are changed.
+    """
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.sources = {}
+        self.device_profile = {}
+        self.checked = {}
+        self.check_cache = {}
+        self.sheets = []
+        self.other_matrices = {}
+        self.last_scan = None
+
+    def load (self):
+        """ Loads the inventory and the commands, and checks every device (the unchanged ones through the cache) """
+        global inventory, config_source
+        inventory = None
+        config_source = None
+        self.sources = {}
+        for filename in (xls_ip_devices, cfg_check_cmd, cfg_archive):
+            if filename:
+                self.sources[filename] = excel_signature(filename)
+        profiles_list = get_inventory().profile_configs(dev_filter, existing = False)
+        check_cache = load_check_cache()
+        profiles = {}
+        cmd_targ = load_openpyxl().load_workbook(cfg_check_cmd, read_only=True)
+        for profile in profiles_list:
+            if not profile in cmd_targ.sheetnames:
+                print('WARNING: no commands for profile '+profile+' in '+cfg_check_cmd)
+                continue
+            commands = read_profile_commands(cmd_targ, profile)
+            if not preflight_commands(profile, commands):
+                continue
+            state = {'commands': commands, 'matcher': CmdMatcher(commands), 'matrix': CheckMatrix(commands),
+                     'cmd_index': dict((commands[k], k) for k in range(len(commands))), 'files': {}, 'rows': {},
+                     'cache': {'commands': commands_hash(commands), 'devices': {}}}
+            if profile in check_cache and check_cache[profile]['commands'] == state['cache']['commands']:
+                state['cache']['devices'] = check_cache[profile]['devices']
+            for filename in profiles_list[profile]:
+                if cfg_archive:
+                    # the files of an archive are not looked at one by one, the whole archive is
+                    state['files'][filename] = 'archive'
+                    if not get_config_source().exists(filename):
                         continue
-                    #print('Found fix command '+cmd)
-                    cmd_list = cmd.split('\n')
-                    if len(cmd_list)>1:
-                        for k in range(len(cmd_list)-1):
-                            cmd_list.append('exit')
-                    for k in range(0, len(cmd_list)):
-                        devices_commands[dev].append(cmd_list[k])
                 else:
-                    #print('Checking command "'+cmd_2_check+'"')
-                    if not cmd_2_check in prof_fix_rem_cmd[profile]:
+                    state['files'][filename] = config_signature(filename)
+                    if state['files'][filename] == None:
                         continue
-                    # We avoid using string.replace because it could lead to unexpected results, we use again
-                    # a regular expression, and we replace only strings ending with a dollar. 
-                    cmd = re.sub('\$$', '', prof_fix_rem_cmd[profile][cmd_2_check])
-                    cmd = fill_cmd_with_vars(dev, cmd, vars)
-                    if cmd == None:
-                        continue
-                    # print('Found fix command '+cmd)
-                    cmd_list = cmd.split('\n')
-                    if len(cmd_list)>1:
-                        for k in range(len(cmd_list)-1):
-                            cmd_list.append('exit')
-                    for k in range(0, len(cmd_list)):
-                        devices_commands[dev].append(cmd_list[k])
-    
-    print('\nList of commands to be executed on '+str(len(devices_commands))+' devices ...\n')
-    for dev in devices_commands:
-        if len(devices_commands[dev]):
-            print('\n\nCommands on '+dev+':')
-            print(devices_commands[dev])
+                self.add_device(state, filename, self.check_device(state, filename))
+            profiles[profile] = state
+            compliance = state['matrix'].compliance()
+            print('Profile '+profile+': '+str(len(compliance))+' devices, average compliance '+
+                  str(round(100 * sum(compliance) / max(1, len(compliance)), 1))+'%')
+        cmd_targ.close()
+
+        # the profiles not watched are kept in the snapshot as they are in xls_cfg_miss
+        snapshot = load_snapshot(check_snapshot, xls_cfg_miss) if check_snapshot else None
+        with self.lock:
+            self.profiles = profiles
+            self.device_profile = {}
+            for profile in profiles:
+                for dev in profiles[profile]['rows']:
+                    if not dev in self.device_profile:
+                        self.device_profile[dev] = profile
+            self.sheets = list(snapshot[0]) if snapshot != None else []
+            self.sheets += [profile for profile in profiles if not profile in self.sheets]
+            self.other_matrices = {}
+            if snapshot != None:
+                for profile in snapshot[1]:
+                    if not profile in profiles:
+                        self.other_matrices[profile] = snapshot[1][profile]
+            self.check_cache = check_cache
+        self.save()
+
+    def check_device (self, state, filename):
+        """ Returns the indexes of the commands found in the config file, checking it only when its content changed """
+        known = state['cache']['devices'].get(filename)
+        content_hash, presence, timings, sections = check_cfg_file(state['matcher'], filename,
+                                                                   known[0] if known else None)
+        if presence != None:
+            found = tuple((cmd_index, presence[cmd_index]) for cmd_index in range(len(presence)) if presence[cmd_index])
+            state['cache']['devices'][filename] = (content_hash, found)
+        return [cmd_index for cmd_index, lines in state['cache']['devices'][filename][1]]
+
+    def add_device (self, state, filename, cmd_indexes):
+        dev = os.path.basename(filename).replace('.txt','')
+        matrix = state['matrix']
+        with self.lock:
+            if dev in state['rows']:
+                bits = 0
+                for cmd_index in cmd_indexes:
+                    bits |= 1 << cmd_index
+                matrix.rows[state['rows'][dev]] = bits
+                matrix.cols = None
+            else:
+                state['rows'][dev] = len(matrix.devices)
+                matrix.add_device(dev, cmd_indexes)
+            self.checked[dev] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def remove_device (self, state, filename):
+        dev = os.path.basename(filename).replace('.txt','')
+        matrix = state['matrix']
+        with self.lock:
+            if not dev in state['rows']:
+                return
+            dev_index = state['rows'].pop(dev)
+            del matrix.devices[dev_index]
+            del matrix.rows[dev_index]
+            matrix.cols = None
+            for other in state['rows']:
+                if state['rows'][other] > dev_index:
+                    state['rows'][other] -= 1
+            state['cache']['devices'].pop(filename, None)
+            self.checked.pop(dev, None)
+
+    def scan (self):
+        """ Checks again the changed config files, returns the number of devices changed """
+        self.last_scan = datetime.datetime.now().isoformat(timespec='seconds')
+        for filename in self.sources:
+            try:
+                changed = excel_signature(filename) != self.sources[filename]
+            except OSError:
+                # being written right now, it's looked at again the next time
+                return 0
+            if changed:
+                print(filename+' has changed, loading everything again ... ')
+                self.load()
+                return -1
+        changes = 0
+        for profile in self.profiles:
+            state = self.profiles[profile]
+            for filename in state['files']:
+                if cfg_archive:
+                    break
+                signature = config_signature(filename)
+                if signature == state['files'][filename]:
+                    continue
+                state['files'][filename] = signature
+                changes += 1
+                if signature == None:
+                    print('Config removed: '+filename)
+                    self.remove_device(state, filename)
+                    continue
+                try:
+                    self.add_device(state, filename, self.check_device(state, filename))
+                except OSError as err:
+                    # removed or renamed while being read, it will be seen again
+                    state['files'][filename] = None
+                    print('WARNING: could not read '+filename+', '+str(err))
+        if changes:
+            self.save()
+        return changes
+
+    def save (self):
+        with self.lock:
+            matrices = dict(self.other_matrices)
+            for profile in self.profiles:
+                matrices[profile] = self.profiles[profile]['matrix']
+                self.check_cache[profile] = self.profiles[profile]['cache']
+            if watch_snapshot:
+                save_snapshot(watch_snapshot, self.sheets, matrices)
+            save_check_cache(self.check_cache)
+
+    def profiles_info (self):
+        with self.lock:
+            info = {}
+            for profile in self.profiles:
+                compliance = self.profiles[profile]['matrix'].compliance()
+                info[profile] = {'devices': len(compliance), 'commands': len(self.profiles[profile]['commands']),
+                                 'compliance': round(100 * sum(compliance) / max(1, len(compliance)), 2)}
+            return {'last_scan': self.last_scan, 'profiles': info}
+
+    def device_info (self, dev):
+        with self.lock:
+            profile = self.device_profile.get(dev)
+            if profile == None or not dev in self.profiles[profile]['rows']:
+                return None
+            state = self.profiles[profile]
+            bits = state['matrix'].rows[state['rows'][dev]]
+            commands = state['commands']
+            missing = [commands[cmd_index] for cmd_index in range(len(commands)) if not (bits >> cmd_index) & 1]
+            return {'device': dev, 'profile': profile, 'checked': self.checked.get(dev),
+                    'compliance': round(100 * (len(commands) - len(missing)) / max(1, len(commands)), 2),
+                    'commands': len(commands), 'missing': missing}
+
+    def missing_devices (self, command, profile = None):
+        with self.lock:
+            devices = {}
+            for name in self.profiles:
+                if profile != None and name != profile or not command in self.profiles[name]['cmd_index']:
+                    continue
+                devices[name] = self.profiles[name]['matrix'].missing(self.profiles[name]['cmd_index'][command])
+            if not len(devices):
+                return None
+            return {'command': command, 'profiles': devices}
+
+class WatchHandler:
+    """
+    Answers the queries of the watch mode with json, from the CheckWatcher in 'watcher'. watch_server() mixes it with
+    http.server.BaseHTTPRequestHandler, so that http.server is imported by the watch mode only.
+    """
+    watcher = None
+
+    def do_GET (self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/profiles':
+            answer = self.watcher.profiles_info()
+        elif url.path == '/device' and 'name' in query:
+            answer = self.watcher.device_info(query['name'][0])
+        elif url.path == '/missing' and 'command' in query:
+            answer = self.watcher.missing_devices(query['command'][0], query.get('profile', [None])[0])
+        else:
+            self.reply(400, {'error': 'use /profiles, /device?name=D or /missing?command=C&profile=P'})
+            return
+        if answer == None:
+            self.reply(404, {'error': 'not found'})
+        else:
+            self.reply(200, answer)
+
+    def reply (self, status, answer):
+        body = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        pass
+
+def watch_server (watcher, port):
+    import http.server
+    handler = type('WatchRequestHandler', (WatchHandler, http.server.BaseHTTPRequestHandler), {'watcher': watcher})
+    return http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+@phase_settings
+def run_watch ():
+    """ The watch mode: checks again the changed devices every watch_interval seconds, until interrupted """
+    watcher = CheckWatcher()
+    watcher.load()
+    server = None
+    if watch_port:
+        server = watch_server(watcher, watch_port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('Answering the queries on http://127.0.0.1:'+str(watch_port))
+    print('Watching the config files every '+str(watch_interval)+' seconds, ctrl-c to stop')
+    try:
+        while True:
+            time.sleep(watch_interval)
+            changes = watcher.scan()
+            if changes > 0:
+                print(str(changes)+' devices checked again')
+    except KeyboardInterrupt:
+        print('Watch stopped')
+    finally:
+        if server != None:
+            server.shutdown()
+            server.server_close()
+
+# the settings at the beginning of this file, that configure() and the command line can change
+setting_names = ['xls_cfg_miss', 'csv_cfg_miss_dir', 'xls_ip_devices', 'inventory_cache', 'cfg_root_dir', 'cfg_archive',
+                 'cfg_mmap', 'cfg_check_cmd', 'cfg_check_cache', 'check_snapshot', 'cfg_template', 'gen_template',
+                 'gen_excel', 'fix_cfg', 'drift_diff', 'drift_old_snapshot', 'drift_file', 'watch', 'watch_interval',
+                 'watch_port', 'watch_snapshot', 'shard_count', 'shard_index', 'shard_dir', 'shard_run_id',
+                 'merge_shards', 'fix_plan_dir', 'fix_plan_file', 'profiles_filter', 'dev_filter', 'check_workers',
+                 'template_workers', 'template_min_support', 'run_report', 'run_report_top', 'slow_command_us',
+                 'validate_report', 'line_break', 'line_rules', 'line_rules_file', 'line_rules_corpus']
+
+def configure (**settings):
+    """
+    Changes the settings at the beginning of this file for the next phases, when this script is used as a library:
+        import template_create_check as tcc
+        tcc.configure(cfg_root_dir = '/backup/configs/', profiles_filter = '^PE', check_workers = 0)
+        matrices = tcc.run_gen_excel()
+        fixes = tcc.run_fix_cfg(profiles_filter = '^RR')
+    The phases also take settings as keyword arguments, for that call only. Unknown names raise ValueError. What was
+    read with the old settings (configs archive, line rules) is read again, the inventory when xls_ip_devices changes.
+    """
+    global config_source, compiled_line_rules
+    for name in settings:
+        if not name in setting_names:
+            raise ValueError('unknown setting '+name)
+    globals().update(settings)
+    if 'cfg_archive' in settings:
+        config_source = None
+    if 'line_rules' in settings or 'line_rules_file' in settings:
+        compiled_line_rules = None
+
+@phase_settings
+def check_device (dev, filename = None):
+    """
+    Checks one device of the inventory against the commands of its profile, without writing anything. The config is
+    the one of the inventory, or 'filename'. Returns (profile, commands, indexes of the commands found), None when the
+    device, its config or its commands can't be found.
+    """
+    row = get_inventory().by_name.get(dev)
+    if row == None:
+        print('ERROR, device '+dev+' not found in '+xls_ip_devices)
+        return None
+    profile = row[3]
+    if filename == None:
+        filename = get_inventory().config_file(row)
+        if filename == None:
+            print('ERROR, no config file for device '+dev+' in '+cfg_root_dir+row[1])
+            return None
+    cmd_targ = load_openpyxl().load_workbook(cfg_check_cmd, read_only=True)
+    commands = read_profile_commands(cmd_targ, profile) if profile in cmd_targ.sheetnames else None
+    cmd_targ.close()
+    if commands == None:
+        print('ERROR, no commands for profile '+profile+' in '+cfg_check_cmd)
+        return None
+    if not preflight_commands(profile, commands):
+        return None
+    content_hash, presence, timings, sections = check_cfg_file(CmdMatcher(commands), filename)
+    return profile, commands, [cmd_index for cmd_index in range(len(commands)) if presence[cmd_index]]
+
+@phase_settings
+def validate_templates (timed = True):
+    """
+    The pre-flight of cfg_check_cmd, for the profiles matching profiles_filter. Every command is compiled and looked
+    at for the mistakes that would stop or slow down the other phases (see command_risks), the rows with both an add
+    and a remove command are reported, and with 'timed' the commands are timed on a sample config of their profile
+    (the cfg_template file, or else its first config): the ones run as regexp by the checker and slower than
+    slow_command_us are reported. How many commands the checker finds without running a regexp is printed for every
+    profile, and all the details go to validate_report when set. Returns the problems found as
+    (profile, excel row, command, 'ERROR' or 'WARNING', message).
+    """
+    problems = []
+    details = []
+    cmd_targ = load_openpyxl().load_workbook(cfg_check_cmd, read_only=True)
+    for profile in cmd_targ.sheetnames:
+        if profile == 'VARS' or not re.search(profiles_filter, profile):
+            continue
+        commands = []
+        xls_rows = []
+        profile_problems = []
+        xls_row = 1
+        for row in cmd_targ[profile].iter_rows(min_row=2, values_only=True):
+            xls_row += 1
+            cmd = str(row_value(row, 'A')).strip()
+            if not len(cmd) or cmd == 'None':
+                continue
+            commands.append(cmd)
+            xls_rows.append(xls_row)
+            add_cmd = row_value(row, 'B')
+            rem_cmd = row_value(row, 'C')
+            if add_cmd != None and len(str(add_cmd).strip()) and rem_cmd != None and len(str(rem_cmd).strip()):
+                profile_problems.append((profile, xls_row, cmd, 'ERROR', "columns B and C can't be both full"))
+
+        cmd_problems = {}
+        invalid = set()
+        # the commands that may backtrack exponentially are not timed, they could take forever
+        not_timed = set()
+        for i, severity, message in command_problems(commands):
+            profile_problems.append((profile, xls_rows[i], commands[i], severity, message))
+            if not i in cmd_problems:
+                cmd_problems[i] = []
+            cmd_problems[i].append(message)
+            if severity == 'ERROR':
+                invalid.add(i)
+                not_timed.add(i)
+            elif 'backtrack' in message:
+                not_timed.add(i)
+        # the checker is built with the valid commands only, to know how it finds them
+        valid = [i for i in range(len(commands)) if not i in invalid]
+        matcher_kinds = CmdMatcher([commands[i] for i in valid]).kinds
+        kinds = [None] * len(commands)
+        for i, kind in zip(valid, matcher_kinds):
+            kinds[i] = kind
+
+        sample = None
+        if timed:
+            sample = template_file(profile)
+            if sample != None and not get_config_source().exists(sample):
+                print('WARNING: the cfg_template file '+sample+' of profile '+profile+' is missing, the commands are '
+                      'timed on the first config of the profile')
+                sample = None
+            if sample == None:
+                configs = get_inventory().profile_configs(dev_filter).get(profile) if os.path.exists(xls_ip_devices) \
+                          else None
+                if configs:
+                    sample = configs[0]
+        timings = [None] * len(commands)
+        if sample != None:
+            timings = time_commands(commands, sample, skip = not_timed)
+            for i in range(len(commands)):
+                if timings[i] == None:
+                    continue
+                if kinds[i] == 'regex' and timings[i][0] > slow_command_us:
+                    message = 'slow regexp, '+str(round(timings[i][0], 1))+' us per line of '+sample
+                    profile_problems.append((profile, xls_rows[i], commands[i], 'WARNING', message))
+                    cmd_problems.setdefault(i, []).append(message)
+                if timings[i][1] == 0 and sample == template_file(profile):
+                    message = 'no line of the template '+sample+' matches it'
+                    profile_problems.append((profile, xls_rows[i], commands[i], 'WARNING', message))
+                    cmd_problems.setdefault(i, []).append(message)
+
+        problems.extend(sorted(profile_problems, key=lambda problem: problem[1]))
+        counts = dict((kind, kinds.count(kind)) for kind in ('exact', 'prefix', 'suffix', 'substring', 'regex'))
+        regex_time = sum(timings[i][0] for i in range(len(commands)) if kinds[i] == 'regex' and timings[i] != None)
+        print('Profile '+profile+': '+str(len(commands))+' commands, '+
+              ', '.join(str(counts[kind])+' '+kind for kind in counts)+
+              ('' if sample == None else ', the regexp take '+str(round(regex_time, 1))+' us per line of '+sample))
+        for i in range(len(commands)):
+            details.append((profile, xls_rows[i], kinds[i] or '',
+                            '' if timings[i] == None else str(round(timings[i][0], 3)),
+                            '' if timings[i] == None else str(timings[i][1]),
+                            '; '.join(cmd_problems.get(i, [])), commands[i]))
+    cmd_targ.close()
+
+    for profile, xls_row, cmd, severity, message in problems:
+        print(severity+' on line '+str(xls_row)+' profile '+profile+' '+message+': '+cmd)
+    if validate_report:
+        with open(validate_report, 'w') as file:
+            file.write('profile\trow\tkind\tus_per_line\tlines_matched\tproblems\tcommand\n')
+            for detail in details:
+                file.write('\t'.join(str(value) for value in detail) + '\n')
+        print('Written '+validate_report)
+    print(str(len([problem for problem in problems if problem[3] == 'ERROR']))+' errors and '+
+          str(len([problem for problem in problems if problem[3] == 'WARNING']))+' warnings in '+cfg_check_cmd)
+    return problems
+
+def setting_value (text):
+    # the values given with --set are python literals (4, True, '^PE' ...), anything else is taken as a string
+    import ast
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+def main (argv):
+    """
+    The command line, with a subcommand for every phase; the settings at the beginning of this file are the defaults:
+        python template_create_check.py excel --profiles '^PE' --workers 0
+        python template_create_check.py excel --shard 2/8 --run-id 2024-05-01
+        python template_create_check.py check DEVICE
+        python template_create_check.py validate --set cfg_check_cmd=./new_cmd_check.xlsx
+    Returns the exit code.
+    """
+    import argparse
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--profiles', help='profiles_filter, regexp of the profiles')
+    options.add_argument('--devices', help='dev_filter, regexp of the devices')
+    options.add_argument('--workers', type=int, help='check_workers and template_workers, 0 for one per cpu')
+    options.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                         help='any other setting at the beginning of this file')
+    parser = argparse.ArgumentParser(description='Checks the devices configurations against the templates of their '
+                                     'profiles. Without arguments the phases enabled at the beginning of this file run.')
+    subcommands = parser.add_subparsers(dest='subcommand', required=True)
+    subcommands.add_parser('template', parents=[options], help='propose the commands of the templates (gen_template)')
+    excel = subcommands.add_parser('excel', parents=[options], help='check the devices and write xls_cfg_miss')
+    excel.add_argument('--shard', metavar='K/N', help='check only the shard K (0 to N-1) of N, see merge')
+    excel.add_argument('--run-id', help='shard_run_id, the same for all the shards of a run (e.g. the date)')
+    subcommands.add_parser('merge', parents=[options], help='write xls_cfg_miss from the results of all the shards')
+    subcommands.add_parser('fix', parents=[options], help='list the commands fixing the devices (fix_cfg)')
+    subcommands.add_parser('drift', parents=[options], help='compare the check snapshot with drift_old_snapshot')
+    subcommands.add_parser('watch', parents=[options], help='check the changed configs and answer the queries')
+    check = subcommands.add_parser('check', parents=[options], help='check one device, without writing anything')
+    check.add_argument('device')
+    check.add_argument('--file', help='config to be checked instead of the one of the inventory')
+    validate = subcommands.add_parser('validate', parents=[options], help='look for mistakes and slow commands in '
+                                      'cfg_check_cmd')
+    validate.add_argument('--no-timing', action='store_true', help="don't time the commands on a sample config")
+    args = parser.parse_args(argv)
+
+    settings = {}
+    if args.profiles != None:
+        settings['profiles_filter'] = args.profiles
+    if args.devices != None:
+        settings['dev_filter'] = args.devices
+    if args.workers != None:
+        settings['check_workers'] = settings['template_workers'] = args.workers
+    if getattr(args, 'shard', None) != None:
+        try:
+            index, count = args.shard.split('/')
+            settings['shard_index'], settings['shard_count'] = int(index), int(count)
+        except ValueError:
+            parser.error('--shard must be given as K/N')
+        if settings['shard_count'] < 1 or not 0 <= settings['shard_index'] < settings['shard_count']:
+            parser.error('--shard K/N needs N >= 1 and K between 0 and N-1')
+    if getattr(args, 'run_id', None) != None:
+        settings['shard_run_id'] = args.run_id
+    for item in args.set:
+        if not '=' in item:
+            parser.error('--set must be given as NAME=VALUE')
+        name, value = item.split('=', 1)
+        settings[name.strip()] = setting_value(value)
+    try:
+        configure(**settings)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.subcommand == 'check':
+        result = check_device(args.device, args.file)
+        if result == None:
+            return 1
+        profile, commands, found = result
+        print('Device '+args.device+', profile '+profile+': '+str(len(found))+' of '+str(len(commands))+
+              ' commands found')
+        found = set(found)
+        for cmd_index in range(len(commands)):
+            if not cmd_index in found:
+                print('Missing: '+commands[cmd_index])
+        return 0
+    if args.subcommand == 'validate':
+        problems = validate_templates(timed = not args.no_timing)
+        return 1 if len([problem for problem in problems if problem[3] == 'ERROR']) else 0
+
+    start = datetime.datetime.now()
+    result = True
+    if args.subcommand == 'template':
+        result = run_gen_template()
+    elif args.subcommand == 'excel':
+        result = run_gen_excel()
+    elif args.subcommand == 'merge':
+        result = run_merge_shards()
+    elif args.subcommand == 'fix':
+        run_fix_cfg()
+    elif args.subcommand == 'drift':
+        result = run_drift_diff()
+    elif args.subcommand == 'watch':
+        run_watch()
+    print("Total time:" , datetime.datetime.now()-start)
+    return 1 if result == None else 0
 
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
+    start = datetime.datetime.now()
+    if gen_template:
+        run_gen_template()
+    if gen_excel:
+        run_gen_excel()
+    if merge_shards:
+        run_merge_shards()
+    if fix_cfg:
+        run_fix_cfg()
+    if drift_diff:
+        run_drift_diff()
+    if watch:
+        run_watch()
     print("Total time:" , datetime.datetime.now()-start)
     
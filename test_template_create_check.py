@@ -0,0 +1,595 @@
+"""
+Regression tests of template_create_check: the results that the faster code must keep exactly as they were.
+    python -m pytest -q test_template_create_check.py
+"""
+import contextlib
+import csv
+import io
+import os
+import random
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+import zipfile
+
+import openpyxl
+
+import bench_fleet
+import template_create_check as tcc
+
+here = os.path.dirname(os.path.abspath(__file__))
+lb = tcc.line_break
+
+# words of the random configs, with some of the lines that the line rules change or skip
+words = ['interface', 'Gi0/1', 'router', 'bgp', '65000', 'timers', '10', '30', 'password', '7', 'key', 'enable',
+         'secret', '5', 'no', 'shutdown', '!', 'a@b', '@', 'username', 'x', 'crypto', 'pki', 'trustpoint',
+         'TP-self-signed-123', 'key-string', '1', 'description', 'hostname', 'vrf', 'definition']
+
+def random_config (rand):
+    lines = []
+    for i in range(rand.randint(5, 60)):
+        indent = rand.choice([0, 0, 0, 1, 1, 2, 3, 4])
+        space = rand.choice([' ', ' ', '\t'])
+        text = ' '.join(rand.choice(words) for j in range(rand.randint(1, 4)))
+        if rand.random() < 0.05:
+            text = ''
+        if rand.random() < 0.03:
+            text += ' ' + lb + ' y'
+        lines.append(space * indent + text + ('\n' if rand.random() < 0.97 else '   \n'))
+    return lines
+
+def random_command (rand, lines):
+    # a line of the config, maybe with some parents and some regexp around it
+    cmd = rand.choice(lines).strip()
+    if rand.random() < 0.3:
+        cmd = re.escape(cmd)
+    parents = [' '.join(rand.choice(words) for j in range(rand.randint(1, 3))) for i in range(rand.choice([0, 1, 2]))]
+    cmd = lb.join(parents + [cmd])
+    if rand.random() < 0.5:
+        cmd += '$'
+    if rand.random() < 0.2:
+        cmd = '.*' + cmd
+    if rand.random() < 0.2:
+        cmd = cmd.replace(' ', '.*', 1)
+    if rand.random() < 0.2:
+        cmd = '^' + cmd
+    if rand.random() < 0.1:
+        cmd = cmd.replace(' ', '***', 1)
+    return cmd
+
+def baseline_search_lines (lines):
+    """ The lines with their parents, as the first version of run_gen_excel walked the indentation """
+    last_spaces = 0
+    last_line = ''
+    parents = []
+    num_spaces = []
+    for line in lines:
+        if re.search(r'^\s', line):
+            spaces = len(re.search(r'^(\s+)', line).group(1))
+            if spaces > last_spaces:
+                parents.append(last_line.strip())
+                num_spaces.append(spaces)
+                last_spaces = spaces
+            elif spaces < last_spaces:
+                while len(num_spaces) > 0 and num_spaces[-1] > spaces:
+                    parents.pop()
+                    num_spaces.pop()
+                last_spaces = spaces
+        else:
+            while len(parents):
+                parents.pop()
+                num_spaces.pop()
+                last_spaces = 0
+                last_line = ''
+        if parents:
+            yield lb.join(parents) + lb + line.strip()
+        else:
+            yield line.strip()
+        last_line = line.strip()
+
+def baseline_check (commands, lines):
+    """
+    The check of the first version of run_gen_excel: every line with its parents, and the first command found in it
+    with the same number of line_break. Returns the indexes of the commands found, sorted.
+    """
+    found = []
+    for search_line in baseline_search_lines(lines):
+        for i in range(len(commands)):
+            cmd = commands[i].replace('***', ' ')
+            if re.search(cmd, search_line) and cmd.count(lb) == search_line.count(lb):
+                found.append(i)
+                break
+    return sorted(found)
+
+class TempFiles (unittest.TestCase):
+    """ Random config files in a temporary directory, and the settings put back as they were after every test """
+    def setUp (self):
+        self.dir = tempfile.mkdtemp()
+        self.settings = tcc.worker_settings()
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+
+    def tearDown (self):
+        self.output.__exit__(None, None, None)
+        tcc.configure(**self.settings)
+        shutil.rmtree(self.dir)
+
+    def write_config (self, name, lines):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w') as file:
+            file.write(''.join(lines))
+        return filename
+
+class TestCmdMatcher (TempFiles):
+    def test_same_as_baseline (self):
+        rand = random.Random(1)
+        for test in range(150):
+            configs = [random_config(rand) for i in range(4)]
+            commands = []
+            for i in range(rand.randint(1, 40)):
+                cmd = random_command(rand, rand.choice(configs))
+                try:
+                    re.compile(cmd.replace('***', ' '))
+                except re.error:
+                    continue
+                commands.append(cmd)
+            matcher = tcc.CmdMatcher(commands)
+            for i in range(len(configs)):
+                # every tree twice: the second time the sections are found in the matcher cache
+                tree = tcc.get_cfg_tree(self.write_config('dev' + str(i) + '.txt', configs[i]))
+                for repeat in range(2):
+                    self.assertEqual(sorted(matcher.match_tree(tree)), baseline_check(commands, configs[i]),
+                                     'commands ' + repr(commands) + ' on\n' + ''.join(configs[i]))
+
+class TestCfgTree (unittest.TestCase):
+    def test_search_lines (self):
+        rand = random.Random(8)
+        for test in range(300):
+            lines = random_config(rand)
+            with contextlib.redirect_stdout(io.StringIO()):
+                tree = tcc.CfgTree('dev.txt', lines)
+            self.assertEqual([node.search_line() for node in tree.nodes], list(baseline_search_lines(lines)))
+            for node in tree.nodes:
+                self.assertEqual(node.path, node.parent.search_line() if node.parent != None else '')
+
+class TestLineRules (unittest.TestCase):
+    def setUp (self):
+        self.settings = tcc.worker_settings()
+
+    def tearDown (self):
+        tcc.configure(**self.settings)
+
+    def test_corpus (self):
+        tcc.configure(line_rules_file = '')
+        with contextlib.redirect_stdout(io.StringIO()):
+            errors = tcc.check_line_rules(os.path.join(here, 'get_line_corpus.jsonl'))
+        self.assertEqual(errors, 0)
+
+    def test_ignore_case_groups (self):
+        rules = tcc.LineRules([('skip', '(?i:HOSTNAME)', ''), ('change', '^(?i:NTP) server', 'ntp'),
+                               ('skip', '^x(?i:Y)z', '')])
+        self.assertEqual(rules.apply('hostname PE1\n'), None)
+        self.assertEqual(rules.apply('ntp server 1.1.1.1\n'), 'ntp')
+        self.assertEqual(rules.apply('Ntp server 1.1.1.1\n'), 'ntp')
+        self.assertEqual(rules.apply('xyz\n'), None)
+        self.assertEqual(rules.apply('xYz\n'), None)
+        self.assertEqual(rules.apply('xZz\n'), 'xZz\n')
+
+class TestCounting (TempFiles):
+    def random_devices (self, rand, count):
+        # the same lines on most of the devices, so that some commands reach the minimum support
+        common = random_config(rand)
+        filenames = []
+        for i in range(count):
+            lines = [line for line in common if rand.random() < 0.8] + random_config(rand)[:rand.randint(0, 10)]
+            filenames.append(self.write_config('dev' + str(i) + '.txt', lines))
+        return filenames
+
+    def test_merge_keeps_order (self):
+        filenames = self.random_devices(random.Random(3), 12)
+        commands = {}
+        for filename in filenames:
+            tcc.update_template_cmd(filename, commands)
+        merged = {}
+        for start in range(0, len(filenames), 5):
+            chunk = {}
+            for filename in filenames[start:start+5]:
+                tcc.update_template_cmd(filename, chunk)
+            tcc.merge_template_cmd(merged, chunk)
+        self.assertEqual(list(merged.items()), list(commands.items()))
+
+    def test_lossy_counter (self):
+        rand = random.Random(2)
+        devices = [set(cmd for cmd in range(30) if rand.random() < 1.0 / (cmd + 1)) for i in range(200)]
+        real = {}
+        for cmds in devices:
+            for cmd in cmds:
+                real[cmd] = real.get(cmd, 0) + 1
+        single = tcc.LossyCounter(0.05)
+        for cmds in devices:
+            single.add_device(cmds)
+        merged = tcc.LossyCounter(0.05)
+        for start in range(0, len(devices), 37):
+            chunk = tcc.LossyCounter(0.05)
+            for cmds in devices[start:start+37]:
+                chunk.add_device(cmds)
+            merged.merge(chunk)
+        for counter in (single, merged):
+            self.assertEqual(counter.devices, len(devices))
+            for cmd, (count, missed) in counter.counts.items():
+                self.assertLessEqual(count, real[cmd])
+                self.assertGreaterEqual(count + missed, real[cmd])
+                self.assertLessEqual(count + missed, real[cmd] + 0.05 * len(devices))
+            for threshold in (10, 20, 50):
+                self.assertLessEqual(set(cmd for cmd in real if real[cmd] >= threshold), counter.candidates(threshold))
+
+    def test_min_support (self):
+        rand = random.Random(4)
+        filenames = self.random_devices(rand, 40)
+        template = self.write_config('template.txt', random_config(rand) + ['username x password 7 a@b\n'])
+        tcc.configure(cfg_template = {'P': template}, template_workers = 1)
+        target_cmds = set()
+        tcc.update_template_cmd(template, None, target = True, found = target_cmds)
+        commands = {}
+        support = {}
+        for filename in filenames:
+            found = set()
+            tcc.update_template_cmd(filename, commands, found = found)
+            for cmd in found:
+                support[cmd] = support.get(cmd, 0) + 1
+        for min_support in (0.1, 0.3, 0.6):
+            tcc.configure(template_min_support = min_support)
+            expected = [(cmd, count) for cmd, count in commands.items()
+                        if support[cmd] >= min_support * len(filenames) or cmd in target_cmds]
+            self.assertEqual(list(tcc.count_supported_cmd('P', filenames).items()), expected)
+
+class TestCheckMatrix (unittest.TestCase):
+    def random_matrix (self, rand, commands, devices):
+        matrix = tcc.CheckMatrix(list(commands))
+        present = []
+        for dev in devices:
+            cmd_indexes = [i for i in range(len(commands)) if rand.random() < 0.6]
+            matrix.add_device(dev, cmd_indexes)
+            present.append(set(cmd_indexes))
+        return matrix, present
+
+    def test_bits (self):
+        rand = random.Random(5)
+        for cmd_count in (0, 1, 7, 8, 9, 70):
+            commands = ['cmd' + str(i) + '$' for i in range(cmd_count)]
+            devices = ['dev' + str(i) for i in range(rand.randint(0, 40))]
+            matrix, present = self.random_matrix(rand, commands, devices)
+            totals = [sum(1 for cmds in present if i in cmds) for i in range(cmd_count)]
+            missing = [[devices[d] for d in range(len(devices)) if not i in present[d]] for i in range(cmd_count)]
+            for d in range(len(devices)):
+                for i in range(cmd_count):
+                    self.assertEqual(matrix.present(d, i), i in present[d])
+            self.assertEqual(matrix.totals(), totals)
+            self.assertEqual([matrix.missing(i) for i in range(cmd_count)], missing)
+            columns = matrix.columns()
+            self.assertEqual(columns, [sum(1 << d for d in range(len(devices)) if i in present[d])
+                                       for i in range(cmd_count)])
+            self.assertEqual([matrix.missing(i) for i in range(cmd_count)], missing)
+            if cmd_count:
+                self.assertEqual(matrix.compliance(), [len(cmds) / cmd_count for cmds in present])
+            unpacked = tcc.CheckMatrix.unpack(matrix.pack())
+            self.assertEqual((unpacked.commands, unpacked.devices, unpacked.rows),
+                             (matrix.commands, matrix.devices, matrix.rows))
+
+    def test_drift (self):
+        rand = random.Random(6)
+        for test in range(50):
+            old_commands = ['cmd' + str(i) + '$' for i in range(rand.randint(0, 20))]
+            if rand.random() < 0.5:
+                new_commands = list(old_commands)
+            else:
+                new_commands = [cmd for cmd in old_commands if rand.random() < 0.8] + ['new' + str(i) for i in range(3)]
+                rand.shuffle(new_commands)
+            names = ['dev' + str(i) for i in range(15)]
+            old_devices = [dev for dev in names if rand.random() < 0.8]
+            new_devices = [dev for dev in names if rand.random() < 0.8]
+            old, old_present = self.random_matrix(rand, old_commands, old_devices)
+            new, new_present = self.random_matrix(rand, new_commands, new_devices)
+            expected = set()
+            for dev in set(old_devices) | set(new_devices):
+                if not dev in new_devices:
+                    expected.add((dev, None, 'removed device'))
+                elif not dev in old_devices:
+                    expected.add((dev, None, 'added device'))
+                else:
+                    before = set(old_commands[i] for i in old_present[old_devices.index(dev)])
+                    after = set(new_commands[i] for i in new_present[new_devices.index(dev)])
+                    for cmd in set(old_commands) & set(new_commands):
+                        if cmd in before and not cmd in after:
+                            expected.add((dev, cmd, 'lost'))
+                        elif cmd in after and not cmd in before:
+                            expected.add((dev, cmd, 'gained'))
+            changes = list(tcc.matrix_drift(old, new))
+            self.assertEqual(len(changes), len(set(changes)))
+            self.assertEqual(set(changes), expected)
+
+class TestDrift (TempFiles):
+    def write_results (self, devices):
+        tcc.write_check_excel('gen_excel', ['P'], iter([('P', ['a$', 'b$'], devices)]), time.perf_counter())
+
+    def test_nightly_snapshots (self):
+        # gen_excel and drift_diff run together every night: every run is compared with the previous one
+        tcc.configure(xls_cfg_miss = os.path.join(self.dir, 'check.xlsx'), csv_cfg_miss_dir = '',
+                      check_snapshot = os.path.join(self.dir, 'check.snapshot'),
+                      drift_old_snapshot = os.path.join(self.dir, 'check.snapshot.old'),
+                      drift_file = os.path.join(self.dir, 'drift.csv'), drift_diff = True,
+                      profiles_filter = '.*', dev_filter = '.*')
+        self.write_results([('d1', [0]), ('d2', [0, 1])])
+        self.assertEqual(tcc.run_drift_diff(), None)
+        self.write_results([('d1', [0, 1]), ('d2', [1]), ('d3', [])])
+        self.assertEqual(tcc.run_drift_diff(), 3)
+        with open(tcc.drift_file, newline='') as file:
+            rows = list(csv.reader(file))[1:]
+        self.assertEqual(sorted(rows), [['P', 'd1', 'b$', 'gained'], ['P', 'd2', 'a$', 'lost'],
+                                        ['P', 'd3', '', 'added device']])
+        self.write_results([('d1', [0, 1]), ('d2', [1]), ('d3', [])])
+        self.assertEqual(tcc.run_drift_diff(), 0)
+
+class Fleet (TempFiles):
+    """ A small synthetic fleet of bench_fleet.py, with the settings to check it """
+    def setUp (self):
+        TempFiles.setUp(self)
+        self.fleet = bench_fleet.generate_fleet(self.dir, devices = 30, lines = 60, depth = 2, commands = 40,
+                                                regex = 0.3, profiles = 3, missing = 0.1, seed = 7)
+        tcc.configure(cfg_root_dir = self.fleet['cfg_root_dir'], cfg_archive = '',
+                      xls_ip_devices = os.path.join(self.dir, 'IpDevices_list.xlsx'), inventory_cache = '',
+                      cfg_check_cmd = os.path.join(self.dir, 'cfg_cmd_check.xlsx'),
+                      xls_cfg_miss = os.path.join(self.dir, 'Cfg_Check.xlsx'), csv_cfg_miss_dir = '',
+                      cfg_check_cache = '', check_snapshot = os.path.join(self.dir, 'Cfg_Check.snapshot'),
+                      shard_dir = os.path.join(self.dir, 'shards'), shard_count = 1, shard_index = 0,
+                      shard_run_id = '', cfg_template = self.fleet['cfg_template'], check_workers = 1,
+                      template_workers = 1, profiles_filter = '.*', dev_filter = '.*', drift_diff = False,
+                      run_report = False)
+
+    def results (self):
+        """ The sheets of xls_cfg_miss and the matrices of check_snapshot """
+        workbook = openpyxl.load_workbook(tcc.xls_cfg_miss, read_only=True)
+        sheets = dict((name, [list(row) for row in workbook[name].iter_rows(values_only=True)])
+                      for name in workbook.sheetnames)
+        workbook.close()
+        matrices = tcc.load_snapshot(tcc.check_snapshot)[1]
+        return sheets, dict((profile, (matrix.commands, matrix.devices, matrix.rows))
+                            for profile, matrix in matrices.items())
+
+class TestShards (Fleet):
+    def run_shards (self, count, run_id = ''):
+        for index in range(count):
+            tcc.configure(shard_count = count, shard_index = index, shard_run_id = run_id)
+            self.assertNotEqual(tcc.run_gen_excel(), None)
+        tcc.configure(shard_count = count, shard_index = 0, shard_run_id = run_id)
+
+    def test_same_as_single_run (self):
+        tcc.run_gen_excel()
+        single = self.results()
+        for count in (2, 3, 7):
+            os.remove(tcc.xls_cfg_miss)
+            self.run_shards(count)
+            self.assertNotEqual(tcc.run_merge_shards(), None)
+            self.assertEqual(self.results(), single)
+            # the shards are merged once
+            self.assertEqual(os.listdir(tcc.shard_dir), [])
+
+    def test_shards_of_other_runs (self):
+        self.run_shards(2, 'monday')
+        tcc.configure(shard_count = 2, shard_index = 0, shard_run_id = 'tuesday')
+        tcc.run_gen_excel()
+        self.assertEqual(tcc.run_merge_shards(), None)
+        self.assertFalse(os.path.exists(tcc.xls_cfg_miss))
+        # a shard checked again after a merge is not merged with the old results of the others
+        self.run_shards(2, 'tuesday')
+        self.assertNotEqual(tcc.run_merge_shards(), None)
+        tcc.configure(shard_count = 2, shard_index = 0)
+        tcc.run_gen_excel()
+        self.assertEqual(tcc.run_merge_shards(), None)
+
+    def test_shard_argument (self):
+        for shard in ('1/0', '0/0', '2/2', '-1/2', 'x'):
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    tcc.main(['excel', '--shard', shard])
+
+class TestLibrary (Fleet):
+    def test_phases_called_again (self):
+        # a scheduler calling the phases in the same process sees the new devices
+        first = tcc.run_gen_excel()
+        workbook = openpyxl.load_workbook(tcc.xls_ip_devices)
+        workbook['Devices'].append(['PROFILE_1', 'ssh', 'profile_1', 'ssh', 'dev99999', '10.20.99.99', 'IOS XE 17.3',
+                                    'PROFILE_1'] + [None] * 7 + ['PROFILE_1'])
+        workbook.save(tcc.xls_ip_devices)
+        shutil.copy(os.path.join(tcc.cfg_root_dir, 'PROFILE_1', 'dev00000.txt'),
+                    os.path.join(tcc.cfg_root_dir, 'PROFILE_1', 'dev99999.txt'))
+        second = tcc.run_gen_excel()
+        self.assertEqual(second['PROFILE_1'].devices, first['PROFILE_1'].devices + ['dev99999'])
+        self.assertEqual(second['PROFILE_1'].rows[-1], second['PROFILE_1'].rows[0])
+        self.assertEqual(second['PROFILE_2'].devices, first['PROFILE_2'].devices)
+
+    def test_settings_for_one_call (self):
+        matrices = tcc.run_gen_excel(profiles_filter = '^PROFILE_2$', dev_filter = '0[0-4]$')
+        self.assertEqual(list(matrices), ['PROFILE_2'])
+        self.assertTrue(all(re.search('0[0-4]$', dev) for dev in matrices['PROFILE_2'].devices))
+        self.assertEqual((tcc.profiles_filter, tcc.dev_filter), ('.*', '.*'))
+        self.assertEqual(tcc.check_device('dev00001', profiles_filter = 'none')[0], 'PROFILE_2')
+        self.assertEqual(tcc.profiles_filter, '.*')
+
+class TestCheckFiles (Fleet):
+    def test_csv_files (self):
+        tcc.configure(csv_cfg_miss_dir = os.path.join(self.dir, 'csv', 'new'))
+        matrices = tcc.run_gen_excel()
+        sheets = self.results()[0]
+        for profile in matrices:
+            with open(os.path.join(tcc.csv_cfg_miss_dir, profile + '.csv'), newline='') as file:
+                rows = list(csv.reader(file))
+            # the same cells as the excel sheet, without its totals row (the empty cells at its end are not read)
+            width = len(matrices[profile].commands) + 1
+            self.assertEqual(rows, [['Device'] + matrices[profile].commands] +
+                             [[cell or '' for cell in row + [None] * (width - len(row))]
+                              for row in sheets[profile][1:-1]])
+
+class TestArchives (Fleet):
+    def test_same_as_disk (self):
+        tcc.run_gen_excel()
+        disk = self.results()
+        root = tcc.cfg_root_dir
+        names = sorted(os.path.relpath(os.path.join(dir, name), root).replace(os.sep, '/')
+                       for dir, dirs, files in os.walk(root) for name in files)
+        archives = [os.path.join(self.dir, 'configs.zip')]
+        with zipfile.ZipFile(archives[0], 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in names:
+                archive.write(os.path.join(root, name), name)
+        for extension, mode in (('.tar', 'w:'), ('.tar.gz', 'w:gz'), ('.tgz', 'w:gz')):
+            archives.append(os.path.join(self.dir, 'configs' + extension))
+            with tarfile.open(archives[-1], mode) as archive:
+                for name in names:
+                    # the members named as written by tar -C configs -czf configs.tgz .
+                    archive.add(os.path.join(root, name), './' + name)
+        # the uncompressed copies of the compressed tar go with the other temporary files of the test
+        temp = tempfile.tempdir
+        tempfile.tempdir = self.dir
+        try:
+            for workers in (1, 2):
+                for filename in archives:
+                    os.remove(tcc.xls_cfg_miss)
+                    tcc.run_gen_excel(cfg_root_dir = '', cfg_archive = filename, check_workers = workers)
+                    self.assertEqual(self.results(), disk, filename)
+        finally:
+            tempfile.tempdir = temp
+
+class TestFixCommand (unittest.TestCase):
+    def test_same_as_fill_cmd_with_vars (self):
+        rand = random.Random(9)
+        names = ['Loop_0_ip', 'mask', 'peer', 'n', 'a$b', 'x(y']
+        values = ['10.0.0.1', '10.0.0.255', '255.255.255.255', '1', '10', '+ 1', '- 2', '| 3', '1.2.3', 'abc',
+                  '$(mask)', '$(n', '(x)', ')', '', ' 10.1.1.1 - 1']
+        texts = ['ip route ', ' ', ' + ', '+', ' - 3', '-', '|', ' + 1', '10.0.0.1', '1.2.3.4 + 5', '\n', '\n exit',
+                 'neighbor ', '$(', ')', '$', '(', 'name']
+        for test in range(3000):
+            cmd = ''.join(rand.choice(texts) if rand.random() < 0.6 else '$(' + rand.choice(names) + ')'
+                          for i in range(rand.randint(1, 8)))
+            vars = {}
+            for dev in ('dev1', 'dev2'):
+                vars[dev] = dict((name, rand.choice(values)) for name in names if rand.random() < 0.85)
+            fix_command = tcc.FixCommand(cmd)
+            for dev in ('dev1', 'dev2', 'dev3'):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    filled = tcc.fill_cmd_with_vars(dev, cmd, vars)
+                    lines = fix_command.render(dev, vars)
+                self.assertEqual(lines, None if filled == None else tcc.fix_lines(filled), repr((cmd, vars.get(dev))))
+
+class TestCheckCache (Fleet):
+    def cached (self):
+        return dict((profile, set(entry['devices'])) for profile, entry in tcc.load_check_cache().items())
+
+    def check (self, **settings):
+        """ Checks with the cache, and returns the results with the ones of a check without it """
+        if os.path.exists(tcc.xls_cfg_miss):
+            os.remove(tcc.xls_cfg_miss)
+        tcc.run_gen_excel(**settings)
+        cached = self.results()
+        os.remove(tcc.xls_cfg_miss)
+        tcc.run_gen_excel(cfg_check_cache = '', **settings)
+        return cached, self.results()
+
+    def remove_devices (self, removed):
+        workbook = openpyxl.load_workbook(tcc.xls_ip_devices)
+        sheet = workbook['Devices']
+        for row in range(sheet.max_row, 1, -1):
+            if removed(sheet.cell(row, 5).value, sheet.cell(row, 16).value):
+                sheet.delete_rows(row)
+        workbook.save(tcc.xls_ip_devices)
+
+    def test_hits_misses_evictions (self):
+        tcc.configure(cfg_check_cache = os.path.join(self.dir, 'Cfg_Check.cache'))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cached, fresh = self.check()
+        self.assertEqual(cached, fresh)
+        self.assertIn('PROFILE_1: 0 hits, 10 misses', output.getvalue())
+        all_files = self.cached()
+        self.assertEqual(sorted(len(files) for files in all_files.values()), [10, 10, 10])
+
+        # nothing changed, then one config changed and the commands of one profile changed
+        with open(os.path.join(tcc.cfg_root_dir, 'PROFILE_1', 'dev00003.txt'), 'a') as file:
+            file.write('snmp-server community edge2 RO\nlogging host 10.0.0.2\n')
+        workbook = openpyxl.load_workbook(tcc.cfg_check_cmd)
+        workbook['PROFILE_2'].delete_rows(2)
+        workbook.save(tcc.cfg_check_cmd)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cached, fresh = self.check()
+        self.assertEqual(cached, fresh)
+        self.assertIn('PROFILE_1: 9 hits, 1 misses', output.getvalue())
+        self.assertIn('PROFILE_2: 0 hits, 10 misses', output.getvalue())
+        self.assertIn('PROFILE_3: 10 hits, 0 misses', output.getvalue())
+
+        # the devices left out by dev_filter are kept, the ones no longer in the inventory are dropped
+        self.check(dev_filter = '[02468]$')
+        self.assertEqual(self.cached(), all_files)
+        self.remove_devices(lambda dev, profile: dev == 'dev00003' or profile == 'PROFILE_3')
+        cached, fresh = self.check(dev_filter = '[02468]$')
+        self.assertEqual(cached, fresh)
+        self.assertEqual(self.cached(), {'PROFILE_1': all_files['PROFILE_1'] - set([os.path.join(tcc.cfg_root_dir,
+                                                                                    'PROFILE_1', 'dev00003.txt')]),
+                                         'PROFILE_2': all_files['PROFILE_2']})
+
+class TestCommandRisks (unittest.TestCase):
+    def risks (self, pattern):
+        messages = [message for severity, message in tcc.command_risks(pattern)]
+        found = set()
+        for key, text in (('backtrack', 'backtrack'), ('end', "'$' followed"), ('begin', "'^' after"),
+                          ('dot', "'.' between digits"), ('or', "'|'")):
+            if any(text in message for message in messages):
+                found.add(key)
+        return found
+
+    def test_classifications (self):
+        cases = [
+            (r'(\S+\s*)+$', {'backtrack'}), (r'(a+)+b', {'backtrack'}), (r'(a|aa)+$', {'backtrack'}),
+            (r'router bgp@@@(\s*\w+)*x$', {'backtrack'}), (r'(.*,)*end', {'backtrack'}),
+            (r'(\s+\S+)*$', set()), (r'(ab)+', set()), (r'(\d+\.){3}\d+', set()), (r'\S+ \d+$', set()),
+            (r'(a+){2,5}', set()), (r'username \S+ password 7', set()),
+            (r'end$ x', {'end'}), (r'a$b', {'end'}), (r'a$', set()), (r'a$\s*', set()),
+            (r'a^b', {'begin'}), (r'^a', set()), (r'\s*^a', set()),
+            (r'ip route 10.0.0.0', {'dot'}), (r'ip route 10\.0\.0\.0', set()), (r'a.b', set()), (r'1.*2', set()),
+            (r'shutdown|description', {'or'}), (r'(shutdown|description)', set()), (r'[a|b]', set()),
+            (r'a\|b', set()), (r'a(?:b|c)', set()),
+            (r'(\S+\s*)+ 10.1|x$y', {'backtrack', 'dot', 'or', 'end'}),
+        ]
+        for pattern, expected in cases:
+            self.assertEqual(self.risks(pattern), expected, pattern)
+        problems = tcc.command_problems(['a$', '(b', 'c|d', 'e***f'])
+        self.assertEqual([(i, severity) for i, severity, message in problems], [(1, 'ERROR'), (2, 'WARNING')])
+
+    def test_random_commands (self):
+        rand = random.Random(10)
+        pieces = ['a', 'b', '1', '2', ' ', '.', '\\.', '\\d+', '\\S+', '\\s*', '.*', '$', '^', '(', ')', '|', '+', '*',
+                  '?', '[ab]', '{2}', '@@@']
+        lines = [' '.join(rand.choice(['a', 'b', '1', '2', '1.2', 'ab', '@@@', 'a@@@b']) for i in range(rand.randint(0, 6)))
+                 for j in range(3000)]
+        never = 0
+        for test in range(3000):
+            # the commands written from a config line are never warned about
+            config_line = rand.choice(random_config(rand)).strip()
+            self.assertEqual(self.risks(re.escape(config_line) + '$'), set(), config_line)
+            self.assertEqual(self.risks('^' + re.escape(config_line)), set(), config_line)
+            # and the commands that can never match don't match any line (with alternatives or optional parts, it's
+            # only that part of the command that can never match)
+            pattern = ''.join(rand.choice(pieces) for i in range(rand.randint(1, 8)))
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                continue
+            if self.risks(pattern) & {'end', 'begin'} and not re.search('[|*?{]', pattern):
+                never += 1
+                self.assertFalse(any(regex.search(line) for line in lines), pattern)
+        self.assertGreater(never, 50)
+
+if __name__ == '__main__':
+    unittest.main()